@@ -0,0 +1,21 @@
+# Generated by Django 4.1.3 on 2026-10-18 01:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annoquery', '0006_genes_annoquery_g_chromos_209e01_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='genes',
+            index=models.Index(fields=['gene'], name='annoquery_g_gene_a45290_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='snps',
+            index=models.Index(fields=['rsid'], name='annoquery_s_rsid_24b79f_idx'),
+        ),
+    ]
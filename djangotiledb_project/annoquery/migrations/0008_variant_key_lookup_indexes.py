@@ -0,0 +1,59 @@
+# Generated by Django 4.1.3 on 2026-10-18 01:24
+
+from django.db import migrations, models
+
+# same expression as annoquery.models.VARIANT_KEY_SQL, frozen here as migrations must not depend on models
+VARIANT_KEY_SQL = ("(('x' || substr(md5(regexp_replace(upper({chromosome}::text), '^CHR', '') || ':' || {position}::text || ':' "
+                   "|| coalesce({ref}, '') || ':' || coalesce({alt}, '')), 1, 16))::bit(64)::bigint)")
+# Clinvars stores chrX/chrY as '23'/'24'; the loader and the lookups hash them as X/Y
+CLINVAR_CHROMOSOME_SQL = "CASE chromosome WHEN '23' THEN 'X' WHEN '24' THEN 'Y' ELSE chromosome END"
+SNPS_KEY_SQL = VARIANT_KEY_SQL.format(chromosome='chr', position='start', ref='ref', alt='alt')
+CLINVARS_KEY_SQL = VARIANT_KEY_SQL.format(chromosome=f'({CLINVAR_CHROMOSOME_SQL})', position='positionvcf',
+                                          ref='referenceallelevcf', alt='alternateallelevcf')
+
+
+def populate_variant_keys(apps, schema_editor):
+    """Backfills the keys with one set-based UPDATE per table. Postgres only: other backends (e.g. a
+    sqlite annodb used for benchmarks) have no md5()/bit casts and get their keys from the loader."""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('UPDATE annoquery_snps SET variant_key = ' + SNPS_KEY_SQL)
+    schema_editor.execute('UPDATE annoquery_clinvars SET variant_key = ' + CLINVARS_KEY_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annoquery', '0007_genes_gene_snps_rsid_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clinvars',
+            name='variant_key',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='snps',
+            name='variant_key',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        # backfill before the indexes exist, so the update does not maintain them row by row
+        migrations.RunPython(populate_variant_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='clinvars',
+            index=models.Index(fields=['chromosome', 'start', 'stop', 'alternateallelevcf'], name='annoquery_c_lookup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='clinvars',
+            index=models.Index(fields=['variant_key'], name='annoquery_c_varkey_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='snps',
+            index=models.Index(fields=['chr', 'start', 'stop', 'alt'], include=('id', 'rsid'), name='annoquery_s_lookup_cov_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='snps',
+            index=models.Index(fields=['variant_key'], include=('rsid',), name='annoquery_s_varkey_idx'),
+        ),
+    ]
@@ -0,0 +1,70 @@
+from django.db import migrations
+
+# frozen copies of the contig names (tilequery.utils.regionops.CHR_DICT_STR_TO_INT) and of the Snps
+# indexes as of 0008, as migrations must not depend on the current code
+CONTIGS = [f'chr{i}' for i in range(1, 23)] + ['chrX', 'chrY']
+SNPS_INDEXES = [
+    ('annoquery_s_chr_ef6b6d_idx', '(chr, start)'),
+    ('annoquery_s_rsid_24b79f_idx', '(rsid)'),
+    ('annoquery_s_lookup_cov_idx', '(chr, start, stop, alt) INCLUDE (id, rsid)'),
+    ('annoquery_s_varkey_idx', '(variant_key) INCLUDE (rsid)'),
+]
+SNPS = 'annoquery_snps'
+OLD = 'annoquery_snps__old'
+SEQUENCE = 'annoquery_snps_id_seq'
+
+
+def _rebuild_snps(schema_editor, partitioned:bool):
+    """Copies annoquery_snps into a new table, either LIST-partitioned by `chr` (one partition per
+    contig plus a default one) or plain, and recreates the indexes under their Django names. On the
+    partitioned table the indexes are declared on the parent and created on every partition, and the
+    primary key has to include the partition key, hence (id, chr)."""
+    execute = schema_editor.execute
+    execute(f'ALTER TABLE {SNPS} RENAME TO {OLD}')
+    for name, _ in SNPS_INDEXES:
+        execute(f'DROP INDEX IF EXISTS {name}')
+    # no identity: partitioned tables cannot have one, so ids come from a plain owned sequence
+    execute(f'CREATE TABLE {SNPS} (LIKE {OLD} INCLUDING DEFAULTS)' + (' PARTITION BY LIST (chr)' if partitioned else ''))
+    execute(f'ALTER TABLE {SNPS} ALTER COLUMN id DROP DEFAULT')
+    execute(f'DROP SEQUENCE IF EXISTS {SEQUENCE}__new')
+    execute(f'CREATE SEQUENCE {SEQUENCE}__new OWNED BY {SNPS}.id')
+    execute(f"ALTER TABLE {SNPS} ALTER COLUMN id SET DEFAULT nextval('{SEQUENCE}__new')")
+    if partitioned:
+        for contig in CONTIGS:
+            execute(f"CREATE TABLE {SNPS}_{contig.lower()} PARTITION OF {SNPS} FOR VALUES IN ('{contig}')")
+        execute(f'CREATE TABLE {SNPS}_other PARTITION OF {SNPS} DEFAULT')
+
+    execute(f'INSERT INTO {SNPS} SELECT * FROM {OLD}')
+    execute(f'DROP TABLE {OLD} CASCADE')
+    execute(f'ALTER SEQUENCE {SEQUENCE}__new RENAME TO {SEQUENCE}')
+    execute(f"SELECT setval('{SEQUENCE}', coalesce((SELECT max(id) FROM {SNPS}), 0) + 1, false)")
+
+    execute(f'ALTER TABLE {SNPS} ADD CONSTRAINT {SNPS}_pkey PRIMARY KEY ' + ('(id, chr)' if partitioned else '(id)'))
+    for name, columns in SNPS_INDEXES:
+        execute(f'CREATE INDEX {name} ON {SNPS} USING btree {columns}')
+    execute(f'ANALYZE {SNPS}')
+
+
+def partition_snps(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    _rebuild_snps(schema_editor, partitioned=True)
+
+
+def unpartition_snps(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    _rebuild_snps(schema_editor, partitioned=False)
+
+
+# postgres only, and not visible in the model state: Django has no notion of partitioned tables,
+# and the `filter(chr=...)` lookups prune to one partition without any ORM change
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annoquery', '0008_variant_key_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_snps, unpartition_snps),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annoquery', '0009_partition_snps_by_chromosome'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='genes',
+            index=models.Index(django.db.models.functions.text.Upper('gene'), name='annoquery_g_gene_upper_idx'),
+        ),
+    ]
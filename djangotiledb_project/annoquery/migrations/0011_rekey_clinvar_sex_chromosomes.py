@@ -0,0 +1,26 @@
+from django.db import migrations
+
+# frozen copy of 0008's Clinvars key expression, with chromosome '23'/'24' hashed as X/Y
+VARIANT_KEY_SQL = ("(('x' || substr(md5(regexp_replace(upper({chromosome}::text), '^CHR', '') || ':' || {position}::text || ':' "
+                   "|| coalesce({ref}, '') || ':' || coalesce({alt}, '')), 1, 16))::bit(64)::bigint)")
+CLINVARS_KEY_SQL = VARIANT_KEY_SQL.format(chromosome="(CASE chromosome WHEN '23' THEN 'X' WHEN '24' THEN 'Y' ELSE chromosome END)",
+                                          position='positionvcf', ref='referenceallelevcf', alt='alternateallelevcf')
+
+
+def rekey_sex_chromosomes(apps, schema_editor):
+    """0008 first hashed the chrX/chrY rows of Clinvars as '23'/'24', which no lookup asks for.
+    Postgres only, like the 0008 backfill."""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f"UPDATE annoquery_clinvars SET variant_key = {CLINVARS_KEY_SQL} WHERE chromosome IN ('23', '24')")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annoquery', '0010_genes_gene_upper_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(rekey_sex_chromosomes, migrations.RunPython.noop),
+    ]
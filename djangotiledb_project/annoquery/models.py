@@ -1,7 +1,24 @@
 from django.db import models
+from django.db.models.functions import Upper
+
+import hashlib
 
 # Create your models here.
 
+def variant_key(chromosome, position, ref, alt) -> int:
+    """Compact exact-match key of a variant: the first 64 bits of md5('CHROM:POS:REF:ALT') as a
+    signed integer. The chromosome is upper-cased with any `chr` prefix dropped, so `chr17` (tiledb,
+    dbSNP) and `17` (ClinVar) give the same key. VARIANT_KEY_SQL computes the same value in postgres."""
+    chromosome = str(chromosome).upper()
+    chromosome = chromosome[3:] if chromosome.startswith('CHR') else chromosome
+    s = f'{chromosome}:{int(position)}:{ref or ""}:{alt or ""}'
+    return int.from_bytes(hashlib.md5(s.encode()).digest()[:8], 'big', signed=True)
+
+# postgres expression matching `variant_key`, formatted with the column names of a table. Clinvars stores
+# chrX/chrY as '23'/'24', which must be mapped to 'X'/'Y' first (see migration 0008).
+VARIANT_KEY_SQL = ("(('x' || substr(md5(regexp_replace(upper({chromosome}::text), '^CHR', '') || ':' || {position}::text || ':' "
+                   "|| coalesce({ref}, '') || ':' || coalesce({alt}, '')), 1, 16))::bit(64)::bigint)")
+
 class Snps(models.Model):    
     rsid = models.CharField(max_length=16)
     chr = models.CharField(max_length=32)
@@ -9,11 +26,16 @@ class Snps(models.Model):
     stop = models.IntegerField()
     ref = models.CharField(max_length=64, blank=True, null=True)
     alt = models.CharField(max_length=64, blank=True, null=True)
+    variant_key = models.BigIntegerField(blank=True, null=True) # variant_key(chr, start, ref, alt)
 
     class Meta:
         app_label = 'annoquery'
         indexes = [
-            models.Index(fields=['chr','start'])
+            models.Index(fields=['chr','start']),
+            models.Index(fields=['rsid']),
+            # covers the batched annotation lookup (filter chr/start, match stop/alt, return id/rsid) as an index-only scan
+            models.Index(fields=['chr','start','stop','alt'], include=['id','rsid'], name='annoquery_s_lookup_cov_idx'),
+            models.Index(fields=['variant_key'], include=['rsid'], name='annoquery_s_varkey_idx'),
         ]
 
 class Clinvars(models.Model):
@@ -54,6 +76,7 @@ class Clinvars(models.Model):
     referenceallelevcf = models.CharField(max_length=100) # will truncate longer deletions, but will be captured anyway by start and stop
     alternateallelevcf = models.CharField(max_length=100) # will truncate longer insertions, but will be captured anyway by start and stop
     order = models.FloatField()
+    variant_key = models.BigIntegerField(blank=True, null=True) # variant_key(chromosome, positionvcf, referenceallelevcf, alternateallelevcf)
 
     def __repr__(self) -> str:
         return super().__repr__() + f'//{self.clinicalsignificance}//{self.genesymbol}//{self.chromosome}:{self.start}-{self.stop}'
@@ -63,6 +86,9 @@ class Clinvars(models.Model):
         indexes = [
             models.Index(fields=['chromosome','start']),
             models.Index(fields=['clinicalsignificance']),
+            # exact match of the batched annotation lookup, so the wide rows are only visited on a hit
+            models.Index(fields=['chromosome','start','stop','alternateallelevcf'], name='annoquery_c_lookup_idx'),
+            models.Index(fields=['variant_key'], name='annoquery_c_varkey_idx'),
         ]
 
 
@@ -79,4 +105,7 @@ class Genes(models.Model):
         app_label = 'annoquery'
         indexes = [
             models.Index(fields=['chromosome','start']),
+            models.Index(fields=['gene']),
+            # gene symbols typed in the regions field are matched case-insensitively
+            models.Index(Upper('gene'), name='annoquery_g_gene_upper_idx'),
         ]
@@ -1,3 +1,42 @@
-from django.test import TestCase
+from django.db import connections
+from django.test import SimpleTestCase, TestCase
+from importlib import import_module
+import unittest
 
-# Create your tests here.
+from .models import variant_key
+
+variant_key_migration = import_module('annoquery.migrations.0008_variant_key_lookup_indexes')
+
+
+class VariantKeyTests(SimpleTestCase):
+
+    def test_chromosome_is_normalized(self):
+        self.assertEqual(variant_key('chr17', 100, 'A', 'G'), variant_key('17', 100, 'A', 'G'))
+        self.assertEqual(variant_key('chrX', 100, 'A', 'G'), variant_key('x', 100, 'A', 'G'))
+        self.assertNotEqual(variant_key('chr17', 100, 'A', 'G'), variant_key('chr17', 100, 'A', 'T'))
+
+    def test_missing_alleles(self):
+        self.assertEqual(variant_key('1', 5, None, None), variant_key('1', 5, '', ''))
+
+
+@unittest.skipUnless(connections['annodb'].vendor == 'postgresql', 'the backfill SQL needs postgres')
+class VariantKeySqlTests(TestCase):
+    """The keys the 0008 backfill writes in SQL match the ones the lookups compute in Python."""
+
+    databases = {'annodb'}
+
+    def sql_key(self, expression, columns, values):
+        with connections['annodb'].cursor() as cursor:
+            cursor.execute(f'SELECT {expression} FROM (VALUES (%s, %s, %s, %s)) AS t({",".join(columns)})', values)
+            return cursor.fetchone()[0]
+
+    def test_snps_keys(self):
+        for contig in ('chr17', 'chrX', 'chrY'):
+            self.assertEqual(self.sql_key(variant_key_migration.SNPS_KEY_SQL, ['chr', 'start', 'ref', 'alt'], [contig, 100, 'AT', 'A']),
+                             variant_key(contig, 100, 'AT', 'A'))
+
+    def test_clinvars_keys(self):
+        columns = ['chromosome', 'positionvcf', 'referenceallelevcf', 'alternateallelevcf']
+        for chromosome, contig in (('17', 'chr17'), ('23', 'chrX'), ('24', 'chrY')):
+            self.assertEqual(self.sql_key(variant_key_migration.CLINVARS_KEY_SQL, columns, [chromosome, 100, 'AT', 'A']),
+                             variant_key(contig, 100, 'AT', 'A'))
@@ -0,0 +1,6 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path('clinvar/<int:clinvar_id>/', views.clinvar_detail, name='clinvar_detail'),
+]
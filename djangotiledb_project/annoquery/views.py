@@ -1,3 +1,14 @@
-from django.shortcuts import render
+from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
 
-# Create your views here.
+from .models import Clinvars
+
+
+@login_required
+def clinvar_detail(request, clinvar_id):
+    """Every column of one Clinvars row, including the large free-text fields that the query
+    results leave out. Fetched by the results page when a row is expanded."""
+    fields = [f.name for f in Clinvars._meta.concrete_fields if f.name != 'variant_key']
+    row = get_object_or_404(Clinvars.objects.values(*fields), pk=clinvar_id)
+    return JsonResponse(row)
@@ -141,3 +141,24 @@ STATICFILES_STORAGE = "django.contrib.staticfiles.storage.StaticFilesStorage"
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGIN_REDIRECT_URL = '/query/'
+
+# where query results are annotated from: 'postgres' (the annoquery tables on annodb) or 'local',
+# the memory-mapped Arrow files written by `manage.py build_annotation_store` to ANNOTATION_STORE_DIR
+ANNOTATION_BACKEND = os.environ.get('ANNOTATION_BACKEND', 'postgres')
+ANNOTATION_STORE_DIR = BASE_DIR / 'annotation_store'
+
+# per-worker LRU of annotation lookups by variant, emptied when the annotation data changes.
+# ANNOTATION_SHARED_CACHE names an entry of CACHES to also share entries between workers.
+ANNOTATION_CACHE_SIZE = 200000
+ANNOTATION_CACHE_TTL_SECONDS = 3600
+ANNOTATION_SHARED_CACHE = None
+# annotate the pathogenic_vars hotspots in the background when a worker starts
+ANNOTATION_CACHE_PREWARM = True
+
+# per-stage query timings are logged as JSON on the `tilequery.trace` logger and exposed on /metrics.
+# Every process writes its counters to QUERY_METRICS_DIR so that /metrics can sum all of them.
+QUERY_METRICS_DIR = BASE_DIR / 'query_metrics'
+# /metrics is served to staff only: scrape it with a staff user's token (manage.py create_api_token)
+# set to a directory to let staff users profile one request with `?profile=1` (cProfile .prof)
+# or `?profile=pyinstrument` (HTML, needs pyinstrument installed)
+QUERY_PROFILE_DIR = None
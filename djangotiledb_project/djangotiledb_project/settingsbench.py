@@ -0,0 +1,43 @@
+"""
+Settings for `manage.py benchmark_queries`: the dev settings with both databases replaced by
+throw-away SQLite files under BENCH_DIR, so the benchmark can seed Snps/Clinvars/Genes freely.
+
+    DJANGO_SETTINGS_MODULE=djangotiledb_project.settingsbench python manage.py benchmark_queries
+
+Set BENCH_ANNODB_NAME (and BENCH_ANNODB_HOST/PORT/USER/PASSWORD) to benchmark the annotation
+lookups against a local Postgres database instead. Its annoquery tables are overwritten.
+"""
+import os
+
+os.environ.setdefault('SECRET_KEY', 'benchmark-only')
+
+from .settingsdev import *
+
+# `benchmark_queries` refuses to seed annotation tables unless this is set
+BENCHMARK = True
+BENCH_DIR = BASE_DIR / 'bench'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BENCH_DIR / 'default.sqlite3',
+    },
+    'annodb': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BENCH_DIR / 'annodb.sqlite3',
+    },
+}
+if os.environ.get('BENCH_ANNODB_NAME'):
+    DATABASES['annodb'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ['BENCH_ANNODB_NAME'],
+        'USER': os.environ.get('BENCH_ANNODB_USER', 'postgres'),
+        'PASSWORD': os.environ.get('BENCH_ANNODB_PASSWORD', ''),
+        'HOST': os.environ.get('BENCH_ANNODB_HOST', 'localhost'),
+        'PORT': os.environ.get('BENCH_ANNODB_PORT', '5432'),
+    }
+
+# the per-worker annotation cache would turn every repeat into a cache hit
+ANNOTATION_CACHE_SIZE = int(os.environ.get('BENCH_ANNOTATION_CACHE_SIZE', '0'))
+ANNOTATION_CACHE_PREWARM = False
+QUERY_METRICS_DIR = None
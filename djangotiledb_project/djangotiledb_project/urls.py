@@ -16,10 +16,14 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.contrib.auth import views as auth_views
+from tilequery.views import metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),    
     path('accounts/', include('django.contrib.auth.urls')),
+    path('annotations/', include('annoquery.urls')),
+    path('api/v1/', include('tilequery.api_urls')),
+    path('metrics', metrics, name='metrics'),
     path('', include('tilequery.urls')),
     path('query/', include('tilequery.urls')),
 ]
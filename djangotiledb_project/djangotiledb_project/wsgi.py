@@ -8,9 +8,24 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/wsgi/
 """
 
 import os
+import logging
+import threading
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djangotiledb_project.settings')
 
 application = get_wsgi_application()
+
+
+def _prewarm():
+    try:
+        from tilequery.views import prewarm_annotation_cache
+        prewarm_annotation_cache()
+    except Exception:
+        logging.getLogger('django').exception('annotation cache prewarm failed')
+
+# warm this worker's annotation caches without delaying its first request
+if getattr(settings, 'ANNOTATION_CACHE_PREWARM', False):
+    threading.Thread(target=_prewarm, name='annotation-prewarm', daemon=True).start()
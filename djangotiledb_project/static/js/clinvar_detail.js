@@ -0,0 +1,38 @@
+// Expands a result row with the full Clinvars record (including the large text fields the
+// query results leave out) when its clinvar_id link is clicked. A second click collapses it.
+document.addEventListener('click', function (event) {
+    var link = event.target.closest('a.clinvar-detail');
+    if (!link) {
+        return;
+    }
+    event.preventDefault();
+    var row = link.closest('tr');
+    var next = row.nextElementSibling;
+    if (next && next.classList.contains('clinvar-detail-row')) {
+        next.remove();
+        return;
+    }
+    fetch(link.href, {credentials: 'same-origin'})
+        .then(function (response) { return response.json(); })
+        .then(function (record) {
+            var detail = document.createElement('tr');
+            detail.className = 'clinvar-detail-row';
+            var cell = document.createElement('td');
+            cell.colSpan = row.children.length;
+            var list = document.createElement('dl');
+            list.className = 'row text-start small mb-0';
+            Object.keys(record).forEach(function (key) {
+                var term = document.createElement('dt');
+                term.className = 'col-sm-2';
+                term.textContent = key;
+                var value = document.createElement('dd');
+                value.className = 'col-sm-10';
+                value.textContent = record[key];
+                list.appendChild(term);
+                list.appendChild(value);
+            });
+            cell.appendChild(list);
+            detail.appendChild(cell);
+            row.after(detail);
+        });
+});
@@ -0,0 +1,117 @@
+// Lightweight result table: the page only holds an empty table, each page of rows is fetched from
+// the JSON page endpoint in data-page-url. Clicking a header sorts on the server (again to reverse),
+// the filter box does a case-insensitive substring match on the selected column.
+(function () {
+    function init(view) {
+        // the template (and with it this script) may be included once per table on a page
+        if (view.dataset.initialized) {
+            return;
+        }
+        view.dataset.initialized = '1';
+        var state = {offset: 0, sort: '', order: 'asc', filterColumn: '', filter: '', total: 0, columns: null};
+        var pageSize = parseInt(view.dataset.pageSize, 10) || 100;
+        var head = view.querySelector('thead');
+        var body = view.querySelector('tbody');
+        var status = view.querySelector('.result-status');
+        var columnSelect = view.querySelector('.result-filter-column');
+        var filterInput = view.querySelector('.result-filter');
+        var clinvarUrl = view.dataset.clinvarUrl;
+        var timer = null;
+
+        function cell(column, value) {
+            var td = document.createElement('td');
+            if (column === 'clinvar_id' && value !== null && value !== '-') {
+                var link = document.createElement('a');
+                link.className = 'clinvar-detail';
+                link.href = clinvarUrl.replace(/0\/$/, value + '/');
+                link.textContent = value;
+                td.appendChild(link);
+            } else {
+                td.textContent = value === null ? '' : (Array.isArray(value) ? value.join(',') : value);
+            }
+            return td;
+        }
+
+        function renderHead(columns) {
+            head.innerHTML = '';
+            var tr = document.createElement('tr');
+            var sn = document.createElement('th');
+            sn.textContent = 'S/N';
+            tr.appendChild(sn);
+            columns.forEach(function (column) {
+                var th = document.createElement('th');
+                th.textContent = column + (state.sort === column ? (state.order === 'asc' ? ' ▲' : ' ▼') : '');
+                th.style.cursor = 'pointer';
+                th.addEventListener('click', function () {
+                    state.order = (state.sort === column && state.order === 'asc') ? 'desc' : 'asc';
+                    state.sort = column;
+                    state.offset = 0;
+                    load();
+                });
+                tr.appendChild(th);
+            });
+            head.appendChild(tr);
+            if (!state.columns) {
+                columns.forEach(function (column) {
+                    var option = document.createElement('option');
+                    option.value = option.textContent = column;
+                    columnSelect.appendChild(option);
+                });
+                state.filterColumn = columns[0] || '';
+            }
+            state.columns = columns;
+        }
+
+        function render(page) {
+            renderHead(page.columns);
+            body.innerHTML = '';
+            page.rows.forEach(function (row, i) {
+                var tr = document.createElement('tr');
+                tr.appendChild(cell('S/N', page.offset + i));
+                row.forEach(function (value, j) { tr.appendChild(cell(page.columns[j], value)); });
+                body.appendChild(tr);
+            });
+            state.total = page.total_rows;
+            var last = Math.min(page.offset + page.rows.length, page.total_rows);
+            status.textContent = (page.total_rows ? (page.offset + 1) + '-' + last : '0') + ' of ' + page.total_rows +
+                (page.total_rows !== page.stored_rows ? ' (filtered from ' + page.stored_rows + ')' : '') +
+                (page.truncated ? ', result truncated' : '');
+        }
+
+        function load() {
+            var params = new URLSearchParams({offset: state.offset, limit: pageSize});
+            if (state.sort) { params.set('sort', state.sort); params.set('order', state.order); }
+            if (state.filter) { params.set('filter_column', state.filterColumn); params.set('filter', state.filter); }
+            status.textContent = 'loading...';
+            fetch(view.dataset.pageUrl + '?' + params, {credentials: 'same-origin'})
+                .then(function (response) { return response.json(); })
+                .then(function (page) {
+                    if (page.error) { status.textContent = page.error; return; }
+                    render(page);
+                });
+        }
+
+        view.querySelector('.result-prev').addEventListener('click', function () {
+            if (state.offset > 0) { state.offset = Math.max(0, state.offset - pageSize); load(); }
+        });
+        view.querySelector('.result-next').addEventListener('click', function () {
+            if (state.offset + pageSize < state.total) { state.offset += pageSize; load(); }
+        });
+        function refilter() {
+            clearTimeout(timer);
+            timer = setTimeout(function () {
+                state.filter = filterInput.value.trim();
+                state.filterColumn = columnSelect.value;
+                state.offset = 0;
+                load();
+            }, 300);
+        }
+        filterInput.addEventListener('input', refilter);
+        columnSelect.addEventListener('change', function () { if (filterInput.value.trim()) { refilter(); } });
+        load();
+    }
+
+    document.addEventListener('DOMContentLoaded', function () {
+        document.querySelectorAll('.result-view').forEach(init);
+    });
+})();
@@ -0,0 +1,33 @@
+// Suggests sample names for the last comma-separated entry of the samples field, from the
+// sample_search endpoint, instead of shipping the whole sample list with the page.
+document.addEventListener('DOMContentLoaded', function () {
+    var input = document.querySelector('input[data-sample-search]');
+    if (!input) {
+        return;
+    }
+    var list = document.getElementById(input.getAttribute('list'));
+    var timer = null;
+    input.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            var parts = input.value.split(',');
+            var last = parts.pop().trim();
+            if (!last) {
+                list.innerHTML = '';
+                return;
+            }
+            var prefix = parts.length ? parts.join(',') + ',' : '';
+            var url = input.dataset.sampleSearch + '?limit=20&q=' + encodeURIComponent(last);
+            fetch(url, {credentials: 'same-origin'})
+                .then(function (response) { return response.json(); })
+                .then(function (page) {
+                    list.innerHTML = '';
+                    page.results.forEach(function (name) {
+                        var option = document.createElement('option');
+                        option.value = prefix + name;
+                        list.appendChild(option);
+                    });
+                });
+        }, 200);
+    });
+});
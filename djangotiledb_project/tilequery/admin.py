@@ -1,3 +1,32 @@
 from django.contrib import admin
 
+from .models import QueryJob, Cohort, ApiToken
+
 # Register your models here.
+
+@admin.register(QueryJob)
+class QueryJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'status', 'rows_kept', 'created', 'finished']
+    list_filter = ['status']
+    readonly_fields = ['id', 'created', 'started', 'finished']
+
+
+@admin.register(Cohort)
+class CohortAdmin(admin.ModelAdmin):
+    list_display = ['name', 'owner', 'sample_count', 'shared', 'updated']
+    list_filter = ['shared']
+    search_fields = ['name', 'description']
+    # the sample list is edited from the cohorts page, which validates it against the dataset
+    exclude = ['samples_blob']
+    readonly_fields = ['sample_count', 'digest', 'created', 'updated']
+
+
+@admin.register(ApiToken)
+class ApiTokenAdmin(admin.ModelAdmin):
+    list_display = ['prefix', 'user', 'name', 'revoked', 'expires', 'last_used', 'created']
+    list_filter = ['revoked']
+    # keys are issued by `manage.py create_api_token`, here they can only be revoked or re-dated
+    readonly_fields = ['user', 'prefix', 'key_hash', 'last_used', 'created']
+
+    def has_add_permission(self, request):
+        return False
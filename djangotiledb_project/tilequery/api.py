@@ -0,0 +1,195 @@
+from django.http import HttpResponse, JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.views.decorators.gzip import gzip_page
+
+import pandas as pd
+from typing import List
+import base64
+import binascii
+import logging
+import json
+
+import pyarrow as pa
+
+from . import views
+from .auth import api_token_required
+from .utils.cohortops import expand_sample_tokens
+from .utils.identifierops import expand_query_tokens
+from .utils.regionops import parse_regions
+from .utils.arrowops import EXPORT_FORMATS, dataframe_to_arrow
+from .utils.resultcache import canonical_query, query_cache_key
+from .utils.resultview import table_rows
+from .utils.instrumentation import instrumented
+
+logger = logging.getLogger('django')
+
+# rows per page when the client does not ask, and the most it may ask for
+API_PAGE_SIZE=int(views.config.get('API', 'PAGE_SIZE', fallback='1000'))
+API_MAX_PAGE_SIZE=int(views.config.get('API', 'MAX_PAGE_SIZE', fallback='10000'))
+# an API query keeps at most this many rows; `truncated` tells the client when it was hit
+API_MAX_ROWS=int(views.config.get('API', 'MAX_ROWS', fallback='1000000'))
+
+API_FORMATS = ['json', 'arrow']
+
+DEFAULT_ATTRS = ['sample_name', 'id', 'alleles', 'fmt_GT', 'contig', 'pos_start', 'pos_end', 'info_AF']
+
+
+class ApiError(Exception):
+    pass
+
+
+def _params(request) -> dict:
+    """GET query string or a POST JSON object. Lists may be JSON lists or comma separated strings."""
+    if request.method == 'POST':
+        try:
+            params = json.loads(request.body or b'{}')
+        except ValueError as e:
+            raise ApiError(f'request body is not JSON: {e}')
+        if not isinstance(params, dict):
+            raise ApiError('request body must be a JSON object.')
+        return params
+    return request.GET.dict()
+
+
+def _list(params:dict, name:str, default:List[str]=None) -> List[str]:
+    value = params.get(name)
+    if value is None or value == '':
+        return list(default or [])
+    if isinstance(value, str):
+        value = value.split(',')
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def _flag(params:dict, name:str) -> bool:
+    value = params.get(name, False)
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def _int(params:dict, name:str, default:int) -> int:
+    try:
+        return int(params.get(name, default))
+    except (TypeError, ValueError):
+        raise ApiError(f'{name} must be an integer.')
+
+
+def encode_cursor(key:str, offset:int) -> str:
+    return base64.urlsafe_b64encode(json.dumps(dict(q=key[:16], o=offset)).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor:str, key:str) -> int:
+    """Offset of `cursor`. The cursor carries a prefix of the query key, so it is rejected when the
+    query or the data it was issued for changed since."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        offset, prefix = int(data['o']), data['q']
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ApiError('malformed cursor.')
+    if prefix != key[:16] or offset < 0:
+        raise ApiError('cursor does not belong to this query, or the data changed since it was issued. Start again without a cursor.')
+    return offset
+
+
+def _build_result(key:str, regions, samples, attrs, flags):
+    """Runs the query (up to API_MAX_ROWS rows) into the result cache."""
+    stream = views._stream_query_tiledb(regions=regions, samples=samples, attrs=attrs, row_limit=API_MAX_ROWS, **flags)
+    try:
+        frames = [views.dataframe_common_final_reformat(df) for df in stream]
+    except Exception:
+        views.DATASET_POOL.discard(views.URI, views.BATCH_MEMORY_BUDGET_MB)
+        raise
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=attrs)
+    try:
+        views.RESULT_CACHE.put(key, df, truncated=stream.truncated, row_group_size=API_MAX_PAGE_SIZE)
+    except Exception:
+        logger.exception('query_api: could not store result')
+    return df, stream.truncated
+
+
+@gzip_page
+@api_token_required
+@instrumented('api_query')
+def query_api(request):
+    """`/api/v1/query`: the `index` query as JSON or Arrow, one page at a time.
+
+    Parameters (GET query string or POST JSON): regions, samples (names or `cohort:<name>`), attrs,
+    clinvar, hidenonvariants, genelist, fields (columns to return), page_size, cursor, format
+    (json or arrow). The full result is computed once into the result cache; `next_cursor` (JSON) or
+    the `X-Next-Cursor` header (Arrow) fetches the next page of the same query. Responses are
+    gzip-compressed for clients that accept it."""
+    if request.method not in ('GET', 'POST'):
+        return JsonResponse(dict(error='Use GET or POST.'), status=405)
+    try:
+        params = _params(request)
+        regions = _list(params, 'regions')
+        sample_tokens = _list(params, 'samples')
+        attrs = _list(params, 'attrs', DEFAULT_ATTRS)
+        fields = _list(params, 'fields')
+        flags = dict(clinvar_flag=_flag(params, 'clinvar'),
+                     hidenonvariants_flag=_flag(params, 'hidenonvariants'),
+                     genelist_flag=_flag(params, 'genelist'))
+        page_size = _int(params, 'page_size', API_PAGE_SIZE)
+        fmt = params.get('format', 'json')
+        if fmt not in API_FORMATS:
+            raise ApiError(f'unknown format {fmt}. Choose from {",".join(API_FORMATS)}.')
+        if not 1 <= page_size <= API_MAX_PAGE_SIZE:
+            raise ApiError(f'page_size must be between 1 and {API_MAX_PAGE_SIZE}.')
+
+        if not regions:
+            if not sample_tokens:
+                raise ApiError('regions and samples must not both be empty.')
+            regions = views.pathogenic_vars
+        regions, unresolved = expand_query_tokens(regions)
+        if unresolved:
+            raise ApiError(f'could not resolve gene symbol(s)/rsID(s): {",".join(unresolved)}')
+        try:
+            parse_regions(regions)
+        except ValueError as e:
+            raise ApiError(str(e))
+        samples, sample_key, unresolved_cohorts = expand_sample_tokens(sample_tokens or [''], request.user)
+        if unresolved_cohorts:
+            raise ApiError(f'unknown or empty cohort(s): {",".join(unresolved_cohorts)}')
+        unknown_samples = views.SAMPLE_CATALOG.get().unknown(samples)
+        if unknown_samples:
+            raise ApiError(f'unknown sample(s): {",".join(unknown_samples[:20])}')
+
+        versions = views._query_cache_versions(flags['clinvar_flag'], flags['genelist_flag'], row_limit=API_MAX_ROWS)
+        key = query_cache_key(canonical_query(regions, sample_key, attrs, flags, **versions))
+        offset = decode_cursor(params['cursor'], key) if params.get('cursor') else 0
+
+        table, total, truncated = views.RESULT_CACHE.get_slice(key, offset, page_size)
+        if table is None:
+            df, truncated = _build_result(key, regions, samples, attrs, flags)
+            total = df.shape[0]
+            table = dataframe_to_arrow(df.iloc[offset:offset + page_size])
+
+        if fields:
+            missing = [f for f in fields if f not in table.column_names]
+            if missing:
+                raise ApiError(f'unknown field(s): {",".join(missing)}. Available: {",".join(table.column_names)}')
+            table = table.select(fields)
+    except ApiError as e:
+        return JsonResponse(dict(error=str(e)), status=400)
+
+    next_offset = offset + table.num_rows
+    next_cursor = encode_cursor(key, next_offset) if next_offset < total else None
+
+    if fmt == 'arrow':
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        response = HttpResponse(sink.getvalue().to_pybytes(), content_type=EXPORT_FORMATS['arrow'][0])
+        response['X-Total-Rows'] = str(total)
+        response['X-Truncated'] = str(truncated).lower()
+        if next_cursor:
+            response['X-Next-Cursor'] = next_cursor
+        return response
+
+    return JsonResponse(dict(total_rows=total,
+                             truncated=truncated,
+                             offset=offset,
+                             next_cursor=next_cursor,
+                             columns=table.column_names,
+                             rows=table_rows(table),
+                             ), encoder=DjangoJSONEncoder)
@@ -0,0 +1,6 @@
+from django.urls import path
+from . import api
+
+urlpatterns = [
+    path('query', api.query_api, name='query_api'),
+]
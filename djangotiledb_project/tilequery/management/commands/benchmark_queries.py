@@ -0,0 +1,184 @@
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+
+import datetime
+import statistics
+import shutil
+import json
+import math
+import os
+
+from tilequery.utils.benchops import (make_sites, make_genotypes, sample_names, write_sample_vcfs, ingest_dataset,
+                                      synthetic_tiledb_frame, seed_annotations, environment_info, compare_results,
+                                      load_results)
+from tilequery.utils.instrumentation import RequestTrace
+
+ATTRS = ['sample_name', 'id', 'alleles', 'fmt_GT', 'contig', 'pos_start', 'pos_end', 'info_AF']
+
+FLAG_SETS = {
+    'none':             dict(),
+    'hidenonvariants':  dict(hidenonvariants_flag=True),
+    'genelist':         dict(genelist_flag=True),
+    'clinvar':          dict(clinvar_flag=True),
+    'all':              dict(hidenonvariants_flag=True, genelist_flag=True, clinvar_flag=True),
+}
+
+
+def _ints(value:str):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+class Command(BaseCommand):
+    help = ('Generates a synthetic TileDB-VCF dataset and annotation tables, times `_query_tiledb` and '
+            '`_append_tiledb_with_annotation` over a grid of result sizes, sample counts and flags, and '
+            'writes the timings (with per-stage breakdowns) as JSON. Needs the benchmark settings: '
+            'DJANGO_SETTINGS_MODULE=djangotiledb_project.settingsbench. Writing the VCFs needs bgzip and tabix.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workdir', default=None, help='defaults to settings.BENCH_DIR')
+        parser.add_argument('--samples', type=int, default=100, help='samples in the synthetic dataset')
+        parser.add_argument('--variants', type=int, default=10000, help='sites in the synthetic dataset')
+        parser.add_argument('--ploidy', type=int, default=2)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--rebuild', action='store_true', help='regenerate the dataset and annotations even if they match')
+        parser.add_argument('--rows', default='10,1000,100000', help='result sizes to aim for')
+        parser.add_argument('--query-samples', default='1,100,10000', help='samples per query')
+        parser.add_argument('--flags', default=','.join(FLAG_SETS), help=f'flag sets, from {",".join(FLAG_SETS)}')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--skip-tiledb', action='store_true', help='only time the annotation step, on synthetic frames')
+        parser.add_argument('--output', help='write the JSON results here instead of stdout')
+        parser.add_argument('--compare', metavar='BASELINE', help='JSON results of an earlier run to compare against')
+        parser.add_argument('--threshold', type=float, default=0.2, help='median slowdown (fraction) reported as a regression')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def _prepare(self, workdir:str, options:dict, sites, genotypes, names) -> str:
+        """Seeds the annotation tables and ingests the dataset, unless the workdir already holds
+        the same ones. Returns the dataset uri."""
+        uri = os.path.join(workdir, 'dataset')
+        manifest_path = os.path.join(workdir, 'manifest.json')
+        manifest = {k: options[k] for k in ('samples', 'variants', 'ploidy', 'seed')}
+        manifest['tiledb'] = not options['skip_tiledb']
+        try:
+            with open(manifest_path) as f:
+                current = json.load(f) == manifest
+        except (OSError, ValueError):
+            current = False
+        if current and not options['rebuild']:
+            return uri
+
+        self.stderr.write('seeding annotation tables')
+        counts = seed_annotations(sites)
+        self.stderr.write(f'  {counts}')
+        if not options['skip_tiledb']:
+            self.stderr.write(f'writing {len(names)} VCFs and ingesting them into {uri}')
+            vcf_dir = os.path.join(workdir, 'vcf')
+            shutil.rmtree(vcf_dir, ignore_errors=True)
+            shutil.rmtree(uri, ignore_errors=True)
+            ingest_dataset(uri, write_sample_vcfs(vcf_dir, sites, genotypes, names))
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        return uri
+
+    def _time(self, name:str, run, repeat:int) -> dict:
+        seconds, rows, extra, stages = [], None, {}, None
+        for _ in range(repeat):
+            trace = RequestTrace(name)
+            with trace.activate():
+                rows, extra = run()
+            seconds.append(trace.elapsed())
+            stages = {k: dict(v.as_dict(), seconds=round(v.seconds, 6)) for k, v in trace.stages.items()}
+        result = dict(name=name, rows=rows, runs=[round(s, 6) for s in seconds],
+                      min_seconds=round(min(seconds), 6),
+                      median_seconds=round(statistics.median(seconds), 6),
+                      max_seconds=round(max(seconds), 6),
+                      stages=stages, **extra)
+        self.stderr.write(f'{name}: {result["median_seconds"]:.4f}s median, {rows} rows')
+        return result
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'BENCHMARK', False):
+            raise CommandError('run with DJANGO_SETTINGS_MODULE=djangotiledb_project.settingsbench, '
+                               'the benchmark overwrites the annotation tables.')
+        unknown = [f for f in options['flags'].split(',') if f not in FLAG_SETS]
+        if unknown:
+            raise CommandError(f'unknown flag set(s) {",".join(unknown)}. Choose from {",".join(FLAG_SETS)}.')
+        flag_sets = options['flags'].split(',')
+
+        workdir = str(options['workdir'] or settings.BENCH_DIR)
+        os.makedirs(workdir, exist_ok=True)
+        for db in settings.DATABASES:
+            call_command('migrate', database=db, verbosity=0)
+
+        sites = make_sites(options['variants'], seed=options['seed'])
+        genotypes = make_genotypes(sites, options['samples'], ploidy=options['ploidy'], seed=options['seed'])
+        names = sample_names(options['samples'])
+        uri = self._prepare(workdir, options, sites, genotypes, names)
+
+        # imported late: the views module reads the tiledb config and pulls in tiledbvcf
+        from tilequery import views
+        request = RequestFactory().get('/')
+        request._messages = CookieStorage(request)
+
+        scenarios, skipped = [], []
+        total_rows = options['samples'] * options['variants']
+        for rows in _ints(options['rows']):
+            for n_samples in _ints(options['query_samples']):
+                if options['skip_tiledb']:
+                    break
+                base = f'rows={rows}/samples={n_samples}'
+                if n_samples > options['samples'] or rows > n_samples * options['variants']:
+                    skipped.append(dict(name=f'tiledb/{base}', reason='larger than the synthetic dataset'))
+                    continue
+                n_sites = max(1, math.ceil(rows / n_samples))
+                region = f'{sites.contig.iloc[0]}:{sites.pos.iloc[0]}-{sites.pos.iloc[n_sites - 1]}'
+                for flag_name in flag_sets:
+                    flags = FLAG_SETS[flag_name]
+                    def run(region=region, samples=names[:n_samples], flags=flags):
+                        df = views._query_tiledb(request, regions=[region], samples=samples, attrs=ATTRS, uri=uri, **flags)
+                        return df.shape[0], dict(truncated=bool(df.attrs.get('truncated', False)))
+                    scenarios.append(dict(self._time(f'tiledb/{base}/flags={flag_name}', run, options['repeat']),
+                                          kind='tiledb', rows_target=rows, samples=n_samples, flags=flag_name))
+
+            # the annotation step alone, on a frame shaped like a tiledb read
+            if rows > total_rows:
+                skipped.append(dict(name=f'annotate/rows={rows}', reason='larger than the synthetic dataset'))
+                continue
+            frame = synthetic_tiledb_frame(sites, genotypes, names, rows)
+            for flag_name in flag_sets:
+                flags = FLAG_SETS[flag_name]
+                if not (flags.get('clinvar_flag') or flags.get('genelist_flag')):
+                    continue
+                def run(flags=flags):
+                    df = views._append_tiledb_with_annotation(frame, flags=flags)
+                    return df.shape[0], {}
+                scenarios.append(dict(self._time(f'annotate/rows={rows}/flags={flag_name}', run, options['repeat']),
+                                      kind='annotate', rows_target=rows, flags=flag_name))
+
+        results = dict(created=datetime.datetime.now().isoformat(timespec='seconds'),
+                       environment=environment_info(),
+                       dataset={k: options[k] for k in ('samples', 'variants', 'ploidy', 'seed')},
+                       annotation_backend=getattr(settings, 'ANNOTATION_BACKEND', 'postgres'),
+                       annodb_engine=settings.DATABASES['annodb']['ENGINE'],
+                       repeat=options['repeat'],
+                       scenarios=scenarios,
+                       skipped=skipped)
+
+        text = json.dumps(results, indent=2, default=str)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text)
+            self.stderr.write(f'results written to {options["output"]}')
+        else:
+            self.stdout.write(text)
+
+        if options['compare']:
+            regressions = compare_results(load_results(options['compare']), results, options['threshold'])
+            for r in regressions:
+                self.stderr.write(self.style.WARNING(f'{r["name"]}: {r["baseline"]:.4f}s -> {r["current"]:.4f}s ({r["change"]:+.0%})'))
+            if not regressions:
+                self.stderr.write(self.style.SUCCESS(f'no scenario slower than +{options["threshold"]:.0%}'))
+            elif options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} scenario(s) regressed')
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from tilequery.utils.annotationstore import build_annotation_store
+
+
+class Command(BaseCommand):
+    help = ('Materializes the Snps, Clinvars and Genes tables of annodb into the local memory-mapped '
+            'annotation store used when settings.ANNOTATION_BACKEND = "local". Run it again after '
+            '`load_annotations`; workers switch to the new build within a minute.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--store-dir', default=str(getattr(settings, 'ANNOTATION_STORE_DIR')),
+                            help='defaults to settings.ANNOTATION_STORE_DIR')
+
+    def handle(self, *args, **options):
+        build_dir = build_annotation_store(options['store_dir'])
+        self.stdout.write(self.style.SUCCESS(f'annotation store built in {build_dir}'))
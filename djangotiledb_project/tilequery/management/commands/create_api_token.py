@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+import datetime
+
+from tilequery.models import ApiToken
+
+
+class Command(BaseCommand):
+    help = ('Issues a bearer token for the /api/v1/ endpoints (and /metrics, for staff users) and prints its key once. Revoke it from '
+            'the admin, or with --revoke <prefix>.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--name', default='', help='what the token is for, e.g. the pipeline using it')
+        parser.add_argument('--expires-days', type=int, default=None, help='never expires when omitted')
+        parser.add_argument('--revoke', metavar='PREFIX', help='revoke the user\'s tokens starting with PREFIX instead')
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(username=options['username'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'no user {options["username"]}')
+
+        if options['revoke']:
+            revoked = ApiToken.objects.filter(user=user, prefix__startswith=options['revoke'], revoked=False).update(revoked=True)
+            self.stdout.write(f'revoked {revoked} token(s)')
+            return
+
+        expires = None
+        if options['expires_days'] is not None:
+            expires = timezone.now() + datetime.timedelta(days=options['expires_days'])
+        token, key = ApiToken.issue(user, name=options['name'], expires=expires)
+        self.stdout.write(self.style.SUCCESS(f'token {token.prefix}… for {user}, expires {expires or "never"}'))
+        self.stdout.write(key)
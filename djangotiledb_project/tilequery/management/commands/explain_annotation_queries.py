@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models.functions import Upper
+
+from annoquery.models import Clinvars, Snps, Genes
+from tilequery.utils.annotationops import snp_lookup_queryset, clinvar_lookup_queryset, clinvar_profile_fields, CLINVAR_PROFILES
+
+
+class Command(BaseCommand):
+    help = ('Prints the postgres EXPLAIN plan of the annotation queries the query views run '
+            '(batched Snps/Clinvars variant_key lookups, rsID/gene symbol resolution) '
+            'and whether each one uses an index.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--analyze', action='store_true', help='EXPLAIN ANALYZE, i.e. actually run the queries')
+        parser.add_argument('--positions', type=int, default=1000, help='number of variant keys in the batched lookups')
+        parser.add_argument('--clinvar-profile', choices=list(CLINVAR_PROFILES), default='clinical', help='columns of the Clinvars lookup')
+
+    def _sample_keys(self, model, chromosome_field, n):
+        """Real (chromosome, [variant_key,...]) taken from the table so the planner sees realistic values."""
+        first = model.objects.order_by().values_list(chromosome_field, flat=True).first()
+        if first is None:
+            return None, []
+        keys = list(model.objects.filter(**{chromosome_field: first}, variant_key__isnull=False)
+                    .order_by().values_list('variant_key', flat=True)[:n])
+        return first, keys
+
+    def _report(self, title, qs, analyze):
+        self.stdout.write(self.style.MIGRATE_HEADING(title))
+        self.stdout.write(str(qs.query)[:300])
+        plan = qs.explain(analyze=analyze) if analyze else qs.explain()
+        self.stdout.write(plan)
+        uses_index = any(s in plan for s in ['Index Scan', 'Index Only Scan', 'Bitmap Index Scan', 'USING INDEX', 'USING COVERING INDEX'])
+        style = self.style.SUCCESS if uses_index else self.style.WARNING
+        self.stdout.write(style(f'uses index: {uses_index}') + '\n')
+
+    def handle(self, *args, **options):
+        db = Snps.objects.db
+        if connections[db].vendor != 'postgresql':
+            self.stderr.write(self.style.WARNING(f'{db} is {connections[db].vendor}; plans below are not the production ones.'))
+        analyze = options['analyze']
+        n = options['positions']
+        clinvar_fields = clinvar_profile_fields(options['clinvar_profile'])
+
+        chromosome, keys = self._sample_keys(Snps, 'chr', n)
+        if chromosome is not None:
+            self._report(f'Snps batched lookup ({len(keys)} variant keys)', snp_lookup_queryset(chromosome, keys), analyze)
+            rsids = list(Snps.objects.order_by().values_list('rsid', flat=True)[:n])
+            self._report(f'Snps rsID resolution ({len(rsids)} ids)', Snps.objects.filter(rsid__in=rsids).values_list('rsid', 'chr', 'start', 'stop'), analyze)
+        else:
+            self.stdout.write('Snps is empty, skipped.')
+
+        chromosome, keys = self._sample_keys(Clinvars, 'chromosome', n)
+        if chromosome is not None and str(chromosome).isdigit():
+            self._report(f'Clinvars batched lookup ({len(keys)} variant keys)', clinvar_lookup_queryset(chromosome, keys, clinvar_fields), analyze)
+        else:
+            self.stdout.write('Clinvars has no numeric chromosome rows, skipped.')
+
+        genes = list(Genes.objects.order_by().values_list('gene', flat=True)[:n])
+        if genes:
+            upper = [g.upper() for g in genes if g]
+            self._report(f'Genes symbol resolution ({len(upper)} symbols)', Genes.objects.annotate(gene_upper=Upper('gene')).filter(gene_upper__in=upper).values_list('chromosome', 'start', 'stop', 'gene_upper'), analyze)
+            self._report('Genes interval index load (full scan expected)', Genes.objects.values_list('chromosome', 'start', 'stop', 'gene'), analyze)
+        else:
+            self.stdout.write('Genes is empty, skipped.')
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from annoquery.models import Clinvars, Snps, Genes
+from tilequery.utils.loaderops import iter_clinvar_rows, iter_dbsnp_rows, iter_gene_rows, staged_reload
+
+SOURCES = {
+    'clinvar': (Clinvars, 'ClinVar variant_summary.txt(.gz)'),
+    'dbsnp': (Snps, 'dbSNP VCF(.gz), RefSeq accessions or chr-named contigs'),
+    'genes': (Genes, 'RefSeq GFF3(.gz)'),
+}
+
+
+class Command(BaseCommand):
+    help = ('Reloads one annotation table (clinvar, dbsnp or genes) from its source file. The file is '
+            'parsed and streamed into a staging table with COPY FROM STDIN, indexed, and swapped in '
+            'atomically, so queries keep using the old table until the new one is complete.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', choices=list(SOURCES))
+        parser.add_argument('path', help=', '.join(f'{k}: {v[1]}' for k, v in SOURCES.items()))
+        parser.add_argument('--assembly', default='GRCh38', help='clinvar only: assembly to keep')
+        parser.add_argument('--lock-timeout', default='30s', help='max wait for the table lock of the final swap')
+
+    def handle(self, *args, **options):
+        model, _ = SOURCES[options['source']]
+        connection = connections[model.objects.db]
+        if connection.vendor != 'postgresql':
+            raise CommandError(f'load_annotations needs postgres, but {connection.alias} is {connection.vendor}.')
+
+        path = options['path']
+        if options['source'] == 'clinvar':
+            rows = iter_clinvar_rows(path, assembly=options['assembly'])
+        elif options['source'] == 'dbsnp':
+            rows = iter_dbsnp_rows(path)
+        else:
+            rows = iter_gene_rows(path)
+
+        n = staged_reload(connection, model, rows, lock_timeout=options['lock_timeout'])
+        self.stdout.write(self.style.SUCCESS(f'{model._meta.db_table}: loaded {n} rows from {path}'))
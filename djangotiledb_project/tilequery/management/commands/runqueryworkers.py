@@ -0,0 +1,186 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+import multiprocessing
+import datetime
+import logging
+import socket
+import threading
+import time
+import re
+import os
+
+from tilequery.models import QueryJob
+from tilequery.utils.cohortops import expand_sample_tokens
+from tilequery.utils.instrumentation import RequestTrace
+
+logger = logging.getLogger('django')
+
+# worker names are <host>-<process number>-<pid>
+WORKER_NAME_PATTERN = re.compile(r'^(?P<host>.+)-\d+-(?P<pid>\d+)$')
+# a running job's heartbeat is bumped this often, from a thread of the worker running it
+HEARTBEAT_SECONDS = 30
+
+
+def _pid_alive(pid:int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def requeue_interrupted_jobs(heartbeat_timeout:datetime.timedelta) -> int:
+    """Moves running jobs whose worker is gone back to the queue: jobs whose heartbeat is older than
+    `heartbeat_timeout`, whichever host runs them, and jobs of a worker process of this host that no
+    longer exists. A live worker keeps its job's heartbeat fresh however long the job takes."""
+    host = socket.gethostname()
+    cutoff = timezone.now() - heartbeat_timeout
+    running = QueryJob.objects.filter(status=QueryJob.RUNNING)
+    # jobs claimed before the heartbeat column existed only have their start time
+    missed = (Q(heartbeat__lt=cutoff) |
+              Q(heartbeat__isnull=True) & (Q(started__isnull=True) | Q(started__lt=cutoff)))
+    orphaned = Q(pk__in=[])
+    for pk, worker in running.exclude(missed).values_list('pk', 'worker'):
+        m = WORKER_NAME_PATTERN.match(worker)
+        if m and m['host'] == host and not _pid_alive(int(m['pid'])):
+            orphaned |= Q(pk=pk, worker=worker)
+    return running.filter(missed | orphaned).update(status=QueryJob.QUEUED, worker='')
+
+
+def claim_next_job(worker:str):
+    """Atomically moves the oldest queued job to running. The conditional update makes the
+    claim safe when several worker processes poll the same table."""
+    while True:
+        with transaction.atomic():
+            job = QueryJob.objects.filter(status=QueryJob.QUEUED).order_by('created').first()
+            if job is None:
+                return None
+            claimed = (QueryJob.objects
+                       .filter(pk=job.pk, status=QueryJob.QUEUED)
+                       .update(status=QueryJob.RUNNING, worker=worker, started=timezone.now(), heartbeat=timezone.now()))
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def _beat(job:QueryJob, stop:threading.Event):
+    try:
+        while not stop.wait(HEARTBEAT_SECONDS):
+            QueryJob.objects.filter(pk=job.pk, worker=job.worker).update(heartbeat=timezone.now())
+    finally:
+        # this thread's own connection
+        connections.close_all()
+
+
+def run_job(job:QueryJob):
+    # imported here so that the worker parent process does not open the tiledb dataset before forking
+    from tilequery import views
+    from tilequery.utils.arrowops import iter_export_bytes
+
+    p = job.params
+    # cohorts are resolved when the job runs, jobs store the `cohort:<name>` tokens
+    samples, _, unresolved_cohorts = expand_sample_tokens(p['samples'], job.user)
+    if unresolved_cohorts:
+        raise ValueError(f'<run_job> unknown or empty cohort(s): {",".join(unresolved_cohorts)}')
+    stream = views._stream_query_tiledb(regions=p['regions'], samples=samples, attrs=p['attrs'],
+                                        clinvar_flag=p.get('clinvar_flag', False),
+                                        hidenonvariants_flag=p.get('hidenonvariants_flag', False),
+                                        genelist_flag=p.get('genelist_flag', False),
+                                        )
+
+    def frames():
+        for df in stream:
+            QueryJob.objects.filter(pk=job.pk, worker=job.worker).update(rows_read=stream.rows_read, rows_kept=stream.rows_kept)
+            yield views.dataframe_common_final_reformat(df)
+
+    os.makedirs(views.JOB_RESULTS_DIR, exist_ok=True)
+    result_path = os.path.join(views.JOB_RESULTS_DIR, f'{job.pk}.parquet')
+    tmp_path = result_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter_export_bytes(frames(), 'parquet'):
+            f.write(chunk)
+    os.replace(tmp_path, result_path)
+
+    # a job requeued from under this worker (missed heartbeats) belongs to whoever claimed it next
+    QueryJob.objects.filter(pk=job.pk, worker=job.worker).update(status=QueryJob.DONE, result_path=result_path,
+                                              rows_read=stream.rows_read, rows_kept=stream.rows_kept,
+                                              finished=timezone.now())
+
+
+def worker_loop(worker:str, poll_seconds:float, heartbeat_timeout:datetime.timedelta, once:bool=False):
+    # the pid tells a later pool on this host whether the jobs claimed here are still running
+    worker = f'{worker}-{os.getpid()}'
+    logger.info(f'runqueryworkers: {worker} started')
+    next_requeue = 0.0
+    while True:
+        job = claim_next_job(worker)
+        if job is None:
+            if once:
+                return
+            # idle workers pick up the jobs of workers that died on any host
+            if time.monotonic() >= next_requeue:
+                requeued = requeue_interrupted_jobs(heartbeat_timeout)
+                if requeued:
+                    logger.info(f'runqueryworkers: {worker} requeued {requeued} interrupted job(s)')
+                next_requeue = time.monotonic() + heartbeat_timeout.total_seconds()
+            time.sleep(poll_seconds)
+            continue
+
+        logger.info(f'runqueryworkers: {worker} running job {job.pk}')
+        trace = RequestTrace('job')
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_beat, args=(job, stop), daemon=True)
+        heartbeat.start()
+        try:
+            with trace.activate():
+                run_job(job)
+            trace.finish(job=str(job.pk), status='done')
+        except Exception as e:
+            logger.exception(f'runqueryworkers: job {job.pk} failed')
+            trace.finish(job=str(job.pk), status='failed')
+            QueryJob.objects.filter(pk=job.pk, worker=job.worker).update(status=QueryJob.FAILED, message=str(e), finished=timezone.now())
+        finally:
+            stop.set()
+            heartbeat.join()
+
+
+class Command(BaseCommand):
+    help = 'Runs a local pool of worker processes executing queued background queries (QueryJob).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help='number of worker processes')
+        parser.add_argument('--poll', type=float, default=2.0, help='seconds between polls of an idle worker')
+        parser.add_argument('--once', action='store_true', help='drain the queue and exit instead of polling forever')
+        parser.add_argument('--heartbeat-timeout', type=float, default=4 * HEARTBEAT_SECONDS,
+                            help='seconds without a heartbeat after which a running job is requeued, whichever host runs it')
+
+    def handle(self, *args, **options):
+        # jobs left running by a previous, killed worker pool would never finish otherwise
+        heartbeat_timeout = datetime.timedelta(seconds=options['heartbeat_timeout'])
+        requeued = requeue_interrupted_jobs(heartbeat_timeout)
+        if requeued:
+            self.stdout.write(f'requeued {requeued} interrupted job(s)')
+
+        # forked children must not share the parent's database connections
+        connections.close_all()
+        host = socket.gethostname()
+        procs = []
+        for i in range(options['processes']):
+            proc = multiprocessing.Process(target=worker_loop,
+                                           args=(f'{host}-{i}', options['poll'], heartbeat_timeout, options['once']),
+                                           daemon=True)
+            proc.start()
+            procs.append(proc)
+
+        self.stdout.write(f'started {len(procs)} query worker(s)')
+        try:
+            for proc in procs:
+                proc.join()
+        except KeyboardInterrupt:
+            for proc in procs:
+                proc.terminate()
@@ -0,0 +1,42 @@
+# Generated by Django 4.1.3 on 2026-10-18 01:36
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tilequery', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Cohort',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('shared', models.BooleanField(default=False)),
+                ('description', models.CharField(blank=True, max_length=255)),
+                ('samples_blob', models.BinaryField()),
+                ('sample_count', models.PositiveIntegerField(default=0)),
+                ('digest', models.CharField(max_length=40)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cohorts', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='cohort',
+            index=models.Index(fields=['name', 'shared'], name='tilequery_c_name_087d47_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='cohort',
+            constraint=models.UniqueConstraint(fields=('owner', 'name'), name='tilequery_cohort_owner_name_uniq'),
+        ),
+    ]
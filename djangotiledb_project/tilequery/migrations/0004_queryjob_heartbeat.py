@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tilequery', '0003_apitoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryjob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
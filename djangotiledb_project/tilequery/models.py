@@ -1,3 +1,120 @@
 from django.db import models
+from django.conf import settings
+
+from typing import List, Tuple
+import hashlib
+import secrets
+import uuid
+import zlib
 
 # Create your models here.
+
+class QueryJob(models.Model):
+    """A query submitted from `index` to run in the background. Claimed and executed by the
+    `runqueryworkers` management command; the result table is written to `result_path` as Parquet."""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='query_jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    params = models.JSONField() # regions, samples, attrs and flags as posted to `index`
+    rows_read = models.BigIntegerField(default=0)
+    rows_kept = models.BigIntegerField(default=0)
+    message = models.TextField(blank=True)
+    result_path = models.CharField(max_length=512, blank=True)
+    worker = models.CharField(max_length=64, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(null=True, blank=True) # bumped by the worker while the job runs
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __repr__(self) -> str:
+        return super().__repr__() + f'//{self.status}//{self.user_id}'
+
+    class Meta:
+        ordering = ['-created']
+        indexes = [
+            models.Index(fields=['status','created']),
+        ]
+
+
+class Cohort(models.Model):
+    """A named sample list, referenced in the samples field of a query as `cohort:<name>`.
+
+    The names are stored sorted, de-duplicated and zlib-compressed (see `set_samples`); `digest`
+    is the sha1 of that sorted list and stands in for the samples in result cache keys."""
+
+    name = models.CharField(max_length=64)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='cohorts')
+    shared = models.BooleanField(default=False) # other users may reference it by name too
+    description = models.CharField(max_length=255, blank=True)
+    samples_blob = models.BinaryField()
+    sample_count = models.PositiveIntegerField(default=0)
+    digest = models.CharField(max_length=40)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def set_samples(self, samples:List[str]):
+        names = sorted(set(s.strip() for s in samples if s and s.strip()))
+        text = '\n'.join(names).encode()
+        self.samples_blob = zlib.compress(text, 9)
+        self.sample_count = len(names)
+        self.digest = hashlib.sha1(text).hexdigest()
+
+    @property
+    def samples(self) -> List[str]:
+        text = zlib.decompress(bytes(self.samples_blob)).decode()
+        return text.split('\n') if text else []
+
+    def __str__(self) -> str:
+        return f'{self.name} ({self.sample_count} samples)'
+
+    class Meta:
+        ordering = ['name']
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'name'], name='tilequery_cohort_owner_name_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['name', 'shared']),
+        ]
+
+
+class ApiToken(models.Model):
+    """Bearer token for the `/api/v1/` endpoints. Only the sha256 of the key is stored; the key
+    itself is shown once, by `manage.py create_api_token`."""
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='api_tokens')
+    name = models.CharField(max_length=64, blank=True)
+    prefix = models.CharField(max_length=8) # first characters of the key, to tell tokens apart
+    key_hash = models.CharField(max_length=64, unique=True)
+    revoked = models.BooleanField(default=False)
+    expires = models.DateTimeField(null=True, blank=True)
+    last_used = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def hash_key(key:str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    @classmethod
+    def issue(cls, user, name:str='', expires=None) -> Tuple['ApiToken', str]:
+        """Creates a token for `user`. Returns (token, key); the key cannot be recovered later."""
+        key = secrets.token_urlsafe(32)
+        token = cls.objects.create(user=user, name=name, prefix=key[:8], key_hash=cls.hash_key(key), expires=expires)
+        return token, key
+
+    def __str__(self) -> str:
+        return f'{self.prefix}… ({self.user})'
+
+    class Meta:
+        ordering = ['-created']
@@ -1,3 +1,754 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+from django.contrib.auth.models import User
+from django.test import RequestFactory
+from django.utils import timezone
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import concurrent.futures
+import datetime
+import tempfile
+import json
+import gzip
+import io
+import os
+
+from annoquery.models import Clinvars, Genes, Snps, variant_key
+from .utils import identifierops
+from .utils.annotationcache import CachedAnnotationBackend, VersionedLRUCache
+from .utils.arrowops import arrow_to_dataframe, dataframe_to_arrow, iter_export_bytes
+from . import api, views
+from .auth import authenticate_api_token
+from .models import ApiToken, Cohort
+from .utils.carrierops import CarrierScan
+from .utils.cohortops import expand_sample_tokens, parse_sample_list, visible_cohorts
+from .utils.datasetmeta import DatasetMetadata
+from .utils.frequencyops import AlleleFrequencyAggregator
+from .utils.geneindex import GeneIntervalIndex
+from .utils.loaderops import (CLINVAR_COLUMNS, CopyStream, iter_clinvar_rows, iter_dbsnp_rows, iter_gene_rows,
+                              model_row_converter, refseq_to_chr)
+from .utils.genotypeops import explode_alt_alleles, filter_genotype_to_variants_only_output_mask, ragged_to_flat
+from .utils.regionops import Region, assign_rows_to_regions, normalize_regions, parse_regions
+from .utils.streamops import TileDBQueryStream
+from .utils.samplecatalog import SampleCatalog, SampleCatalogService
+from .utils.resultcache import ResultCache, canonical_query, query_cache_key
+
+
+def genotype_batch(records:list) -> pa.Table:
+    """A tiledbvcf Arrow batch from (sample_name, contig, pos_start, alleles, fmt_GT) records."""
+    return pa.table(dict(
+        sample_name=[r[0] for r in records],
+        id=['.'] * len(records),
+        contig=[r[1] for r in records],
+        pos_start=pa.array([r[2] for r in records], pa.int32()),
+        pos_end=pa.array([r[2] + len(r[3][0]) - 1 for r in records], pa.int32()),
+        alleles=pa.array([r[3] for r in records], pa.list_(pa.string())),
+        fmt_GT=pa.array([r[4] for r in records], pa.list_(pa.int32())),
+    ))
+
+
+MULTIALLELIC = ['A', 'G', 'T']
+MULTIALLELIC_RECORDS = [
+    ('S1', 'chr1', 100, MULTIALLELIC, [0, 0]),
+    ('S2', 'chr1', 100, MULTIALLELIC, [0, 1]),
+    ('S3', 'chr1', 100, MULTIALLELIC, [1, 1]),
+    ('S4', 'chr1', 100, MULTIALLELIC, [1, 2]),
+    ('S5', 'chr1', 100, MULTIALLELIC, [2, 2]),
+    ('S6', 'chr1', 100, MULTIALLELIC, [0, -1]),
+    ('S7', 'chr1', 100, MULTIALLELIC, [1, -1]),
+    ('S8', 'chr1', 100, MULTIALLELIC, [-1, -1]),
+]
+
+
+class AlleleFrequencyAggregatorTests(SimpleTestCase):
+
+    def aggregate(self, batches, samples_scanned=None, regions=None):
+        aggregator = AlleleFrequencyAggregator(samples_scanned=samples_scanned)
+        for records in batches:
+            aggregator.add(genotype_batch(records))
+        return aggregator.table(regions=parse_regions(regions) if regions else None)
+
+    def test_genotype_classes_are_per_variant(self):
+        df = self.aggregate([MULTIALLELIC_RECORDS[:3], MULTIALLELIC_RECORDS[3:]]).set_index('alt_allele')
+        self.assertEqual(df.loc['G', ['ac', 'an', 'hom_ref', 'het', 'hom_alt', 'other_alt', 'partial', 'missing']].tolist(),
+                         [5, 12, 1, 2, 1, 1, 2, 1])
+        self.assertEqual(df.loc['T', ['ac', 'an', 'hom_ref', 'het', 'hom_alt', 'other_alt', 'partial', 'missing']].tolist(),
+                         [3, 12, 1, 1, 1, 2, 2, 1])
+        self.assertAlmostEqual(df.loc['G', 'af'], round(5 / 12, 6))
+
+    def test_classes_add_up_to_records(self):
+        df = self.aggregate([MULTIALLELIC_RECORDS])
+        classes = df[['hom_ref', 'het', 'hom_alt', 'other_alt', 'partial', 'missing']].sum(axis=1)
+        self.assertEqual(classes.tolist(), df['records'].tolist())
+        self.assertEqual(df['records'].tolist(), [8, 8])
+
+    def test_partial_calls_are_not_het(self):
+        df = self.aggregate([[('S1', 'chr1', 100, ['A', 'G'], [0, -1]),
+                              ('S2', 'chr1', 100, ['A', 'G'], [1, -1]),
+                              ('S3', 'chr1', 100, ['A', 'G'], [-1, 1])]])
+        self.assertEqual(df.loc[0, ['ac', 'an', 'het', 'hom_alt', 'partial']].tolist(), [2, 3, 0, 0, 3])
+
+    def test_haploid_calls(self):
+        df = self.aggregate([[('S1', 'chrX', 100, ['A', 'G'], [1]),
+                              ('S2', 'chrX', 100, ['A', 'G'], [0])]])
+        self.assertEqual(df.loc[0, ['ac', 'an', 'hom_ref', 'het', 'hom_alt']].tolist(), [1, 2, 1, 0, 1])
+
+    def test_site_without_alt_calls(self):
+        df = self.aggregate([[('S1', 'chr1', 100, ['A', 'G'], [0, 0]),
+                              ('S2', 'chr1', 100, ['A', 'G'], [-1, -1])]], samples_scanned=3)
+        self.assertEqual(df.shape[0], 1)
+        self.assertIsNone(df.loc[0, 'alt_allele'])
+        self.assertEqual(df.loc[0, ['ac', 'an', 'af', 'hom_ref', 'missing', 'no_record']].tolist(), [0, 2, 0.0, 1, 1, 1])
+
+    def test_regions_drop_the_merge_gap(self):
+        records = [('S1', 'chr1', 100, ['A', 'G'], [0, 1]),
+                   ('S1', 'chr1', 500, ['C', 'T'], [0, 1])]
+        df = self.aggregate([records], regions=['chr1:50-150'])
+        self.assertEqual(df['pos_start'].tolist(), [100])
+
+    def test_empty(self):
+        df = self.aggregate([], samples_scanned=2)
+        self.assertEqual(df.shape[0], 0)
+        self.assertIn('other_alt', df.columns)
+
+
+class CarrierScanTests(SimpleTestCase):
+
+    def scan(self, batches, samples_scanned, regions=None):
+        scan = CarrierScan(samples_scanned, parse_regions(regions) if regions else None)
+        for records in batches:
+            scan.add(genotype_batch(records))
+        return scan.tables()
+
+    def test_variant_and_sample_tables(self):
+        variants, samples = self.scan([MULTIALLELIC_RECORDS[:4], MULTIALLELIC_RECORDS[4:]], samples_scanned=10)
+        variants = variants.set_index('alt_allele')
+        # G: S2 0/1, S3 1/1, S4 1/2, S7 1/. ; T: S4 1/2, S5 2/2
+        self.assertEqual(variants.loc['G', ['carriers', 'homozygous', 'heterozygous']].tolist(), [4, 1, 3])
+        self.assertEqual(variants.loc['T', ['carriers', 'homozygous', 'heterozygous']].tolist(), [2, 1, 1])
+        self.assertEqual(variants.loc['G', 'samples'], 'S2,S3,S4,S7')
+        self.assertAlmostEqual(variants.loc['T', 'carrier_frequency'], 0.2)
+        samples = samples.set_index('sample_name')
+        self.assertEqual(samples.index.tolist(), ['S2', 'S3', 'S4', 'S5', 'S7'])
+        self.assertEqual(samples.loc['S4', ['variants', 'homozygous', 'heterozygous', 'carried']].tolist(),
+                         [2, 0, 2, 'chr1:100:A>G,chr1:100:A>T'])
+
+    def test_reference_and_missing_records_are_not_carriers(self):
+        variants, samples = self.scan([[('S1', 'chr1', 100, ['A', 'G'], [0, 0]),
+                                        ('S2', 'chr1', 100, ['A', 'G'], [-1, -1])]], samples_scanned=2)
+        self.assertEqual(variants.shape[0], 0)
+        self.assertEqual(samples.shape[0], 0)
+
+    def test_regions_drop_the_merge_gap(self):
+        records = [('S1', 'chr1', 100, ['A', 'G'], [0, 1]),
+                   ('S1', 'chr1', 500, ['C', 'T'], [1, 1])]
+        variants, samples = self.scan([records], samples_scanned=1, regions=['chr1:50-150'])
+        self.assertEqual(variants['pos_start'].tolist(), [100])
+        self.assertEqual(samples.loc[0, 'variants'], 1)
+
+
+class GeneIntervalIndexTests(SimpleTestCase):
+
+    genes = pd.DataFrame(dict(chromosome=[1, 1, 1, 2, 1],
+                              start=[100, 150, 1000, 100, 100],
+                              stop=[5000, 200, 1100, 200, 5000],
+                              gene=['LONG', 'SHORT', 'LATE', 'OTHER', 'LONG']))
+
+    def brute_force(self, chromosome, start, stop):
+        g = self.genes
+        names = g.loc[(g.chromosome == chromosome) & (g.start <= start) & (g.stop >= stop), 'gene']
+        return ';'.join(sorted(set(names))) if len(names) else np.nan
+
+    def test_matches_the_containment_filter(self):
+        index = GeneIntervalIndex(self.genes)
+        queries = [(1, 160, 170), (1, 100, 5000), (1, 99, 120), (1, 1050, 1050), (1, 4000, 6000),
+                   (2, 150, 150), (3, 150, 150), (1, 150, 200)]
+        chromosomes, starts, stops = zip(*queries)
+        result = index.lookup(chromosomes, starts, stops)
+        for q, r in zip(queries, result):
+            expected = self.brute_force(*q)
+            if pd.isna(expected):
+                self.assertTrue(pd.isna(r), q)
+            else:
+                self.assertEqual(r, expected, q)
+
+    def test_missing_chromosomes(self):
+        result = GeneIntervalIndex(self.genes).lookup([np.nan, 1], [150, 150], [150, 150])
+        self.assertTrue(pd.isna(result[0]))
+        self.assertEqual(result[1], 'LONG;SHORT')
+
+    def test_from_backend_strips_the_gene_prefix(self):
+        class Backend:
+            name = 'test'
+            def load_genes(self):
+                return pd.DataFrame(dict(chromosome=[1], start=[1], stop=[10], gene=['gene=BRCA1']))
+        index = GeneIntervalIndex.from_backend(Backend(), version=(1,))
+        self.assertEqual(index.lookup([1], [5], [5]).tolist(), ['BRCA1'])
+        self.assertEqual(index.version, (1,))
+
+
+def baseline_variants_only_mask(s:pd.Series) -> np.ndarray:
+    """The padded-matrix mask the views used before genotypeops, diploid calls only."""
+    gts = pd.DataFrame(s.tolist()).fillna(0).to_numpy()
+    return ~(((gts[:, 0] == 0) & (gts[:, 1] == 0)) | ((gts[:, 0] == -1) & (gts[:, 1] == -1)))
+
+
+class GenotypeOpsTests(SimpleTestCase):
+
+    def test_ragged_to_flat(self):
+        values, offsets = ragged_to_flat(pd.Series([np.array([0, 1]), None, np.nan, [2], []], dtype=object), dtype=np.int64)
+        self.assertEqual(values.tolist(), [0, 1, 2])
+        self.assertEqual(offsets.tolist(), [0, 2, 2, 2, 3, 3])
+
+    def test_variants_only_mask_matches_baseline(self):
+        calls = [[0, 0], [0, 1], [1, 1], [1, 2], [-1, -1], [0, -1], [-1, 1], [2, 0]]
+        s = pd.Series([np.array(c) for c in calls])
+        self.assertEqual(filter_genotype_to_variants_only_output_mask(s).tolist(),
+                         baseline_variants_only_mask(s).tolist())
+
+    def test_variants_only_mask_any_ploidy(self):
+        s = pd.Series([np.array([0]), np.array([1]), np.array([-1]), np.array([0, 0, 1]), np.array([0, 0, 0])])
+        self.assertEqual(filter_genotype_to_variants_only_output_mask(s).tolist(), [False, True, False, True, False])
+
+    def test_explode_alt_alleles(self):
+        df = pd.DataFrame(dict(sample_name=['S1', 'S2', 'S3'],
+                               alleles=[np.array(['A', 'G', 'T'])] * 3,
+                               info_AF=[np.array([0.1, 0.2])] * 3,
+                               fmt_GT=[np.array([1, 2]), np.array([0, 0]), np.array([2, 2])]))
+        out = explode_alt_alleles(df)
+        self.assertEqual(out['sample_name'].tolist(), ['S1', 'S1', 'S3'])
+        self.assertEqual(out['alt_allele'].tolist(), ['G', 'T', 'T'])
+        self.assertEqual(out['alt_af'].tolist(), [0.1, 0.2, 0.2])
+
+    def test_explode_keeps_rows_without_alt_calls(self):
+        df = pd.DataFrame(dict(alleles=[np.array(['A', 'G'])] * 2,
+                               fmt_GT=[np.array([0, 0]), np.array([0, 1])]))
+        out = explode_alt_alleles(df, show_only_alt=False)
+        self.assertTrue(pd.isna(out.loc[0, 'alt_allele']))
+        self.assertEqual(out.loc[1, 'alt_allele'], 'G')
+        self.assertEqual(out.shape[0], 2)
+
+
+def annotated_batch(rows:list, columns:list) -> pd.DataFrame:
+    """An annotated result batch: object columns, as batch_search_for_snp_and_clinvar returns them."""
+    df = pd.DataFrame(rows, columns=columns, dtype=object)
+    df['pos_start'] = df['pos_start'].astype(np.int64)
+    return df
+
+
+class ArrowOpsTests(SimpleTestCase):
+
+    # the first batch hits ClinVar, the second only has '-' misses and a column the first lacks
+    batches = [annotated_batch([['chr1', 100, '.', 5, 'Benign']], ['contig', 'pos_start', 'id', 'id', 'clinvar_sig']),
+               annotated_batch([['chr1', 200, '.', '-', '-', 'x']], ['contig', 'pos_start', 'id', 'id', 'clinvar_sig', 'extra'])]
+
+    def test_duplicate_columns_round_trip(self):
+        df = self.batches[0]
+        self.assertEqual(list(arrow_to_dataframe(dataframe_to_arrow(df)).columns), list(df.columns))
+
+    def test_parquet_schema_is_stable_across_batches(self):
+        table = pq.read_table(io.BytesIO(b''.join(iter_export_bytes(iter(self.batches), 'parquet'))))
+        self.assertEqual(table.num_rows, 2)
+        self.assertEqual(table.column('id.1').to_pylist(), ['5', '-'])
+        df = arrow_to_dataframe(table)
+        self.assertEqual(list(df.columns), list(self.batches[0].columns))
+
+    def test_arrow_stream(self):
+        table = pa.ipc.open_stream(b''.join(iter_export_bytes(iter(self.batches), 'arrow'))).read_all()
+        self.assertEqual(table.column('pos_start').to_pylist(), [100, 200])
+
+    def test_csv_keeps_the_first_header(self):
+        text = b''.join(iter_export_bytes(iter(self.batches), 'csv')).decode()
+        self.assertEqual(text.splitlines(), ['contig,pos_start,id,id,clinvar_sig', 'chr1,100,.,5,Benign', 'chr1,200,.,-,-'])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            list(iter_export_bytes(iter(self.batches), 'xlsx'))
+
+
+class ResultCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def cache(self, max_bytes=10 ** 9):
+        return ResultCache(self.tmp.name, max_bytes=max_bytes)
+
+    def age(self, cache, key, seconds):
+        # the LRU clock is the file mtime; set it instead of sleeping past the filesystem resolution
+        os.utime(cache._path(key), (seconds, seconds))
+
+    def test_round_trip(self):
+        cache = self.cache()
+        df = pd.DataFrame(dict(contig=['chr1', 'chr2'], pos_start=[1, 2]))
+        cache.put('a', df, truncated=True)
+        cached, truncated = cache.get('a')
+        pd.testing.assert_frame_equal(cached, df)
+        self.assertTrue(truncated)
+        self.assertEqual(cache.get('b'), (None, False))
+        self.assertEqual(cache.stats(), dict(hits=1, misses=1))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = self.cache()
+        df = pd.DataFrame(dict(x=range(1000)))
+        for key in 'abc':
+            cache.put(key, df)
+        self.age(cache, 'a', 100)
+        self.age(cache, 'b', 200)
+        self.age(cache, 'c', 300)
+        cache.get('a')
+        cache.max_bytes = os.path.getsize(cache._path('a')) * 2
+        cache.evict()
+        self.assertEqual(sorted(n for n in os.listdir(self.tmp.name) if n.endswith('.parquet')), ['a.parquet', 'c.parquet'])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_slice_reads_across_row_groups(self):
+        cache = self.cache()
+        cache.put('a', pd.DataFrame(dict(x=range(25))), row_group_size=10)
+        table, total, truncated = cache.get_slice('a', offset=8, limit=5)
+        self.assertEqual(table.column('x').to_pylist(), [8, 9, 10, 11, 12])
+        self.assertEqual((total, truncated), (25, False))
+        table, total, _ = cache.get_slice('a', offset=30, limit=5)
+        self.assertEqual((table.num_rows, total), (0, 25))
+
+    def test_counters_are_serialized(self):
+        cache = self.cache()
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            list(pool.map(lambda _: cache._count('hits'), range(200)))
+        self.assertEqual(cache.stats(), dict(hits=200))
+
+    def test_canonical_query_is_order_insensitive(self):
+        a = canonical_query(['chr2:10-20', 'chr1:1,000-2,000'], ['S2', 'S1', 'S1'], ['contig'], dict(clinvar_flag='on'), dataset=1)
+        b = canonical_query(['chr1:1000-2000', 'chr2:10-20'], ['S1', 'S2'], ['contig'], dict(clinvar_flag=True), dataset=1)
+        self.assertEqual(query_cache_key(a), query_cache_key(b))
+        self.assertNotEqual(query_cache_key(a), query_cache_key({**b, 'versions': {'dataset': '2'}}))
+
+
+class RegionOpsTests(SimpleTestCase):
+
+    def test_normalize_regions(self):
+        originals, merged = normalize_regions(['chr2:500-600', 'chr1:1,000-2,000', 'chr1:2500', ' ', 'chr1:100-200'], gap=500)
+        self.assertEqual(originals, [Region('chr2', 500, 600), Region('chr1', 1000, 2000),
+                                     Region('chr1', 2500, 2500), Region('chr1', 100, 200)])
+        self.assertEqual(merged, ['chr1:100-200', 'chr1:1000-2500', 'chr2:500-600'])
+        self.assertEqual(normalize_regions(['chr1:1000-2000', 'chr1:2001-2100'])[1], ['chr1:1000-2100'])
+
+    def test_invalid_regions(self):
+        for text in ['chr1', 'chr1:200-100', 'chrM:1-10', 'chr1:0-10']:
+            with self.assertRaises(ValueError, msg=text):
+                parse_regions([text])
+
+    def test_assign_rows_to_regions(self):
+        regions = parse_regions(['chr1:100-200', 'chr1:150-300', 'chr1:1000-1100', 'chr2:100-200'])
+        df = pd.DataFrame(dict(contig=['chr1', 'chr1', 'chr1', 'chr1', 'chr2', 'chrX'],
+                               pos_start=[90, 160, 500, 1100, 100, 150],
+                               pos_end=[100, 160, 500, 1105, 100, 150]))
+        result = assign_rows_to_regions(df, regions)
+        self.assertEqual(result[:2].tolist(), ['chr1:100-200', 'chr1:100-200,chr1:150-300'])
+        self.assertTrue(pd.isna(result[2]))
+        self.assertEqual(result[3:5].tolist(), ['chr1:1000-1100', 'chr2:100-200'])
+        self.assertTrue(pd.isna(result[5]))
+
+
+class IdentifierOpsTests(TestCase):
+
+    databases = {'default', 'annodb'}
+
+    @classmethod
+    def setUpTestData(cls):
+        Genes.objects.create(chromosome=17, start=43044295, stop=43125364, gene='gene=BRCA1')
+        Genes.objects.create(chromosome=9, start=27546545, stop=27573866, gene='C9orf72')
+        Snps.objects.create(rsid='rs80357906', chr='chr17', start=43057062, stop=43057062)
+
+    def setUp(self):
+        # a fresh version per test, so the per-worker cache starts empty
+        patcher = mock.patch.object(identifierops, 'annotation_data_version', return_value=(self.id(),))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_expand_query_tokens(self):
+        regions, unresolved = identifierops.expand_query_tokens(['chr1:100-200', ' brca1', 'RS80357906', 'NOPE', ''])
+        self.assertEqual(regions, ['chr1:100-200', 'chr17:43044295-43125364', 'chr17:43057062-43057062', ''])
+        self.assertEqual(unresolved, ['NOPE'])
+
+    def test_gene_symbols_match_any_case(self):
+        resolved = identifierops.resolve_identifiers(['c9orf72', 'C9ORF72'])
+        self.assertEqual(resolved['c9orf72'], ['chr9:27546545-27573866'])
+        self.assertEqual(resolved['C9ORF72'], ['chr9:27546545-27573866'])
+
+    def test_lookups_are_cached(self):
+        identifierops.resolve_identifiers(['BRCA1', 'NOPE'])
+        with self.assertNumQueries(0, using='annodb'):
+            resolved = identifierops.resolve_identifiers(['BRCA1', 'NOPE'])
+        self.assertEqual(resolved, {'BRCA1': ['chr17:43044295-43125364'], 'NOPE': []})
+
+    def test_regions_only_need_no_lookup(self):
+        with self.assertNumQueries(0, using='annodb'):
+            self.assertEqual(identifierops.expand_query_tokens(['chr1:1-10']), (['chr1:1-10'], []))
+
+
+class LoaderOpsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, name, lines):
+        path = os.path.join(self.tmp.name, name)
+        with (gzip.open(path, 'wt') if name.endswith('.gz') else open(path, 'w')) as f:
+            f.write(''.join(line + '\n' for line in lines))
+        return path
+
+    def test_refseq_to_chr(self):
+        self.assertEqual([refseq_to_chr(s) for s in ['NC_000017.11', 'NC_000023.11', 'chr2', '5', 'NT_187361.1', 'chrM']],
+                         ['chr17', 'chrX', 'chr2', 'chr5', None, None])
+
+    def test_clinvar_rows(self):
+        def line(**values):
+            return '\t'.join(values.get(name, '-') for name in CLINVAR_COLUMNS.values())
+        path = self.write('variant_summary.txt.gz', [
+            '\t'.join(CLINVAR_COLUMNS),
+            line(assembly='GRCh37', chromosome='17', positionvcf='1', referenceallelevcf='A', alternateallelevcf='G'),
+            line(assembly='GRCh38', chromosome='X', positionvcf='100', referenceallelevcf='A', alternateallelevcf='G'),
+            line(assembly='GRCh38', chromosome='MT', positionvcf='5', referenceallelevcf='A', alternateallelevcf='G'),
+        ])
+        rows = list(iter_clinvar_rows(path))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]['chromosome'], rows[0]['order']), ('23', 2.0))
+        # the key is on the contig name, same as the lookups and the 0011 migration
+        self.assertEqual(rows[0]['variant_key'], variant_key('chrX', 100, 'A', 'G'))
+
+    def test_clinvar_header_is_checked(self):
+        with self.assertRaises(ValueError):
+            list(iter_clinvar_rows(self.write('other.txt', ['#AlleleID\tType'])))
+
+    def test_dbsnp_rows(self):
+        path = self.write('dbsnp.vcf', [
+            '##fileformat=VCFv4.2',
+            'NC_000001.11\t100\trs1\tAC\tA,ACC\t.\t.\t.',
+            'NC_000001.11\t200\t.\tA\tG\t.\t.\t.',
+            'NW_021160000.1\t5\trs2\tA\tG\t.\t.\t.',
+        ])
+        rows = list(iter_dbsnp_rows(path))
+        self.assertEqual([(r['rsid'], r['chr'], r['start'], r['stop'], r['alt']) for r in rows],
+                         [('rs1', 'chr1', 100, 101, 'A'), ('rs1', 'chr1', 100, 101, 'ACC')])
+        self.assertEqual(rows[1]['variant_key'], variant_key('chr1', 100, 'AC', 'ACC'))
+
+    def test_gene_rows(self):
+        path = self.write('genes.gff', [
+            '##gff-version 3',
+            'NC_000017.11\tBestRefSeq\tgene\t43044295\t43125364\t.\t-\t.\tID=gene-BRCA1;Name=BRCA1;description=BRCA1%2C DNA repair;gene=BRCA1;gene_biotype=protein_coding',
+            'NC_000017.11\tBestRefSeq\tmRNA\t43044295\t43125364\t.\t-\t.\tID=rna-1;gene=BRCA1',
+        ])
+        self.assertEqual(list(iter_gene_rows(path)), [dict(chromosome=17, source='BestRefSeq', gene_type='protein_coding',
+                                                           start=43044295, stop=43125364, gene='BRCA1',
+                                                           product='BRCA1, DNA repair')])
+
+    def test_model_row_converter(self):
+        convert = model_row_converter(Clinvars, ['alleleid', 'hgnc_id', 'numbersubmitters'])
+        self.assertEqual(convert(dict(alleleid='x', hgnc_id='HGNC:123456789', numbersubmitters='3')), (-1, 'HGNC:12345', 3))
+        self.assertEqual(model_row_converter(Snps, ['ref'])(dict(ref='')), (None,))
+
+    def test_copy_stream_encoding(self):
+        stream = CopyStream([(1, None, 'a\tb'), (2, 'c\\d', 'e\nf')])
+        self.assertEqual(stream.read(), '1\t\\N\ta\\tb\n2\tc\\\\d\te\\nf\n')
+        self.assertEqual(stream.count, 2)
+
+
+class SampleCatalogTests(SimpleTestCase):
+
+    catalog = SampleCatalog(['HG002', 'hg001', 'NA12878', 'HG003', 'hg001', 'XHG9'])
+
+    def test_membership(self):
+        self.assertEqual(len(self.catalog), 5)
+        self.assertIn('hg001', self.catalog)
+        self.assertNotIn('HG001', self.catalog)
+        self.assertEqual(self.catalog.unknown(['HG002', ' HG001 ', '', 'NA12878']), ['HG001'])
+
+    def test_prefix_search(self):
+        self.assertEqual(self.catalog.search('hg'), (3, ['hg001', 'HG002', 'HG003']))
+        self.assertEqual(self.catalog.search('HG', offset=1, limit=1), (3, ['HG002']))
+        self.assertEqual(self.catalog.search('zz'), (0, []))
+        self.assertEqual(self.catalog.search('')[0], 5)
+
+    def test_substring_search(self):
+        self.assertEqual(self.catalog.search('g00', mode='substring'), (3, ['hg001', 'HG002', 'HG003']))
+        self.assertEqual(self.catalog.search('hg9', mode='substring'), (1, ['XHG9']))
+        with self.assertRaises(ValueError):
+            self.catalog.search('hg', mode='regex')
+
+    def test_service_rebuilds_on_new_metadata(self):
+        class MetadataService:
+            metadata = DatasetMetadata('uri', 1, [], ['A'], 0.0)
+            def get(self):
+                return self.metadata
+        metadata_service = MetadataService()
+        service = SampleCatalogService(metadata_service)
+        first = service.get()
+        self.assertIs(service.get(), first)
+        metadata_service.metadata = DatasetMetadata('uri', 2, [], ['A', 'B'], 0.0)
+        self.assertEqual(len(service.get()), 2)
+
+
+class CohortOpsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice')
+        cls.bob = User.objects.create_user('bob')
+        cls.trio = cls.cohort(cls.alice, 'trio', ['HG004', 'HG003', 'HG002', 'HG002'])
+        cls.shared = cls.cohort(cls.bob, 'trio', ['NA12878'], shared=True)
+        cls.private = cls.cohort(cls.bob, 'private', ['NA12891'])
+        cls.empty = cls.cohort(cls.bob, 'empty', [], shared=True)
+
+    @staticmethod
+    def cohort(owner, name, samples, shared=False):
+        cohort = Cohort(owner=owner, name=name, shared=shared)
+        cohort.set_samples(samples)
+        cohort.save()
+        return cohort
+
+    def test_parse_sample_list(self):
+        self.assertEqual(parse_sample_list(' HG002,HG003;\nHG004  NA12878 '), ['HG002', 'HG003', 'HG004', 'NA12878'])
+
+    def test_samples_are_stored_sorted_and_unique(self):
+        self.assertEqual(Cohort.objects.get(pk=self.trio.pk).samples, ['HG002', 'HG003', 'HG004'])
+        self.assertEqual(self.trio.sample_count, 3)
+
+    def test_own_cohort_wins_over_shared(self):
+        samples, key_samples, unresolved = expand_sample_tokens(['Cohort:trio', 'HG002', 'NA12891'], self.alice)
+        self.assertEqual(samples, ['HG002', 'HG003', 'HG004', 'NA12891'])
+        self.assertEqual(key_samples, [f'cohort:{self.trio.digest}', 'HG002', 'NA12891'])
+        self.assertEqual(unresolved, [])
+        self.assertEqual(expand_sample_tokens(['cohort:trio'], self.bob)[0], ['NA12878'])
+
+    def test_private_and_empty_cohorts_do_not_resolve(self):
+        samples, _, unresolved = expand_sample_tokens(['cohort:private', 'cohort:empty', 'cohort:nope'], self.alice)
+        self.assertEqual(samples, [])
+        self.assertEqual(unresolved, ['cohort:private', 'cohort:empty', 'cohort:nope'])
+
+    def test_blank_field_does_not_widen_a_cohort(self):
+        self.assertEqual(expand_sample_tokens(['', 'cohort:trio'], self.alice)[0], ['HG002', 'HG003', 'HG004'])
+        self.assertEqual(expand_sample_tokens([''], self.alice)[0], [''])
+
+    def test_visible_cohorts(self):
+        self.assertEqual(sorted(c.pk for c in visible_cohorts(self.alice)), sorted([self.trio.pk, self.shared.pk, self.empty.pk]))
+
+
+class ApiTokenAuthTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('pipeline')
+        cls.token, cls.key = ApiToken.issue(cls.user, name='test')
+
+    def authenticate(self, header):
+        return authenticate_api_token(RequestFactory().get('/', HTTP_AUTHORIZATION=header))
+
+    def test_bearer_token(self):
+        self.assertEqual(self.authenticate(f'Bearer {self.key}'), self.user)
+        self.assertEqual(self.authenticate(f'token {self.key}'), self.user)
+        self.assertIsNotNone(ApiToken.objects.get(pk=self.token.pk).last_used)
+
+    def test_rejected_tokens(self):
+        self.assertIsNone(self.authenticate(f'Basic {self.key}'))
+        self.assertIsNone(self.authenticate('Bearer wrong'))
+        self.assertIsNone(self.authenticate('Bearer '))
+        ApiToken.objects.filter(pk=self.token.pk).update(expires=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertIsNone(self.authenticate(f'Bearer {self.key}'))
+        ApiToken.objects.filter(pk=self.token.pk).update(expires=None, revoked=True)
+        self.assertIsNone(self.authenticate(f'Bearer {self.key}'))
+
+    def test_inactive_user(self):
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertIsNone(self.authenticate(f'Bearer {self.key}'))
+
+    def test_query_api_needs_a_token(self):
+        response = api.query_api(RequestFactory().get('/api/v1/query', dict(regions='chr1:1-10')))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+
+
+class FakeStream:
+    """Stands in for the TileDBQueryStream of `_stream_query_tiledb`."""
+
+    def __init__(self, frames, truncated=False):
+        self.frames = frames
+        self.truncated = truncated
+
+    def __iter__(self):
+        return iter(self.frames)
+
+
+class QueryApiPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('pipeline')
+        _, cls.key = ApiToken.issue(cls.user)
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        frames = [pd.DataFrame(dict(sample_name=['S1', 'S2', 'S3'], pos_start=[1, 2, 3])),
+                  pd.DataFrame(dict(sample_name=['S4', 'S5'], pos_start=[4, 5]))]
+        self.stream = mock.Mock(side_effect=lambda **kw: FakeStream(frames))
+        patcher = mock.patch.multiple(views,
+                                      RESULT_CACHE=ResultCache(tmp.name, max_bytes=10 ** 9),
+                                      SAMPLE_CATALOG=mock.Mock(**{'get.return_value': SampleCatalog([])}),
+                                      _query_cache_versions=mock.Mock(return_value=dict(dataset=1)),
+                                      _stream_query_tiledb=self.stream)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, **params):
+        request = RequestFactory().get('/api/v1/query', params, HTTP_AUTHORIZATION=f'Bearer {self.key}')
+        response = api.query_api(request)
+        return response.status_code, json.loads(response.content)
+
+    def test_cursor_pages_through_one_query(self):
+        rows, cursor = [], None
+        while True:
+            params = dict(regions='chr1:1-10', attrs='sample_name,pos_start', page_size=2)
+            status, page = self.get(**params, **(dict(cursor=cursor) if cursor else {}))
+            self.assertEqual(status, 200)
+            self.assertEqual(page['total_rows'], 5)
+            rows.extend(r[0] for r in page['rows'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(rows, ['S1', 'S2', 'S3', 'S4', 'S5'])
+        # the later pages were read from the result cache
+        self.assertEqual(self.stream.call_count, 1)
+
+    def test_cursor_of_another_query_is_rejected(self):
+        _, page = self.get(regions='chr1:1-10', page_size=2)
+        status, error = self.get(regions='chr1:1-20', page_size=2, cursor=page['next_cursor'])
+        self.assertEqual(status, 400)
+        self.assertIn('cursor', error['error'])
+        self.assertEqual(self.get(regions='chr1:1-10', cursor='not-a-cursor')[0], 400)
+
+    def test_fields_and_page_size_are_checked(self):
+        status, page = self.get(regions='chr1:1-10', attrs='sample_name,pos_start', fields='pos_start')
+        self.assertEqual((status, page['columns']), (200, ['pos_start']))
+        self.assertEqual(self.get(regions='chr1:1-10', fields='nope')[0], 400)
+        self.assertEqual(self.get(regions='chr1:1-10', page_size=0)[0], 400)
+
+    def test_cursor_round_trip(self):
+        key = 'ab' * 32
+        self.assertEqual(api.decode_cursor(api.encode_cursor(key, 1234), key), 1234)
+
+
+class FakeDataset:
+    """A tiledbvcf reader returning `batches` through read()/continue_read()."""
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.read_count = 0
+
+    def read(self, attrs, regions, samples):
+        self.read_count = 1
+        return self.batches[0].loc[:, attrs]
+
+    def continue_read(self):
+        self.read_count += 1
+        return self.batches[self.read_count - 1]
+
+    def read_completed(self):
+        return self.read_count >= len(self.batches)
+
+
+class TileDBQueryStreamTests(SimpleTestCase):
+
+    def dataset(self):
+        return FakeDataset([pd.DataFrame(dict(sample_name=['S1', 'S2'], pos_start=[1, 2])),
+                            pd.DataFrame(dict(sample_name=['S3', 'S4'], pos_start=[3, 4])),
+                            pd.DataFrame(dict(sample_name=['S5'], pos_start=[5]))])
+
+    def stream(self, ds, **kwargs):
+        self.incomplete = 0
+        return TileDBQueryStream(ds, attrs=['sample_name', 'pos_start'], regions=[], samples=[],
+                                 on_incomplete=lambda: setattr(self, 'incomplete', self.incomplete + 1), **kwargs)
+
+    def test_row_limit_stops_reading(self):
+        ds = self.dataset()
+        stream = self.stream(ds, row_filter=lambda b: (b.pos_start != 2).to_numpy(), row_limit=2)
+        df = pd.concat(list(stream))
+        self.assertEqual(df['sample_name'].tolist(), ['S1', 'S3'])
+        self.assertTrue(stream.truncated)
+        self.assertEqual((ds.read_count, stream.rows_read, stream.rows_kept), (2, 4, 2))
+        # the reader is left mid-read, so the caller is told to discard it
+        self.assertEqual(self.incomplete, 1)
+
+    def test_complete_read_keeps_the_reader(self):
+        stream = self.stream(self.dataset(), row_limit=5)
+        self.assertEqual(sum(df.shape[0] for df in stream), 5)
+        self.assertFalse(stream.truncated)
+        self.assertEqual(self.incomplete, 0)
+
+    def test_closed_stream_is_incomplete(self):
+        batches = iter(self.stream(self.dataset()))
+        next(batches)
+        batches.close()
+        self.assertEqual(self.incomplete, 1)
+
+    def test_internal_attrs_are_dropped(self):
+        stream = self.stream(self.dataset(), output_attrs=['sample_name'],
+                             row_filter=lambda b: (b.pos_start > 10).to_numpy())
+        frames = list(stream)
+        # nothing kept: one empty frame, with the selected columns only
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(list(frames[0].columns), ['sample_name'])
+        stream = self.stream(self.dataset(), output_attrs=['sample_name'], transform=lambda b: b.assign(n=b.pos_start * 2))
+        self.assertEqual(list(next(iter(stream)).columns), ['sample_name', 'n'])
+
+
+class VersionedLRUCacheTests(SimpleTestCase):
+
+    def test_lru_and_version(self):
+        cache = VersionedLRUCache(maxsize=2)
+        cache.get_many([], version=1)
+        cache.set_many({'a': 1, 'b': 2})
+        self.assertEqual(cache.get_many(['a'], version=1), {'a': 1})
+        cache.set_many({'c': 3})
+        self.assertEqual(cache.get_many(['a', 'b', 'c'], version=1), {'a': 1, 'c': 3})
+        self.assertEqual(cache.get_many(['a'], version=2), {})
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+
+
+class CachedAnnotationBackendTests(SimpleTestCase):
+
+    class Backend:
+        name = 'test'
+        rsids = {1: 'rs1', 2: 'rs2'}
+
+        def __init__(self):
+            self.asked = []
+
+        def version(self):
+            return (1,)
+
+        def lookup_snp_rsids(self, keys, chromosome_label, start_label, stop_label, alt_label):
+            self.asked.extend(keys['variant_key'].tolist())
+            hits = keys.loc[keys['variant_key'].isin(list(self.rsids))].copy()
+            hits['rsid'] = hits['variant_key'].map(self.rsids)
+            return hits
+
+    def keys(self, variant_keys, contig='chr1'):
+        return pd.DataFrame(dict(contig=contig, pos_start=100, pos_end=100, alt_allele=['G'] * len(variant_keys),
+                                 variant_key=variant_keys))
+
+    def test_entries_are_keyed_on_variant_key(self):
+        inner = self.Backend()
+        backend = CachedAnnotationBackend(inner, maxsize=100)
+        first = backend.lookup_snp_rsids(self.keys([1, 3]), 'contig', 'pos_start', 'pos_end', 'alt_allele')
+        self.assertEqual(first['rsid'].tolist(), ['rs1'])
+        # same variants spelled with another contig name: served from the cache, misses included
+        again = backend.lookup_snp_rsids(self.keys([1, 3], contig='1'), 'contig', 'pos_start', 'pos_end', 'alt_allele')
+        self.assertEqual(again['rsid'].tolist(), ['rs1'])
+        self.assertEqual(inner.asked, [1, 3])
+        self.assertEqual(sorted(backend.local.entries), [('snp', 1), ('snp', 3)])
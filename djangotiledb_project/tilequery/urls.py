@@ -3,4 +3,13 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('export/', views.export, name='export'),
+    path('samples/', views.sample_search, name='sample_search'),
+    path('results/<str:key>/', views.result_page, name='result_page'),
+    path('cohorts/', views.cohort_list, name='cohort_list'),
+    path('cohorts/<int:cohort_id>/delete/', views.cohort_delete, name='cohort_delete'),
+    path('jobs/', views.job_list, name='job_list'),
+    path('jobs/<uuid:job_id>/', views.job_detail, name='job_detail'),
+    path('jobs/<uuid:job_id>/page/', views.job_result_page, name='job_result_page'),
+    path('jobs/<uuid:job_id>/download/', views.job_download, name='job_download'),
 ]
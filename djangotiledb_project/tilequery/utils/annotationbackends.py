@@ -0,0 +1,93 @@
+import pandas as pd
+from typing import List, Tuple
+import threading
+import abc
+import logging
+
+from django.conf import settings
+
+from annoquery.models import Genes
+from .annotationops import lookup_snp_rsids, lookup_clinvars, annotation_data_version, table_version
+
+logger = logging.getLogger('django')
+
+
+class AnnotationBackend(abc.ABC):
+    """The annotation lookups `_append_tiledb_with_annotation` needs. `keys` are unique
+    (chromosome, start, stop, alt) rows with their `variant_key` column; the lookups return `keys`
+    columns + the values, one row per key that was found (the first hit by id)."""
+
+    name = None
+
+    @abc.abstractmethod
+    def version(self) -> Tuple:
+        """Changes whenever any of the annotation data changes. Part of the result cache key."""
+
+    @abc.abstractmethod
+    def genes_version(self) -> Tuple:
+        ...
+
+    @abc.abstractmethod
+    def lookup_snp_rsids(self, keys:pd.DataFrame, chromosome_label, start_label, stop_label, alt_label) -> pd.DataFrame:
+        ...
+
+    @abc.abstractmethod
+    def lookup_clinvars(self, keys:pd.DataFrame, clinvar_fields:List[str], chromosome_label, start_label, stop_label, alt_label) -> pd.DataFrame:
+        ...
+
+    @abc.abstractmethod
+    def load_genes(self) -> pd.DataFrame:
+        """Every gene as (chromosome, start, stop, gene), for the GeneIntervalIndex."""
+
+
+class PostgresAnnotationBackend(AnnotationBackend):
+    """The `annoquery` tables on annodb, with the batched queries of annotationops."""
+
+    name = 'postgres'
+
+    def version(self) -> Tuple:
+        return annotation_data_version()
+
+    def genes_version(self) -> Tuple:
+        return table_version(Genes)
+
+    def lookup_snp_rsids(self, keys, chromosome_label, start_label, stop_label, alt_label):
+        return lookup_snp_rsids(keys, chromosome_label, start_label, stop_label, alt_label)
+
+    def lookup_clinvars(self, keys, clinvar_fields, chromosome_label, start_label, stop_label, alt_label):
+        return lookup_clinvars(keys, clinvar_fields, chromosome_label, start_label, stop_label, alt_label)
+
+    def load_genes(self):
+        rows = Genes.objects.values_list('chromosome', 'start', 'stop', 'gene')
+        return pd.DataFrame.from_records(rows, columns=['chromosome', 'start', 'stop', 'gene'])
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_annotation_backend() -> AnnotationBackend:
+    """Process-wide backend picked by settings.ANNOTATION_BACKEND: `postgres` (default) or `local`,
+    the memory-mapped store under settings.ANNOTATION_STORE_DIR. Wrapped in the per-worker hot key
+    cache when settings.ANNOTATION_CACHE_SIZE is set."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = getattr(settings, 'ANNOTATION_BACKEND', 'postgres')
+            if name == 'postgres':
+                _backend = PostgresAnnotationBackend()
+            elif name == 'local':
+                from .annotationstore import LocalAnnotationBackend
+                _backend = LocalAnnotationBackend(getattr(settings, 'ANNOTATION_STORE_DIR'))
+            else:
+                raise ValueError(f'<get_annotation_backend> unknown ANNOTATION_BACKEND "{name}". Expected postgres or local.')
+            if getattr(settings, 'ANNOTATION_CACHE_SIZE', 0):
+                from django.core.cache import caches
+                from .annotationcache import CachedAnnotationBackend
+                shared = getattr(settings, 'ANNOTATION_SHARED_CACHE', None)
+                _backend = CachedAnnotationBackend(_backend,
+                                                   maxsize=settings.ANNOTATION_CACHE_SIZE,
+                                                   ttl=getattr(settings, 'ANNOTATION_CACHE_TTL_SECONDS', None),
+                                                   shared_cache=caches[shared] if shared else None)
+            logger.info(f'get_annotation_backend: using {_backend.name}')
+        return _backend
@@ -0,0 +1,155 @@
+import pandas as pd
+from typing import Callable, Dict, Hashable, List, Tuple
+from collections import OrderedDict
+import threading
+import hashlib
+import logging
+import time
+
+from annoquery.models import Clinvars, Snps
+from .annotationbackends import AnnotationBackend
+from .annotationops import VARIANT_KEY_LABEL
+from .regionops import CHR_DICT_STR_TO_INT, parse_regions
+
+logger = logging.getLogger('django')
+
+
+class VersionedLRUCache:
+    """Thread-safe LRU of key -> value for one worker. It is emptied whenever the data version it
+    is asked with changes, and entries older than `ttl` seconds (if set) count as missing."""
+
+    def __init__(self, maxsize:int, ttl:float=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys:List[Hashable], version) -> Dict:
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            now = time.monotonic()
+            found = {}
+            for k in keys:
+                entry = self.entries.get(k)
+                if entry is None or (self.ttl is not None and entry[0] < now):
+                    continue
+                self.entries.move_to_end(k)
+                found[k] = entry[1]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            return found
+
+    def set_many(self, values:Dict):
+        with self.lock:
+            expires = time.monotonic() + self.ttl if self.ttl is not None else None
+            for k, v in values.items():
+                self.entries[k] = (expires, v)
+                self.entries.move_to_end(k)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+def _plain(row:tuple) -> tuple:
+    # numpy scalars -> python ones, so keys hash the same whichever dataframe they came from
+    return tuple(v.item() if hasattr(v, 'item') else v for v in row)
+
+
+class CachedAnnotationBackend(AnnotationBackend):
+    """Wraps another backend with a per-worker LRU of variant_key -> annotation, in front of the
+    dbSNP and ClinVar lookups. Misses are remembered too, so hotspot positions with no annotation
+    do not go back to the backend either. Everything is invalidated when the wrapped backend's
+    version changes. With `shared_cache` (a Django cache, e.g. memcached or redis) workers also share
+    entries; the shared keys include the version, so a reload never serves stale entries."""
+
+    def __init__(self, inner:AnnotationBackend, maxsize:int, ttl:float=None, shared_cache=None):
+        self.inner = inner
+        self.name = f'{inner.name}+cache'
+        self.local = VersionedLRUCache(maxsize, ttl)
+        self.ttl = ttl
+        self.shared_cache = shared_cache
+
+    def version(self) -> Tuple:
+        return self.inner.version()
+
+    def genes_version(self) -> Tuple:
+        return self.inner.genes_version()
+
+    def load_genes(self) -> pd.DataFrame:
+        return self.inner.load_genes()
+
+    def _shared_key(self, version, key:tuple) -> str:
+        return 'tilequery.anno.' + hashlib.md5(repr((version, key)).encode()).hexdigest()
+
+    def _cached_lookup(self, kind:tuple, keys:pd.DataFrame, key_labels:List[str], value_labels:List[str],
+                       fetch:Callable[[pd.DataFrame], pd.DataFrame]) -> pd.DataFrame:
+        # entries are keyed on the int64 variant_key: cheap to hash, and one key per variant however
+        # the caller spells its chromosome or positions
+        keys = keys.reset_index(drop=True)
+        version = self.inner.version()
+        cache_keys = [kind + (int(k),) for k in keys.loc[:, VARIANT_KEY_LABEL]]
+        found = self.local.get_many(cache_keys, version)
+
+        missing = [k for k in dict.fromkeys(cache_keys) if k not in found]
+        if missing and self.shared_cache is not None:
+            shared_keys = {self._shared_key(version, k): k for k in missing}
+            shared = {shared_keys[sk]: v for sk, v in self.shared_cache.get_many(list(shared_keys)).items()}
+            self.local.set_many(shared)
+            found.update(shared)
+            missing = [k for k in missing if k not in shared]
+
+        if missing:
+            missing_set = set(missing)
+            rows = [i for i, k in enumerate(cache_keys) if k in missing_set]
+            hits = fetch(keys.iloc[rows].drop_duplicates(subset=VARIANT_KEY_LABEL))
+            fetched = {k: None for k in missing}
+            for row in hits.loc[:, [VARIANT_KEY_LABEL] + value_labels].itertuples(index=False, name=None):
+                fetched[kind + (int(row[0]),)] = _plain(row[1:])
+            self.local.set_many(fetched)
+            if self.shared_cache is not None:
+                self.shared_cache.set_many({self._shared_key(version, k): v for k, v in fetched.items()}, timeout=self.ttl)
+            found.update(fetched)
+
+        positions = [i for i, k in enumerate(cache_keys) if found.get(k) is not None]
+        logger.info(f'CachedAnnotationBackend: {kind[0]} {len(cache_keys)} keys, {len(cache_keys) - len(missing)} cached, {len(positions)} hits')
+        values = pd.DataFrame([found[cache_keys[i]] for i in positions], columns=value_labels, dtype=object)
+        result = pd.concat([keys.iloc[positions].reset_index(drop=True), values], axis=1)
+        return result.drop_duplicates(subset=key_labels).reset_index(drop=True)
+
+    def lookup_snp_rsids(self, keys, chromosome_label, start_label, stop_label, alt_label):
+        key_labels = [chromosome_label, start_label, stop_label, alt_label]
+        fetch = lambda k: self.inner.lookup_snp_rsids(k, chromosome_label, start_label, stop_label, alt_label)
+        return self._cached_lookup(('snp',), keys, key_labels, ['rsid'], fetch)
+
+    def lookup_clinvars(self, keys, clinvar_fields, chromosome_label, start_label, stop_label, alt_label):
+        key_labels = [chromosome_label, start_label, stop_label, alt_label]
+        fetch = lambda k: self.inner.lookup_clinvars(k, clinvar_fields, chromosome_label, start_label, stop_label, alt_label)
+        # the selected columns are part of the key, the profile may differ between callers
+        return self._cached_lookup(('clinvar', tuple(clinvar_fields)), keys, key_labels,
+                                   [f'clinvar__{f}' for f in clinvar_fields], fetch)
+
+
+def prewarm_annotations(backend:AnnotationBackend, regions:List[str], clinvar_fields:List[str]):
+    """Runs the dbSNP and ClinVar lookups for every annotated variant inside `regions`, so that
+    `backend`'s cache holds them before the first query asks. The variants are taken from annodb,
+    since the alt alleles a query will bring are not known in advance."""
+    snp_keys, clinvar_keys = [], []
+    for r in parse_regions(regions):
+        snp_keys.extend(Snps.objects.filter(chr=r.contig, start__gte=r.start, start__lte=r.end)
+                        .values_list('chr', 'start', 'stop', 'alt', 'variant_key'))
+        clinvar_keys.extend(Clinvars.objects.filter(chromosome=CHR_DICT_STR_TO_INT[r.contig], positionvcf__gte=r.start, positionvcf__lte=r.end)
+                            .values_list('chromosome', 'positionvcf', 'referenceallelevcf', 'alternateallelevcf', 'variant_key'))
+    labels = ['contig', 'pos_start', 'pos_end', 'alt_allele']
+    snp_keys = pd.DataFrame(snp_keys, columns=labels + [VARIANT_KEY_LABEL]).dropna().drop_duplicates(subset=labels)
+    # keyed like a tiledb record: VCF position, and the end from the length of the VCF ref allele
+    clinvar_keys = pd.DataFrame(clinvar_keys, columns=['chr_int', 'pos_start', 'ref', 'alt_allele', VARIANT_KEY_LABEL]).dropna()
+    clinvar_keys['pos_end'] = clinvar_keys['pos_start'] + clinvar_keys['ref'].str.len() - 1
+    clinvar_keys = clinvar_keys.loc[:, ['chr_int'] + labels[1:] + [VARIANT_KEY_LABEL]].drop_duplicates(subset=['chr_int'] + labels[1:])
+    clinvar_keys['chr_int'] = clinvar_keys['chr_int'].astype(int)
+    backend.lookup_snp_rsids(snp_keys, *labels)
+    backend.lookup_clinvars(clinvar_keys, clinvar_fields, 'chr_int', *labels[1:])
+    logger.info(f'prewarm_annotations: {snp_keys.shape[0]} dbSNP and {clinvar_keys.shape[0]} ClinVar variants in {len(regions)} regions')
@@ -0,0 +1,230 @@
+import pandas as pd
+import numpy as np
+from typing import List, Iterable, Tuple
+import threading
+import logging
+import time
+
+from django.db import connections
+from django.db.models import Max
+
+from annoquery.models import Clinvars, Snps, Genes, variant_key
+from .instrumentation import stage
+
+logger = logging.getLogger('django')
+
+# max number of keys sent in one `variant_key__in` clause. Keeps the statement
+# small enough for postgres to plan against the variant_key index.
+ANNOTATION_BATCH_SIZE = 1000
+
+# column of the lookup keys holding `annoquery.models.variant_key`
+VARIANT_KEY_LABEL = 'variant_key'
+
+# how often (seconds) the annotation tables are re-checked for a new version
+ANNOTATION_VERSION_CHECK_INTERVAL_SECONDS = 60
+
+
+# large free-text Clinvars columns (up to ~4k chars each). No profile selects them; they are fetched
+# one row at a time by annoquery's clinvar_detail view when a result row is expanded.
+CLINVAR_DEFERRED_FIELDS = ['phenotypeids', 'otherids']
+
+# Clinvars columns returned with the query results. `id` is always first so a row can be expanded later.
+CLINVAR_PROFILES = {
+    'minimal': ['id', 'clinicalsignificance', 'reviewstatus', 'genesymbol'],
+    'clinical': ['id', 'alleleid', 'variationid', 'type', 'name', 'genesymbol', 'hgnc_id',
+                 'clinicalsignificance', 'clinsigsimple', 'lastevaluated', 'reviewstatus',
+                 'numbersubmitters', 'phenotypelist', 'origin', 'rcvaccession'],
+    'full': None,
+}
+
+
+def clinvar_profile_fields(profile:str) -> List[str]:
+    """Clinvars columns for the given profile. `full` is every column except the deferred
+    free-text ones and the internal variant_key."""
+    if profile not in CLINVAR_PROFILES:
+        raise ValueError(f'<clinvar_profile_fields> unknown clinvar profile "{profile}". Expected one of {",".join(CLINVAR_PROFILES)}.')
+    if CLINVAR_PROFILES[profile] is not None:
+        return list(CLINVAR_PROFILES[profile])
+    return [f.name for f in Clinvars._meta.concrete_fields
+            if f.name not in CLINVAR_DEFERRED_FIELDS and f.name != 'variant_key']
+
+
+def chunked(seq:List, size:int=ANNOTATION_BATCH_SIZE) -> Iterable[List]:
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def table_version(model) -> Tuple:
+    """Cheap change detector for an annotation table: its max id, one index lookup. Rows are never
+    counted, that is a full scan of dbSNP. `staged_reload` gives every reload ids above the live
+    table's max id, so a reload always changes it."""
+    return (model.objects.aggregate(m=Max('id'))['m'],)
+
+
+_annotation_version = None
+_annotation_version_checked = 0.0
+_annotation_version_lock = threading.Lock()
+
+
+def annotation_data_version() -> Tuple:
+    """Version stamp over Snps, Clinvars and Genes, re-checked at most every
+    ANNOTATION_VERSION_CHECK_INTERVAL_SECONDS per process. One thread re-checks while the others
+    keep using the previous stamp, so no request waits on the check once a stamp exists."""
+    global _annotation_version, _annotation_version_checked
+    if _annotation_version is not None and (time.monotonic() - _annotation_version_checked) <= ANNOTATION_VERSION_CHECK_INTERVAL_SECONDS:
+        return _annotation_version
+    if not _annotation_version_lock.acquire(blocking=_annotation_version is None):
+        return _annotation_version
+    try:
+        now = time.monotonic()
+        if _annotation_version is None or (now - _annotation_version_checked) > ANNOTATION_VERSION_CHECK_INTERVAL_SECONDS:
+            _annotation_version = tuple(table_version(m) for m in (Snps, Clinvars, Genes))
+            _annotation_version_checked = now
+        return _annotation_version
+    finally:
+        _annotation_version_lock.release()
+
+
+def _unique_keys(df:pd.DataFrame, key_labels:List[str]) -> pd.DataFrame:
+    return df.loc[:, key_labels].dropna().drop_duplicates().reset_index(drop=True)
+
+
+def variant_keys(df:pd.DataFrame, chromosome_label:str, start_label:str, ref_label:str, alt_label:str) -> np.ndarray:
+    """`annoquery.models.variant_key` of every row of `df`, hashed once per distinct variant."""
+    labels = [chromosome_label, start_label, ref_label, alt_label]
+    distinct = df.loc[:, labels].drop_duplicates()
+    distinct[VARIANT_KEY_LABEL] = [variant_key(*row) for row in distinct.itertuples(index=False, name=None)]
+    return df.loc[:, labels].merge(distinct, how='left', on=labels).loc[:, VARIANT_KEY_LABEL].to_numpy(dtype=np.int64)
+
+
+def snp_lookup_queryset(chromosome:str, keys:List[int]):
+    """The Snps query behind `lookup_snp_rsids`: an exact match on the variant_key index, within the
+    chromosome's partition."""
+    return (Snps.objects.filter(chr=chromosome, variant_key__in=keys)
+            .order_by('id')
+            .values_list('variant_key', 'rsid'))
+
+
+def clinvar_lookup_queryset(chromosome, keys:List[int], clinvar_fields:List[str]):
+    """The Clinvars query behind `lookup_clinvars`. On postgres only the first row (by id) per
+    variant_key is returned, with DISTINCT ON, instead of every submission for the variant."""
+    qs = Clinvars.objects.filter(chromosome=int(chromosome), variant_key__in=keys)
+    if connections[qs.db].vendor == 'postgresql':
+        qs = qs.order_by('variant_key', 'id').distinct('variant_key')
+    else:
+        qs = qs.order_by('id')
+    return qs.values_list('variant_key', *clinvar_fields)
+
+
+def _lookup_variant_keys(keys:pd.DataFrame, chromosome_label:str, queryset, value_labels:List[str]) -> pd.DataFrame:
+    """Runs `queryset(chromosome, variant keys)` for every chromosome and chunk of `keys`, first hit
+    per variant_key."""
+    if VARIANT_KEY_LABEL not in keys.columns:
+        raise ValueError(f'<_lookup_variant_keys> the keys need a {VARIANT_KEY_LABEL} column, see `variant_keys`.')
+    hits = []
+    for chromosome, group in keys.groupby(chromosome_label, sort=False):
+        wanted = sorted(set(int(x) for x in group.loc[:, VARIANT_KEY_LABEL]))
+        for chunk in chunked(wanted):
+            hits.extend(queryset(chromosome, chunk))
+    hits = pd.DataFrame(hits, columns=[VARIANT_KEY_LABEL] + value_labels)
+    return hits.drop_duplicates(subset=VARIANT_KEY_LABEL, keep='first')
+
+
+def lookup_snp_rsids(keys:pd.DataFrame,
+                     chromosome_label='contig',
+                     start_label='pos_start',
+                     stop_label='pos_end',
+                     alt_label='alt_allele',
+                     ) -> pd.DataFrame:
+    """For the unique (chromosome, start, stop, alt) `keys`, which also carry their `variant_key`,
+    fetch the dbSNP rsid with one `variant_key__in` query per chromosome per chunk. Returns `keys`
+    columns + `rsid`, one row per key (the first hit by primary key, same as the old per-row search).
+    """
+    hits = _lookup_variant_keys(keys, chromosome_label, snp_lookup_queryset, ['rsid'])
+    logger.info(f'lookup_snp_rsids: {keys.shape[0]} keys, {hits.shape[0]} hits')
+    return keys.merge(hits, how='inner', on=VARIANT_KEY_LABEL)
+
+
+def lookup_clinvars(keys:pd.DataFrame,
+                    clinvar_fields:List[str],
+                    chromosome_label='chr_int',
+                    start_label='pos_start',
+                    stop_label='pos_end',
+                    alt_label='alt_allele',
+                    ) -> pd.DataFrame:
+    """Same as `lookup_snp_rsids` but for Clinvars, whose variant_key is on the VCF position and
+    alleles. Returns `keys` columns + `clinvar_fields`, with the clinvar columns prefixed by
+    `clinvar__` so they cannot clash with the key labels.
+    """
+    value_labels = [f'clinvar__{f}' for f in clinvar_fields]
+    queryset = lambda chromosome, chunk: clinvar_lookup_queryset(chromosome, chunk, clinvar_fields)
+    hits = _lookup_variant_keys(keys, chromosome_label, queryset, value_labels)
+    # object dtype so integer fields are not upcast to float by the left merge
+    hits[value_labels] = hits[value_labels].astype(object)
+    logger.info(f'lookup_clinvars: {keys.shape[0]} keys, {hits.shape[0]} hits')
+    return keys.merge(hits, how='inner', on=VARIANT_KEY_LABEL)
+
+
+def batch_search_for_snp_and_clinvar(df:pd.DataFrame,
+                                     clinvar_fields:List[str],
+                                     chromosome_label='contig',
+                                     start_label='pos_start',
+                                     stop_label='pos_end',
+                                     alt_label='alt_allele',
+                                     chr_int_label='chr_int',
+                                     id_label='id',
+                                     ref_label='ref',
+                                     allele_label='alleles',
+                                     snp_search=True,
+                                     backend=None,
+                                     ) -> pd.DataFrame:
+    """Set-based replacement for the per-row `search_for_snp_and_clinvar`. Expects the exploded
+    dataframe (one alt allele per row), with the reference allele in `ref_label` or as the first of
+    `allele_label`. Returns a dataframe aligned to `df` by position with columns
+    `['rsid'] + clinvar_fields`, '-' where nothing was found. The lookups go through `backend` (an
+    annotationbackends.AnnotationBackend), or straight to annodb when None.
+    """
+    snp_lookup = backend.lookup_snp_rsids if backend is not None else lookup_snp_rsids
+    clinvar_lookup = backend.lookup_clinvars if backend is not None else lookup_clinvars
+
+    if df.shape[0] == 0:
+        return pd.DataFrame(columns=['rsid'] + clinvar_fields)
+
+    if ref_label in df.columns:
+        ref = df.loc[:, ref_label]
+    elif allele_label in df.columns:
+        ref = df.loc[:, allele_label].map(lambda a: a[0] if a is not None and len(a) else None)
+    else:
+        raise ValueError(f'<batch_search_for_snp_and_clinvar> needs a {ref_label} or {allele_label} column for the variant keys.')
+    keyed = df.loc[:, [chromosome_label, chr_int_label, start_label, stop_label, alt_label]].copy()
+    # the chromosome name, not chr_int, is hashed: ClinVar's keys are on 'X'/'Y', not 23/24
+    keyed[VARIANT_KEY_LABEL] = variant_keys(keyed.assign(_ref=ref.to_numpy()), chromosome_label, start_label, '_ref', alt_label)
+
+    rsid = df.loc[:, id_label].to_numpy(dtype=object).copy()
+    need_snp = rsid == '.'
+    rsid[need_snp] = '-'
+
+    if snp_search and need_snp.any():
+        snp_labels = [chromosome_label, start_label, stop_label, alt_label]
+        snp_keys = _unique_keys(keyed.loc[need_snp], snp_labels + [VARIANT_KEY_LABEL])
+        with stage('snp_lookup', rows=snp_keys.shape[0]):
+            snp_hits = snp_lookup(snp_keys, chromosome_label, start_label, stop_label, alt_label)
+        found = (keyed.loc[:, snp_labels]
+                 .merge(snp_hits.loc[:, snp_labels + ['rsid']].drop_duplicates(subset=snp_labels), how='left', on=snp_labels)
+                 .loc[:, 'rsid'].to_numpy(dtype=object))
+        fill = need_snp & pd.notna(found)
+        rsid[fill] = found[fill]
+
+    clin_labels = [chr_int_label, start_label, stop_label, alt_label]
+    clin_values = [f'clinvar__{f}' for f in clinvar_fields]
+    clin_keys = _unique_keys(keyed, clin_labels + [VARIANT_KEY_LABEL])
+    with stage('clinvar_lookup', rows=clin_keys.shape[0]):
+        clin_hits = clinvar_lookup(clin_keys, clinvar_fields, chr_int_label, start_label, stop_label, alt_label)
+    clin = (keyed.loc[:, clin_labels]
+            .merge(clin_hits.loc[:, clin_labels + clin_values].drop_duplicates(subset=clin_labels), how='left', on=clin_labels)
+            .loc[:, clin_values]
+            .astype(object)
+            .fillna('-')
+            .to_numpy())
+
+    return pd.DataFrame(np.column_stack([rsid, clin]), columns=['rsid'] + clinvar_fields)
@@ -0,0 +1,252 @@
+import pandas as pd
+import numpy as np
+from typing import Iterable, List, Tuple
+import threading
+import datetime
+import logging
+import shutil
+import json
+import time
+import os
+
+import pyarrow as pa
+
+from annoquery.models import Clinvars, Snps, Genes
+from .annotationops import annotation_data_version, clinvar_profile_fields, VARIANT_KEY_LABEL
+from .annotationbackends import AnnotationBackend
+from .regionops import CHR_DICT_STR_TO_INT
+
+logger = logging.getLogger('django')
+
+# rows per Arrow record batch in the store files
+STORE_BATCH_ROWS = 1_000_000
+
+# how often (seconds) a worker re-reads the CURRENT pointer of the store directory
+STORE_CHECK_INTERVAL_SECONDS = 60
+
+# builds kept next to the current one, so workers still mapping the previous files are not cut off
+STORE_KEEP_BUILDS = 2
+
+# columns stored for the Clinvars lookup: every profile can be served from it
+CLINVAR_STORE_FIELDS = clinvar_profile_fields('full')
+
+# columns of the store files, the position first: it becomes the `pos_key`. ClinVar is keyed on its
+# VCF position, the one its variant_key and the tiledb records use.
+SNP_STORE_COLUMNS = ['start', 'variant_key', 'rsid', 'id']
+CLINVAR_STORE_COLUMNS = ['positionvcf', 'variant_key', 'id'] + [f for f in CLINVAR_STORE_FIELDS if f not in ('positionvcf', 'id')]
+
+
+def pos_key(chromosomes, starts) -> np.ndarray:
+    """(chromosome number, start) packed into one sortable int64: chromosome << 32 | start."""
+    return (np.asarray(chromosomes, dtype=np.int64) << 32) | np.asarray(starts, dtype=np.int64)
+
+
+def _write_batches(path:str, schema:pa.Schema, batches:Iterable[pa.RecordBatch]) -> int:
+    n = 0
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            n += batch.num_rows
+    return n
+
+
+def _batched_query(qs, columns:List[str], chr_int:int, schema:pa.Schema) -> Iterable[pa.RecordBatch]:
+    """Streams `qs` (ordered by position, id) with a server-side cursor into record batches with
+    `pos_key`. The position is the first of `columns`."""
+    rows = []
+    def flush():
+        df = pd.DataFrame.from_records(rows, columns=columns)
+        df.insert(0, 'pos_key', pos_key(np.full(df.shape[0], chr_int), df.pop(columns[0])))
+        return pa.RecordBatch.from_pandas(df, schema=schema, preserve_index=False)
+    for row in qs.values_list(*columns).iterator(chunk_size=max(STORE_BATCH_ROWS // 10, 1)):
+        rows.append(row)
+        if len(rows) >= STORE_BATCH_ROWS:
+            yield flush()
+            rows = []
+    if rows:
+        yield flush()
+
+
+def _snps_batches(schema) -> Iterable[pa.RecordBatch]:
+    for contig, chr_int in sorted(CHR_DICT_STR_TO_INT.items(), key=lambda x: x[1]):
+        qs = Snps.objects.filter(chr=contig).order_by('start', 'id')
+        yield from _batched_query(qs, SNP_STORE_COLUMNS, chr_int, schema)
+        logger.info(f'build_annotation_store: snps {contig} done')
+
+
+def _clinvars_batches(schema) -> Iterable[pa.RecordBatch]:
+    for chr_int in sorted(CHR_DICT_STR_TO_INT.values()):
+        qs = Clinvars.objects.filter(chromosome=str(chr_int)).order_by('positionvcf', 'id')
+        yield from _batched_query(qs, CLINVAR_STORE_COLUMNS, chr_int, schema)
+
+
+def _schema(model, fields:List[str]) -> pa.Schema:
+    """Arrow schema of the store columns `fields`, the first one (the position) stored as `pos_key`."""
+    types = []
+    for i, name in enumerate(fields):
+        field = model._meta.get_field(name)
+        if i == 0:
+            types.append(pa.field('pos_key', pa.int64(), nullable=False))
+        elif field.get_internal_type() in ('AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField'):
+            types.append(pa.field(name, pa.int64()))
+        elif field.get_internal_type() == 'FloatField':
+            types.append(pa.field(name, pa.float64()))
+        else:
+            types.append(pa.field(name, pa.string()))
+    return pa.schema(types)
+
+
+def build_annotation_store(store_dir:str) -> str:
+    """Materializes Snps, Clinvars and Genes from annodb into `<store_dir>/builds/<build id>/` as Arrow
+    IPC files sorted by (pos_key, id), then points `<store_dir>/CURRENT` at it. The switch is an
+    atomic rename, so workers only ever map a complete build. Returns the build directory."""
+    build_id = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    build_dir = os.path.join(store_dir, 'builds', build_id)
+    os.makedirs(build_dir)
+    source_version = annotation_data_version()
+
+    n_snps = _write_batches(os.path.join(build_dir, 'snps.arrow'), _schema(Snps, SNP_STORE_COLUMNS),
+                            _snps_batches(_schema(Snps, SNP_STORE_COLUMNS)))
+
+    n_clinvars = _write_batches(os.path.join(build_dir, 'clinvars.arrow'), _schema(Clinvars, CLINVAR_STORE_COLUMNS),
+                                _clinvars_batches(_schema(Clinvars, CLINVAR_STORE_COLUMNS)))
+
+    genes = pd.DataFrame.from_records(Genes.objects.values_list('chromosome', 'start', 'stop', 'gene'),
+                                      columns=['chromosome', 'start', 'stop', 'gene'])
+    genes_table = pa.Table.from_pandas(genes, preserve_index=False)
+    n_genes = _write_batches(os.path.join(build_dir, 'genes.arrow'), genes_table.schema, genes_table.to_batches())
+
+    manifest = dict(build=build_id, source_version=repr(source_version),
+                    rows=dict(snps=n_snps, clinvars=n_clinvars, genes=n_genes))
+    with open(os.path.join(build_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    pointer = os.path.join(store_dir, 'CURRENT')
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(build_id)
+    os.replace(pointer + '.tmp', pointer)
+    logger.info(f'build_annotation_store: {manifest}')
+
+    builds = sorted(os.listdir(os.path.join(store_dir, 'builds')))
+    for old in builds[:-(STORE_KEEP_BUILDS + 1)]:
+        shutil.rmtree(os.path.join(store_dir, 'builds', old), ignore_errors=True)
+    return build_dir
+
+
+class SortedArrowFile:
+    """Memory-mapped Arrow IPC file sorted by `pos_key`. Every record batch's key column is a
+    zero-copy NumPy view of the mapping, so a lookup is a binary search over the batches covering the
+    key and only the matching rows are ever materialized."""
+
+    def __init__(self, path:str):
+        self.reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+        self.batches = [self.reader.get_batch(i) for i in range(self.reader.num_record_batches)]
+        self.batches = [b for b in self.batches if b.num_rows]
+        self.keys = [b.column('pos_key').to_numpy() for b in self.batches]
+        self.first_keys = np.array([k[0] for k in self.keys], dtype=np.int64)
+        self.last_keys = np.array([k[-1] for k in self.keys], dtype=np.int64)
+
+    def find(self, query_keys:np.ndarray, columns:List[str]) -> pd.DataFrame:
+        """Every row whose pos_key equals one of `query_keys`, as `columns` plus `query` (the index
+        into `query_keys`)."""
+        query_keys = np.asarray(query_keys, dtype=np.int64)
+        # batches b_lo..b_hi-1 can hold a key; equal keys may span a batch boundary
+        b_lo = np.searchsorted(self.last_keys, query_keys, side='left')
+        b_hi = np.searchsorted(self.first_keys, query_keys, side='right')
+        frames = []
+        for b in np.unique(np.concatenate([np.arange(lo, hi) for lo, hi in zip(b_lo, b_hi)] or [np.array([], dtype=np.int64)])):
+            queries = np.flatnonzero((b_lo <= b) & (b < b_hi))
+            keys = self.keys[b]
+            lo = np.searchsorted(keys, query_keys[queries], side='left')
+            hi = np.searchsorted(keys, query_keys[queries], side='right')
+            counts = hi - lo
+            if not counts.sum():
+                continue
+            query_idx = np.repeat(queries, counts)
+            row_idx = np.repeat(lo, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+            df = self.batches[b].select(columns).take(pa.array(row_idx)).to_pandas()
+            df['query'] = query_idx
+            frames.append(df)
+        if not frames:
+            return pd.DataFrame(columns=columns + ['query'])
+        return pd.concat(frames, ignore_index=True)
+
+
+class LocalAnnotationBackend(AnnotationBackend):
+    """Annotation lookups against the local store written by `build_annotation_store`. No database
+    round-trip: the batched position lookups are binary searches over the memory-mapped files. A newly
+    built store is picked up within STORE_CHECK_INTERVAL_SECONDS."""
+
+    name = 'local'
+
+    def __init__(self, store_dir:str):
+        self.store_dir = str(store_dir)
+        self.build = None
+        self.manifest = None
+        self.snps = None
+        self.clinvars = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def _refresh(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.build is None or (now - self.checked) > STORE_CHECK_INTERVAL_SECONDS:
+                try:
+                    with open(os.path.join(self.store_dir, 'CURRENT')) as f:
+                        build = f.read().strip()
+                except OSError:
+                    raise ValueError(f'<LocalAnnotationBackend> no annotation store in {self.store_dir}. Run `manage.py build_annotation_store` first.')
+                if build != self.build:
+                    build_dir = os.path.join(self.store_dir, 'builds', build)
+                    with open(os.path.join(build_dir, 'manifest.json')) as f:
+                        self.manifest = json.load(f)
+                    self.snps = SortedArrowFile(os.path.join(build_dir, 'snps.arrow'))
+                    self.clinvars = SortedArrowFile(os.path.join(build_dir, 'clinvars.arrow'))
+                    self.build = build
+                    logger.info(f'LocalAnnotationBackend: opened build {build}')
+                self.checked = now
+
+    def version(self) -> Tuple:
+        self._refresh()
+        return ('local', self.build)
+
+    def genes_version(self) -> Tuple:
+        return self.version()
+
+    def _lookup(self, table:SortedArrowFile, keys:pd.DataFrame, chromosomes, value_columns:List[str],
+                start_label) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Returns (keys with a match, their values), both aligned, first hit by id per key. The
+        position finds the candidate rows, the variant_key picks the exact variant among them."""
+        keys = keys.reset_index(drop=True)
+        query_keys = pos_key(chromosomes, keys.loc[:, start_label].to_numpy(dtype=np.int64))
+        hits = table.find(query_keys, ['variant_key', 'id'] + [c for c in value_columns if c not in ('variant_key', 'id')])
+        q = hits['query'].to_numpy(dtype=np.int64)
+        match = hits['variant_key'].to_numpy(dtype=np.int64) == keys.loc[:, VARIANT_KEY_LABEL].to_numpy(dtype=np.int64)[q]
+        hits = hits.loc[match].sort_values('id', kind='stable').drop_duplicates(subset='query', keep='first')
+        return keys.iloc[hits['query'].to_numpy()].reset_index(drop=True), hits.loc[:, value_columns].reset_index(drop=True)
+
+    def lookup_snp_rsids(self, keys, chromosome_label, start_label, stop_label, alt_label):
+        self._refresh()
+        chromosomes = keys.loc[:, chromosome_label].map(CHR_DICT_STR_TO_INT)
+        keys = keys.loc[chromosomes.notna().to_numpy()]
+        found, values = self._lookup(self.snps, keys, chromosomes.dropna().to_numpy(dtype=np.int64), ['rsid'], start_label)
+        logger.info(f'LocalAnnotationBackend.lookup_snp_rsids: {keys.shape[0]} keys, {found.shape[0]} hits')
+        return pd.concat([found, values], axis=1)
+
+    def lookup_clinvars(self, keys, clinvar_fields, chromosome_label, start_label, stop_label, alt_label):
+        self._refresh()
+        missing = [f for f in clinvar_fields if f not in CLINVAR_STORE_FIELDS]
+        if missing:
+            raise ValueError(f'<LocalAnnotationBackend> clinvar fields {",".join(missing)} are not in the local store.')
+        found, values = self._lookup(self.clinvars, keys, keys.loc[:, chromosome_label].to_numpy(dtype=np.int64),
+                                     clinvar_fields, start_label)
+        values = values.astype(object)
+        values.columns = [f'clinvar__{f}' for f in clinvar_fields]
+        logger.info(f'LocalAnnotationBackend.lookup_clinvars: {keys.shape[0]} keys, {found.shape[0]} hits')
+        return pd.concat([found, values], axis=1)
+
+    def load_genes(self) -> pd.DataFrame:
+        self._refresh()
+        path = os.path.join(self.store_dir, 'builds', self.build, 'genes.arrow')
+        return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all().to_pandas()
@@ -0,0 +1,150 @@
+import pandas as pd
+from typing import Iterable, Iterator, List
+import json
+import io
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# schema metadata key holding the original (possibly duplicated) column names, e.g. the
+# annotated result carries both the tiledb `id` and the clinvar `id`.
+COLUMNS_METADATA_KEY = b'tilequery.columns'
+
+EXPORT_FORMATS = {
+    'csv':      ('text/csv', 'csv'),
+    'tsv':      ('text/tab-separated-values', 'tsv'),
+    'arrow':    ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet':  ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+def unique_column_names(columns:List[str]) -> List[str]:
+    """['id', 'rsid', 'id'] -> ['id', 'rsid', 'id.1'], same scheme as pandas' read_csv."""
+    seen = {}
+    out = []
+    for c in columns:
+        c = str(c)
+        if c in seen:
+            seen[c] += 1
+            out.append(f'{c}.{seen[c]}')
+        else:
+            seen[c] = 0
+            out.append(c)
+    return out
+
+
+def _series_to_arrow(s:pd.Series) -> pa.Array:
+    try:
+        return pa.Array.from_pandas(s)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError):
+        # mixed object columns, e.g. clinvar ints padded with '-' for misses
+        return pa.Array.from_pandas(s.astype(str))
+
+
+def dataframe_to_arrow(df:pd.DataFrame) -> pa.Table:
+    """Arrow table of `df` (index dropped). Duplicate column names are made unique and the original
+    names kept in the schema metadata so that `arrow_to_dataframe` can restore them.
+    """
+    arrays = [_series_to_arrow(df.iloc[:, i]) for i in range(df.shape[1])]
+    table = pa.Table.from_arrays(arrays, names=unique_column_names(df.columns))
+    return table.replace_schema_metadata({COLUMNS_METADATA_KEY: json.dumps([str(c) for c in df.columns])})
+
+
+def arrow_to_dataframe(table:pa.Table) -> pd.DataFrame:
+    df = table.to_pandas()
+    metadata = table.schema.metadata or {}
+    if COLUMNS_METADATA_KEY in metadata:
+        df.columns = json.loads(metadata[COLUMNS_METADATA_KEY])
+    return df
+
+
+def _stable_schema(df:pd.DataFrame, table:pa.Table) -> pa.Schema:
+    """Schema for a whole stream, taken from its first batch. Scalar object columns (the clinvar
+    and rsid columns mix ints with '-' for misses) and all-null columns are always strings, so
+    every later batch can be cast to the same schema whatever values it happens to hold."""
+    fields = []
+    for i, f in enumerate(table.schema):
+        mixed = df.dtypes.iloc[i] == object and not (pa.types.is_list(f.type) or pa.types.is_large_list(f.type))
+        fields.append(pa.field(f.name, pa.string()) if mixed or pa.types.is_null(f.type) else f)
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+
+def _aligned(df:pd.DataFrame, columns:List[str]) -> pd.DataFrame:
+    """`df` with exactly `columns` in that order, missing ones as NA. Works on the unique names,
+    since an annotated result repeats `id`."""
+    if list(df.columns) == columns:
+        return df
+    out = df.set_axis(unique_column_names(df.columns), axis=1).reindex(columns=unique_column_names(columns))
+    out.columns = columns
+    return out
+
+
+def _conform(table:pa.Table, schema:pa.Schema) -> pa.Table:
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        if column.type != field.type:
+            column = column.cast(field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object collecting whatever the arrow/parquet writers emit, so that the
+    bytes can be handed to a streaming response as soon as each batch is written."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        b = bytes(b)
+        self.chunks.append(b)
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        out = b''.join(self.chunks)
+        self.chunks = []
+        return out
+
+
+def iter_export_bytes(frames:Iterable[pd.DataFrame], fmt:str) -> Iterator[bytes]:
+    """Serializes a stream of dataframes into `fmt` (see EXPORT_FORMATS) and yields the encoded
+    bytes batch by batch. Only one batch is held in memory at a time."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'<iter_export_bytes> unknown format {fmt}. Choose from {list(EXPORT_FORMATS)}')
+
+    # the first batch fixes the columns, later batches are aligned to them
+    columns = None
+    if fmt in ('csv', 'tsv'):
+        for df in frames:
+            header = columns is None
+            columns = list(df.columns) if header else columns
+            yield _aligned(df, columns).to_csv(sep=',' if fmt == 'csv' else '\t', header=header, index=False).encode()
+        return
+
+    sink = _ChunkSink()
+    writer = None
+    schema = None
+    try:
+        for df in frames:
+            if columns is None:
+                columns = list(df.columns)
+            df = _aligned(df, columns)
+            table = dataframe_to_arrow(df)
+            if writer is None:
+                schema = _stable_schema(df, table)
+                writer = pa.ipc.new_stream(sink, schema) if fmt == 'arrow' else pq.ParquetWriter(sink, schema)
+            writer.write_table(_conform(table, schema))
+            yield sink.drain()
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.drain()
@@ -0,0 +1,187 @@
+import pandas as pd
+import numpy as np
+from typing import Dict, List
+import subprocess
+import platform
+import shutil
+import json
+import os
+
+from annoquery.models import Clinvars, Genes, Snps, variant_key
+from .regionops import CHR_DICT_STR_TO_INT
+
+BASES = np.array(['A', 'C', 'G', 'T'])
+
+# every n-th synthetic site also gets a ClinVar record
+CLINVAR_EVERY = 10
+
+# synthetic genes cover this many consecutive sites each, with a gap of the same size between genes
+GENE_SITES = 50
+
+# placeholder values of the Clinvars columns the lookups do not care about
+_CLINVAR_FILLER = dict(alleleid=0, type='single nucleotide variant', geneid=0, genesymbol='BENCH',
+                       hgnc_id='HGNC:0', clinicalsignificance='Pathogenic', clinsigsimple=1,
+                       lastevaluated='-', rsid=-1, nsvesv='-', rcvaccession='RCV0', phenotypeids='-',
+                       phenotypelist='-', origin='germline', originsimple='germline', assembly='GRCh38',
+                       chromosomeaccession='-', cytogenetic='-', reviewstatus='-', numbersubmitters=1,
+                       guidelines='-', testedingtr='N', otherids='-', submittercategories=1)
+
+
+def make_sites(variants:int, contig:str='chr1', start:int=1000000, spacing:int=10, multiallelic:float=0.1, seed:int=0) -> pd.DataFrame:
+    """`variants` SNV sites, `spacing` bp apart: pos, ref, alts (list of 1 or 2 alt bases) and
+    the per-alt allele frequencies used to draw the genotypes."""
+    rng = np.random.default_rng(seed)
+    ref_idx = rng.integers(0, 4, variants)
+    shift = rng.integers(1, 4, (variants, 2))
+    alt_idx = (ref_idx[:, None] + np.array([shift[:, 0], (shift[:, 0] % 3) + 1]).T) % 4
+    n_alts = np.where(rng.random(variants) < multiallelic, 2, 1)
+    af = rng.uniform(0.01, 0.5, (variants, 2))
+    return pd.DataFrame(dict(
+        contig=contig,
+        pos=start + np.arange(variants, dtype=np.int64) * spacing,
+        ref=BASES[ref_idx],
+        alts=[list(BASES[alt_idx[i, :n]]) for i, n in enumerate(n_alts)],
+        af=[list(np.round(af[i, :n], 4)) for i, n in enumerate(n_alts)],
+        ))
+
+
+def make_genotypes(sites:pd.DataFrame, samples:int, ploidy:int=2, seed:int=0) -> np.ndarray:
+    """Allele indices as (samples, sites, ploidy) int8, each haplotype drawn from the site's AFs."""
+    rng = np.random.default_rng(seed + 1)
+    af = np.zeros((sites.shape[0], 2))
+    for i, a in enumerate(sites['af']):
+        af[i, :len(a)] = a
+    draw = rng.random((samples, sites.shape[0], ploidy))
+    gt = np.zeros(draw.shape, dtype=np.int8)
+    gt[draw < af[None, :, 0, None]] = 1
+    gt[(draw >= af[None, :, 0, None]) & (draw < (af[:, 0] + af[:, 1])[None, :, None])] = 2
+    return gt
+
+
+def sample_names(samples:int) -> List[str]:
+    return [f'BENCH{i:06d}' for i in range(samples)]
+
+
+def _require_tools(*tools):
+    missing = [t for t in tools if shutil.which(t) is None]
+    if missing:
+        raise RuntimeError(f'<benchops> {",".join(missing)} not found on PATH (htslib is needed to write indexed VCFs).')
+
+
+def write_sample_vcfs(directory:str, sites:pd.DataFrame, genotypes:np.ndarray, names:List[str]) -> List[str]:
+    """One bgzipped, tabix-indexed single-sample VCF per sample, as tiledbvcf ingests them."""
+    _require_tools('bgzip', 'tabix')
+    os.makedirs(directory, exist_ok=True)
+    contig = sites['contig'].iloc[0]
+    length = int(sites['pos'].iloc[-1]) + 1000
+    body_cols = [f'{contig}\t{p}\t.\t{r}\t{",".join(a)}\t50\tPASS\tAF={",".join(map(str, f))}\tGT'
+                 for p, r, a, f in zip(sites['pos'], sites['ref'], sites['alts'], sites['af'])]
+    paths = []
+    for s, name in enumerate(names):
+        path = os.path.join(directory, f'{name}.vcf')
+        gts = ['/'.join(map(str, g)) for g in genotypes[s]]
+        with open(path, 'w') as f:
+            f.write('##fileformat=VCFv4.2\n')
+            f.write(f'##contig=<ID={contig},length={length}>\n')
+            f.write('##INFO=<ID=AF,Number=A,Type=Float,Description="Allele frequency">\n')
+            f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+            f.write(f'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{name}\n')
+            f.writelines(f'{line}\t{gt}\n' for line, gt in zip(body_cols, gts))
+        subprocess.run(['bgzip', '-f', path], check=True)
+        subprocess.run(['tabix', '-f', '-p', 'vcf', f'{path}.gz'], check=True)
+        paths.append(f'{path}.gz')
+    return paths
+
+
+def ingest_dataset(uri:str, paths:List[str], memory_budget_mb:int=1024):
+    import tiledbvcf as tv
+    ds = tv.Dataset(uri, mode='w')
+    ds.create_dataset(extra_attrs=['info_AF'])
+    ds.ingest_samples(paths, total_memory_budget_mb=memory_budget_mb)
+
+
+def synthetic_tiledb_frame(sites:pd.DataFrame, genotypes:np.ndarray, names:List[str], rows:int=None) -> pd.DataFrame:
+    """The dataframe `tiledbvcf.Dataset.read` returns for these sites and samples (sample-major, the
+    ragged columns as numpy arrays), optionally cut to `rows`. Lets the annotation step be measured
+    without a TileDB dataset."""
+    n_samples, n_sites, _ = genotypes.shape
+    n = n_samples * n_sites if rows is None else min(rows, n_samples * n_sites)
+    s_idx, v_idx = np.divmod(np.arange(n), n_sites)
+    alleles = [np.array([r] + a, dtype=object) for r, a in zip(sites['ref'], sites['alts'])]
+    afs = [np.array(a, dtype=np.float32) for a in sites['af']]
+    pos = sites['pos'].to_numpy()
+    return pd.DataFrame(dict(
+        sample_name=np.array(names, dtype=object)[s_idx],
+        id='.',
+        alleles=[alleles[v] for v in v_idx],
+        fmt_GT=[genotypes[s, v].astype(np.int32) for s, v in zip(s_idx, v_idx)],
+        contig=sites['contig'].iloc[0],
+        pos_start=pos[v_idx].astype(np.int32),
+        pos_end=pos[v_idx].astype(np.int32),
+        info_AF=[afs[v] for v in v_idx],
+        ))
+
+
+def seed_annotations(sites:pd.DataFrame, using:str='annodb', batch_size:int=5000) -> Dict[str, int]:
+    """Replaces the Snps, Clinvars and Genes tables of `using` with records for the synthetic sites:
+    a dbSNP rsID for every alt allele, a ClinVar record for every CLINVAR_EVERY-th site and a gene
+    over every other run of GENE_SITES sites."""
+    contig = sites['contig'].iloc[0]
+    chr_int = CHR_DICT_STR_TO_INT[contig]
+    snps, clinvars, genes = [], [], []
+    for i, (pos, ref, alts) in enumerate(zip(sites['pos'], sites['ref'], sites['alts'])):
+        pos = int(pos)
+        for alt in alts:
+            snps.append(Snps(rsid=f'rs{900000000 + len(snps)}', chr=contig, start=pos, stop=pos, ref=ref, alt=alt,
+                             variant_key=variant_key(contig, pos, ref, alt)))
+        if i % CLINVAR_EVERY == 0:
+            alt = alts[0]
+            clinvars.append(Clinvars(name=f'BENCH:c.{pos}{ref}>{alt}', chromosome=str(chr_int), start=pos, stop=pos,
+                                     referenceallele=ref, alternateallele=alt, variationid=i, positionvcf=pos,
+                                     referenceallelevcf=ref, alternateallelevcf=alt, order=float(i),
+                                     variant_key=variant_key(contig, pos, ref, alt), **_CLINVAR_FILLER))
+    positions = sites['pos'].to_numpy()
+    for g, first in enumerate(range(0, len(positions), 2 * GENE_SITES)):
+        last = min(first + GENE_SITES, len(positions)) - 1
+        genes.append(Genes(chromosome=chr_int, source='BENCH', gene_type='gene', start=int(positions[first]),
+                           stop=int(positions[last]), gene=f'BENCHG{g}', product='-'))
+
+    for model, objs in ((Snps, snps), (Clinvars, clinvars), (Genes, genes)):
+        model.objects.using(using).all().delete()
+        model.objects.using(using).bulk_create(objs, batch_size=batch_size)
+    return dict(snps=len(snps), clinvars=len(clinvars), genes=len(genes))
+
+
+def environment_info() -> dict:
+    """Versions and commit the results were measured with, for comparing runs."""
+    info = dict(python=platform.python_version(), machine=platform.machine(), cpus=os.cpu_count(),
+                numpy=np.__version__, pandas=pd.__version__)
+    try:
+        import tiledbvcf
+        info['tiledbvcf'] = tiledbvcf.version
+    except (ImportError, AttributeError):
+        info['tiledbvcf'] = None
+    try:
+        info['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    return info
+
+
+def compare_results(baseline:dict, current:dict, threshold:float=0.2) -> List[dict]:
+    """Scenarios whose median time grew by more than `threshold` (a fraction) over `baseline`."""
+    before = {s['name']: s for s in baseline.get('scenarios', [])}
+    regressions = []
+    for s in current.get('scenarios', []):
+        b = before.get(s['name'])
+        if b is None or not b.get('median_seconds'):
+            continue
+        change = s['median_seconds'] / b['median_seconds'] - 1
+        if change > threshold:
+            regressions.append(dict(name=s['name'], baseline=b['median_seconds'], current=s['median_seconds'], change=round(change, 3)))
+    return regressions
+
+
+def load_results(path:str) -> dict:
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,135 @@
+import pandas as pd
+import numpy as np
+from typing import List, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .regionops import CHR_DICT_STR_TO_INT, Region, assign_rows_to_regions
+
+# the only attributes a carrier scan reads
+CARRIER_ATTRS = ['sample_name', 'id', 'contig', 'pos_start', 'pos_end', 'alleles', 'fmt_GT']
+
+CARRIER_CALL_COLUMNS = ['sample_name', 'id', 'contig', 'pos_start', 'pos_end', 'ref', 'alt_allele', 'copies', 'ploidy']
+
+# carriers listed by name in one row of the variant table, the per-sample table has them all
+CARRIER_LIST_MAX = 1000
+
+
+def flat_list_column(column) -> Tuple[np.ndarray, np.ndarray]:
+    """values+offsets of an Arrow list column, like `genotypeops.ragged_to_flat` but without a
+    Python object per row. Null lists become empty rows."""
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks() if column.num_chunks else pa.array([], type=column.type)
+    lengths = pc.fill_null(pc.list_value_length(column), 0).to_numpy(zero_copy_only=False)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return pc.list_flatten(column).to_numpy(zero_copy_only=False), offsets
+
+
+def carrier_calls(table:pa.Table, regions:List[Region]=None) -> pd.DataFrame:
+    """One row per (record, called alt allele) of a tiledbvcf Arrow batch, with the number of copies
+    called. The GT column is decoded first and every other column is only taken for the carrier
+    records, so 0/0 and ./. records never leave Arrow. With `regions`, records that only lie in the
+    gap between two coalesced regions are dropped."""
+    gt, gt_offsets = flat_list_column(table.column('fmt_GT'))
+    ploidy = np.diff(gt_offsets)
+    rows = np.repeat(np.arange(table.num_rows), ploidy)
+    called = gt > 0
+    if not called.any():
+        return pd.DataFrame(columns=CARRIER_CALL_COLUMNS)
+
+    # (record, allele index) pairs and how many copies of that allele the record carries
+    width = int(gt[called].max()) + 1
+    keys, copies = np.unique(rows[called] * width + gt[called], return_counts=True)
+    carrier_rows, allele_idx = keys // width, keys % width
+
+    record_rows, inverse = np.unique(carrier_rows, return_inverse=True)
+    records = table.select(['sample_name', 'id', 'contig', 'pos_start', 'pos_end']).take(pa.array(record_rows))
+    alleles, allele_offsets = flat_list_column(table.column('alleles').take(pa.array(record_rows)))
+    record_alleles = np.diff(allele_offsets)
+    record_ref = np.full(len(record_rows), np.nan, dtype=object)
+    record_ref[record_alleles > 0] = alleles[allele_offsets[:-1][record_alleles > 0]]
+    ok = allele_idx < record_alleles[inverse]
+    alt = np.full(len(keys), np.nan, dtype=object)
+    alt[ok] = alleles[allele_offsets[inverse[ok]] + allele_idx[ok]]
+
+    calls = pd.DataFrame({name: records.column(name).to_numpy(zero_copy_only=False)[inverse]
+                          for name in records.column_names})
+    calls['ref'] = record_ref[inverse]
+    calls['alt_allele'] = alt
+    calls['copies'] = copies
+    calls['ploidy'] = ploidy[carrier_rows]
+    if regions:
+        calls = calls.loc[pd.notna(assign_rows_to_regions(calls, regions))]
+    return calls.reset_index(drop=True)
+
+
+def _joined(values:np.ndarray, codes:np.ndarray, n:int, limit:int=None) -> np.ndarray:
+    """','-joined `values` per code 0..n-1, `values` sorted by code. Lists longer than `limit` are
+    cut and end with '+<rest>'."""
+    bounds = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=n), out=bounds[1:])
+    out = np.empty(n, dtype=object)
+    for i in range(n):
+        part = values[bounds[i]:bounds[i + 1]]
+        if limit and len(part) > limit:
+            out[i] = ','.join(part[:limit]) + f',+{len(part) - limit}'
+        else:
+            out[i] = ','.join(part)
+    return out
+
+
+class CarrierScan:
+    """Accumulates `carrier_calls` over the batches of a sample-major scan and aggregates them into
+    a variant table (carriers per variant) and a sample table (variants per carrier). Only the
+    carrier calls are kept, so memory follows the number of carriers, not samples x sites."""
+
+    def __init__(self, samples_scanned:int, regions:List[Region]=None):
+        self.samples_scanned = samples_scanned
+        self.regions = regions
+        self.parts = []
+        self.records_read = 0
+
+    def add(self, table:pa.Table) -> int:
+        self.records_read += table.num_rows
+        calls = carrier_calls(table, self.regions)
+        if calls.shape[0]:
+            self.parts.append(calls)
+        return calls.shape[0]
+
+    def calls(self) -> pd.DataFrame:
+        if not self.parts:
+            return pd.DataFrame(columns=CARRIER_CALL_COLUMNS)
+        return pd.concat(self.parts, ignore_index=True)
+
+    def tables(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """(variant table, sample table)."""
+        calls = self.calls()
+        calls['variant'] = (calls['contig'].astype(str) + ':' + calls['pos_start'].astype(str) + ':'
+                            + calls['ref'].astype(str) + '>' + calls['alt_allele'].astype(str))
+        homozygous = (calls['copies'] == calls['ploidy']).to_numpy()
+        v_codes, v_names = pd.factorize(calls['variant'], sort=False)
+        s_codes, s_names = pd.factorize(calls['sample_name'], sort=True)
+        n_v, n_s = len(v_names), len(s_names)
+
+        first = np.unique(v_codes, return_index=True)[1] if n_v else np.empty(0, dtype=np.int64)
+        variants = calls.iloc[first].loc[:, ['contig', 'pos_start', 'pos_end', 'id', 'ref', 'alt_allele', 'variant']].reset_index(drop=True)
+        carriers = np.bincount(v_codes, minlength=n_v)
+        variants['carriers'] = carriers
+        variants['homozygous'] = np.bincount(v_codes, weights=homozygous, minlength=n_v).astype(np.int64)
+        variants['heterozygous'] = carriers - variants['homozygous']
+        variants['carrier_frequency'] = np.round(carriers / self.samples_scanned, 6) if self.samples_scanned else np.nan
+        by_variant = np.lexsort((s_codes, v_codes))
+        variants['samples'] = _joined(s_names.to_numpy(dtype=object)[s_codes[by_variant]], v_codes[by_variant], n_v, CARRIER_LIST_MAX)
+
+        by_sample = np.lexsort((v_codes, s_codes))
+        samples = pd.DataFrame(dict(sample_name=s_names.to_numpy(dtype=object)))
+        samples['variants'] = np.bincount(s_codes, minlength=n_s)
+        samples['homozygous'] = np.bincount(s_codes, weights=homozygous, minlength=n_s).astype(np.int64)
+        samples['heterozygous'] = samples['variants'] - samples['homozygous']
+        samples['carried'] = _joined(v_names.to_numpy(dtype=object)[v_codes[by_sample]], s_codes[by_sample], n_s)
+
+        variants['chr_int'] = variants['contig'].map(CHR_DICT_STR_TO_INT)
+        variants = variants.sort_values(['chr_int', 'pos_start', 'alt_allele'], kind='stable').reset_index(drop=True)
+        return variants, samples
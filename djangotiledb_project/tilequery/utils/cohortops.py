@@ -0,0 +1,60 @@
+from typing import List, Tuple
+import re
+
+from django.db.models import Q
+
+from tilequery.models import Cohort
+
+# samples field tokens starting with this refer to a Cohort by name
+COHORT_PREFIX = 'cohort:'
+
+COHORT_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+# splits a pasted sample list on commas, whitespace and semicolons
+SAMPLE_LIST_SEPARATORS = re.compile(r'[\s,;]+')
+
+
+def is_cohort_token(token:str) -> bool:
+    return token.strip().lower().startswith(COHORT_PREFIX)
+
+
+def parse_sample_list(text:str) -> List[str]:
+    return [s for s in SAMPLE_LIST_SEPARATORS.split(text) if s]
+
+
+def visible_cohorts(user):
+    """The user's own cohorts and the ones other users shared."""
+    return Cohort.objects.filter(Q(owner=user) | Q(shared=True)).select_related('owner')
+
+
+def resolve_cohort(name:str, user) -> Cohort:
+    """The user's own cohort called `name`, else the oldest shared one, else None."""
+    own = Cohort.objects.filter(owner=user, name=name).first()
+    if own is not None:
+        return own
+    return Cohort.objects.filter(name=name, shared=True).order_by('created').first()
+
+
+def expand_sample_tokens(tokens:List[str], user) -> Tuple[List[str], List[str], List[str]]:
+    """Replaces `cohort:<name>` tokens by the cohort's samples.
+
+    Returns (samples for the tiledb read, samples for the cache key, unresolved cohort tokens).
+    In the cache key list each cohort is a single `cohort:<digest>` entry instead of its samples,
+    so repeated cohort queries hash a short key whichever name they were asked by."""
+    samples, key_samples, unresolved = [], [], []
+    for token in tokens:
+        token = token.strip()
+        if not is_cohort_token(token):
+            samples.append(token)
+            key_samples.append(token)
+            continue
+        cohort = resolve_cohort(token[len(COHORT_PREFIX):].strip(), user)
+        if cohort is None or cohort.sample_count == 0:
+            unresolved.append(token)
+            continue
+        samples.extend(cohort.samples)
+        key_samples.append(f'{COHORT_PREFIX}{cohort.digest}')
+    if any(is_cohort_token(k) for k in key_samples):
+        # a blank field means every sample, which must not widen a cohort query
+        samples = [s for s in samples if s]
+    return list(dict.fromkeys(samples)), key_samples, unresolved
@@ -0,0 +1,113 @@
+from typing import List, NamedTuple
+import threading
+import hashlib
+import logging
+import json
+import time
+import os
+
+from .datasetpool import dataset_version, get_dataset
+
+logger = logging.getLogger('django')
+
+# how often (seconds) the served metadata is compared with the dataset version
+DATASET_METADATA_CHECK_INTERVAL_SECONDS = 60
+
+# remote datasets have no cheap version stamp, their metadata is refreshed on this period instead
+DATASET_METADATA_REMOTE_MAX_AGE_SECONDS = 3600
+
+# bump when the cache file layout changes, older files are then ignored
+DATASET_METADATA_FORMAT = 1
+
+
+class DatasetMetadata(NamedTuple):
+    uri: str
+    version: object
+    attributes: List[str]
+    samples: List[str]
+    loaded_at: float
+
+
+class DatasetMetadataService:
+    """Attributes and sample names of a TileDB-VCF dataset, loaded on first use instead of at import.
+
+    The result is kept in memory and in `<cache_dir>/dataset_<sha1(uri)>.json` together with the
+    dataset version (see `dataset_version`), so a new worker reads the file instead of listing every
+    sample. When the dataset version moves (new samples ingested) the old metadata keeps being served
+    while one background thread reloads it.
+    """
+
+    def __init__(self, uri:str, memory_budget_mb:int, cache_dir:str):
+        self.uri = uri
+        self.memory_budget_mb = memory_budget_mb
+        self.cache_dir = cache_dir
+        self.metadata = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    @property
+    def cache_path(self) -> str:
+        return os.path.join(self.cache_dir, f'dataset_{hashlib.sha1(self.uri.encode()).hexdigest()}.json')
+
+    def _read_cache_file(self):
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('format') != DATASET_METADATA_FORMAT or data.get('uri') != self.uri:
+            return None
+        return DatasetMetadata(data['uri'], data['version'], data['attributes'], data['samples'], data['loaded_at'])
+
+    def _write_cache_file(self, metadata:DatasetMetadata):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = f'{self.cache_path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(metadata._asdict(), format=DATASET_METADATA_FORMAT), f)
+        os.replace(tmp, self.cache_path)
+
+    def _load_from_dataset(self) -> DatasetMetadata:
+        version = dataset_version(self.uri)
+        ds = get_dataset(self.uri, self.memory_budget_mb)
+        metadata = DatasetMetadata(self.uri, version, list(ds.attributes()), list(ds.samples()), time.time())
+        logger.info(f'DatasetMetadataService: loaded {len(metadata.samples)} samples of {self.uri} (version={version})')
+        try:
+            self._write_cache_file(metadata)
+        except OSError:
+            logger.exception('DatasetMetadataService: could not write the cache file')
+        return metadata
+
+    def _is_current(self, metadata:DatasetMetadata) -> bool:
+        version = dataset_version(self.uri)
+        if version is None:
+            return (time.time() - metadata.loaded_at) < DATASET_METADATA_REMOTE_MAX_AGE_SECONDS
+        return version == metadata.version
+
+    def _refresh_in_background(self):
+        def refresh():
+            try:
+                metadata = self._load_from_dataset()
+                with self.lock:
+                    self.metadata = metadata
+            except Exception:
+                logger.exception('DatasetMetadataService: background refresh failed')
+            finally:
+                with self.lock:
+                    self.refreshing = False
+        self.refreshing = True
+        threading.Thread(target=refresh, name='dataset-metadata-refresh', daemon=True).start()
+
+    def get(self) -> DatasetMetadata:
+        with self.lock:
+            if self.metadata is None:
+                metadata = self._read_cache_file()
+                if metadata is None or not self._is_current(metadata):
+                    metadata = self._load_from_dataset()
+                self.metadata = metadata
+                self.checked = time.monotonic()
+            elif (time.monotonic() - self.checked) > DATASET_METADATA_CHECK_INTERVAL_SECONDS:
+                self.checked = time.monotonic()
+                if not self.refreshing and not self._is_current(self.metadata):
+                    self._refresh_in_background()
+            return self.metadata
@@ -0,0 +1,92 @@
+import threading
+import logging
+import time
+import os
+
+import tiledbvcf as tv
+
+logger = logging.getLogger('django')
+
+# how often (seconds) an open handle re-checks the dataset for new fragments.
+DATASET_REFRESH_INTERVAL_SECONDS = 30
+
+# sub-directories of a TileDB-VCF dataset whose contents change when samples are ingested.
+_VERSIONED_PATHS = ['data/__fragments', 'data', 'metadata/vcf_headers/__fragments', 'metadata']
+
+
+def dataset_version(uri:str):
+    """Cheap version stamp of a local dataset: the newest mtime among the fragment directories.
+    New fragments are written as new directory entries, so the parent mtime moves forward on every
+    ingest. Returns None for remote (s3://, tiledb://) uris, which are then never reopened.
+    """
+    if '://' in uri and not uri.startswith('file://'):
+        return None
+    root = uri[len('file://'):] if uri.startswith('file://') else uri
+    mtimes = []
+    for p in _VERSIONED_PATHS:
+        try:
+            mtimes.append(os.stat(os.path.join(root, p)).st_mtime_ns)
+        except OSError:
+            continue
+    return max(mtimes) if mtimes else None
+
+
+class _DatasetHandle:
+    def __init__(self, uri:str, memory_budget_mb:int):
+        self.uri = uri
+        self.memory_budget_mb = memory_budget_mb
+        self.version = dataset_version(uri)
+        self.checked = time.monotonic()
+        cfg = tv.ReadConfig(memory_budget_mb=memory_budget_mb)
+        self.ds = tv.Dataset(uri, mode='r', cfg=cfg, verbose=False)
+        logger.info(f'DatasetPool: opened {uri} (version={self.version}, memory_budget_mb={memory_budget_mb})')
+
+    def is_stale(self) -> bool:
+        now = time.monotonic()
+        if (now - self.checked) < DATASET_REFRESH_INTERVAL_SECONDS:
+            return False
+        self.checked = now
+        return dataset_version(self.uri) != self.version
+
+
+class DatasetPool:
+    """Keeps one open `tv.Dataset` reader per (thread, uri, memory budget) and hands it out
+    across requests, so array schema and fragment metadata are only loaded once per worker thread.
+
+    TileDB-VCF readers are stateful (incomplete reads, buffers) and not safe to share between
+    threads, hence the thread-local storage. A handle is reopened lazily when the dataset version
+    changes, i.e. new fragments were ingested.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _handles(self) -> dict:
+        if not hasattr(self._local, 'handles'):
+            self._local.handles = {}
+        return self._local.handles
+
+    def get(self, uri:str, memory_budget_mb:int) -> tv.Dataset:
+        handles = self._handles()
+        key = (uri, memory_budget_mb)
+        handle = handles.get(key)
+        if handle is None or handle.is_stale():
+            handle = _DatasetHandle(uri, memory_budget_mb)
+            handles[key] = handle
+        return handle.ds
+
+    def version(self, uri:str, memory_budget_mb:int):
+        """Version stamp of the handle currently served for `uri`, opening it if needed."""
+        self.get(uri, memory_budget_mb)
+        return self._handles()[(uri, memory_budget_mb)].version
+
+    def discard(self, uri:str, memory_budget_mb:int):
+        """Drop this thread's handle, e.g. after a read failed and left the reader in a bad state."""
+        self._handles().pop((uri, memory_budget_mb), None)
+
+
+DATASET_POOL = DatasetPool()
+
+
+def get_dataset(uri:str, memory_budget_mb:int) -> tv.Dataset:
+    return DATASET_POOL.get(uri, memory_budget_mb)
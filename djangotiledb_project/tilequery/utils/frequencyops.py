@@ -0,0 +1,173 @@
+import pandas as pd
+import numpy as np
+from typing import List
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .carrierops import flat_list_column
+from .regionops import CHR_DICT_STR_TO_INT, Region, assign_rows_to_regions
+
+# the only attributes an allele frequency aggregation reads
+FREQUENCY_ATTRS = ['contig', 'pos_start', 'pos_end', 'alleles', 'fmt_GT']
+
+# per-site genotype counters, in the row order of AlleleFrequencyAggregator.site_counts
+SITE_COUNTERS = ('records', 'an', 'hom_ref', 'partial', 'missing')
+
+# bumped whenever the columns or the counting of `AlleleFrequencyAggregator.table` change. Part of
+# the result cache key, so no table of an older version is served.
+FREQUENCY_TABLE_VERSION = 2
+
+
+def _encoded(column):
+    """(int codes, dictionary values) of an Arrow string column, so only the distinct values become
+    Python objects."""
+    encoded = pc.dictionary_encode(pc.fill_null(column, ''))
+    if isinstance(encoded, pa.ChunkedArray):
+        encoded = encoded.combine_chunks() if encoded.num_chunks else pa.array([], type=pa.string()).dictionary_encode()
+    return (encoded.indices.to_numpy(zero_copy_only=False).astype(np.int64),
+            encoded.dictionary.to_numpy(zero_copy_only=False))
+
+
+def _grow(array:np.ndarray, n:int) -> np.ndarray:
+    if array.shape[-1] >= n:
+        return array
+    grown = np.zeros(array.shape[:-1] + (max(n, 2 * array.shape[-1]),), dtype=array.dtype)
+    grown[..., :array.shape[-1]] = array
+    return grown
+
+
+class AlleleFrequencyAggregator:
+    """Per-variant AC/AN/AF, genotype class counts and missingness over the batches of a tiledbvcf
+    read, accumulated in numpy arrays indexed by site and by variant. Each batch is reduced to its
+    distinct sites before touching the totals, so memory follows the number of sites, not
+    sites x samples.
+
+    A site is (contig, pos_start, ref); each alt allele called at it is a variant. Every sample record
+    at the site falls in exactly one class for each variant X, so the classes add up to `records`:
+    `missing` when no allele is called, `partial` when some but not all alleles are called (0/., 1/.),
+    and for fully called records `hom_ref` (all ref), `hom_alt` (all X), `het` (X and another allele)
+    or `other_alt` (no X, some other alt, e.g. 0/2 or 2/2 for X=1)."""
+
+    def __init__(self, samples_scanned:int=None):
+        self.samples_scanned = samples_scanned
+        self.site_index = {}
+        self.site_keys = []
+        self.site_counts = np.zeros((len(SITE_COUNTERS), 1024), dtype=np.int64)
+        self.site_end = np.zeros(1024, dtype=np.int64)
+        self.variant_index = {}
+        self.variant_keys = []
+        self.variant_ac = np.zeros(1024, dtype=np.int64)
+        self.variant_het = np.zeros(1024, dtype=np.int64)
+        self.variant_hom = np.zeros(1024, dtype=np.int64)
+        self.records_read = 0
+
+    def _global_ids(self, index:dict, keys:list, local_keys) -> np.ndarray:
+        ids = np.empty(len(local_keys), dtype=np.int64)
+        for i, key in enumerate(local_keys):
+            g = index.get(key)
+            if g is None:
+                g = index[key] = len(keys)
+                keys.append(key)
+            ids[i] = g
+        return ids
+
+    def add(self, table:pa.Table):
+        n = table.num_rows
+        self.records_read += n
+        if not n:
+            return
+
+        # sites of this batch: (contig, pos_start, ref) with the strings dictionary-encoded
+        contig_codes, contigs = _encoded(table.column('contig'))
+        ref_codes, refs = _encoded(pc.list_element(table.column('alleles'), 0))
+        pos = table.column('pos_start').to_numpy().astype(np.int64)
+        end = table.column('pos_end').to_numpy().astype(np.int64)
+        local_key = (contig_codes * (len(refs) + 1) + ref_codes) * (1 << 32) + pos
+        local_sites, row_site = np.unique(local_key, return_inverse=True)
+        first = np.zeros(len(local_sites), dtype=np.int64)
+        first[row_site[::-1]] = np.arange(n)[::-1]
+        site_ids = self._global_ids(self.site_index, self.site_keys,
+                                    list(zip(contigs[contig_codes[first]], pos[first].tolist(), refs[ref_codes[first]])))
+        n_sites = len(self.site_keys)
+        self.site_counts = _grow(self.site_counts, n_sites)
+        self.site_end = _grow(self.site_end, n_sites)
+        row_global = site_ids[row_site]
+        np.maximum.at(self.site_end, row_global, end)
+
+        # site-level classes of every record, from the flat GT values
+        gt, gt_offsets = flat_list_column(table.column('fmt_GT'))
+        ploidy = np.diff(gt_offsets)
+        rows = np.repeat(np.arange(n), ploidy)
+        n_called = np.bincount(rows, weights=gt >= 0, minlength=n).astype(np.int64)
+        n_ref = np.bincount(rows, weights=gt == 0, minlength=n).astype(np.int64)
+        missing = n_called == 0
+        partial = ~missing & (n_called < ploidy)
+        hom_ref = ~missing & ~partial & (n_ref == ploidy)
+        for i, values in enumerate((np.ones(n), n_called, hom_ref, partial, missing)):
+            self.site_counts[i, :n_sites] += np.bincount(row_global, weights=values, minlength=n_sites).astype(np.int64)
+
+        # alt allele counts: every called allele > 0 counts towards its alt string at the site
+        alt_calls = gt > 0
+        if not alt_calls.any():
+            return
+        allele_codes, allele_values = _encoded(pc.list_flatten(table.column('alleles')))
+        _, allele_offsets = flat_list_column(table.column('alleles'))
+        call_rows, call_idx = rows[alt_calls], gt[alt_calls]
+        known = call_idx < np.diff(allele_offsets)[call_rows]
+        call_rows, call_idx = call_rows[known], call_idx[known]
+        call_alt = allele_codes[allele_offsets[call_rows] + call_idx]
+        local_variant = row_site[call_rows] * (len(allele_values) + 1) + call_alt
+        local_variants, call_variant = np.unique(local_variant, return_inverse=True)
+        variant_site = local_variants // (len(allele_values) + 1)
+        variant_alt = local_variants % (len(allele_values) + 1)
+        variant_ids = self._global_ids(self.variant_index, self.variant_keys,
+                                       list(zip(site_ids[variant_site].tolist(), allele_values[variant_alt])))
+        n_variants = len(self.variant_keys)
+        self.variant_ac = _grow(self.variant_ac, n_variants)
+        self.variant_het = _grow(self.variant_het, n_variants)
+        self.variant_hom = _grow(self.variant_hom, n_variants)
+        self.variant_ac[:n_variants] += np.bincount(variant_ids[call_variant], minlength=n_variants)
+
+        # copies of each variant per fully called record: all copies is hom_alt, fewer is het
+        pairs, copies = np.unique(call_rows * len(local_variants) + call_variant, return_counts=True)
+        pair_rows, pair_variant = pairs // len(local_variants), pairs % len(local_variants)
+        full = n_called[pair_rows] == ploidy[pair_rows]
+        hom = full & (copies == ploidy[pair_rows])
+        pair_global = variant_ids[pair_variant]
+        self.variant_het[:n_variants] += np.bincount(pair_global, weights=full & ~hom, minlength=n_variants).astype(np.int64)
+        self.variant_hom[:n_variants] += np.bincount(pair_global, weights=hom, minlength=n_variants).astype(np.int64)
+
+    def table(self, regions:List[Region]=None) -> pd.DataFrame:
+        """One row per variant, plus one row (alt_allele None) for sites where no alt was called.
+        With `regions`, sites that only lie in the gap between two coalesced regions are dropped."""
+        n_sites = len(self.site_keys)
+        sites = pd.DataFrame(self.site_keys, columns=['contig', 'pos_start', 'ref'])
+        sites['pos_end'] = self.site_end[:n_sites]
+        for i, name in enumerate(SITE_COUNTERS):
+            sites[name] = self.site_counts[i, :n_sites]
+        if self.samples_scanned is not None:
+            sites['no_record'] = np.maximum(self.samples_scanned - sites['records'].to_numpy(), 0)
+
+        n_variants = len(self.variant_keys)
+        variant_site = np.array([s for s, _ in self.variant_keys], dtype=np.int64)
+        variants = sites.iloc[variant_site].reset_index(drop=True)
+        variants['alt_allele'] = [a for _, a in self.variant_keys]
+        variants['ac'] = self.variant_ac[:n_variants]
+        variants['het'] = self.variant_het[:n_variants]
+        variants['hom_alt'] = self.variant_hom[:n_variants]
+        no_alt = sites.loc[~np.isin(np.arange(n_sites), variant_site)].copy()
+        no_alt['alt_allele'] = None
+        for name in ('ac', 'het', 'hom_alt'):
+            no_alt[name] = 0
+        df = pd.concat([variants, no_alt], ignore_index=True)
+        df['other_alt'] = df['records'] - df['hom_ref'] - df['het'] - df['hom_alt'] - df['partial'] - df['missing']
+
+        an = df['an'].to_numpy(dtype=np.float64)
+        df['af'] = np.round(np.divide(df['ac'].to_numpy(dtype=np.float64), an, out=np.full(len(an), np.nan), where=an > 0), 6)
+        df['chr_int'] = df['contig'].map(CHR_DICT_STR_TO_INT)
+        if regions and df.shape[0]:
+            df = df.loc[pd.notna(assign_rows_to_regions(df, regions))]
+        columns = ['contig', 'pos_start', 'pos_end', 'ref', 'alt_allele', 'ac', 'an', 'af',
+                   'records', 'hom_ref', 'het', 'hom_alt', 'other_alt', 'partial', 'missing'] + (['no_record'] if self.samples_scanned is not None else []) + ['chr_int']
+        return df.sort_values(['chr_int', 'pos_start', 'ref', 'alt_allele'], kind='stable').loc[:, columns].reset_index(drop=True)
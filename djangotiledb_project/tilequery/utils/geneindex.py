@@ -0,0 +1,97 @@
+import pandas as pd
+import numpy as np
+from typing import Dict, Tuple
+import threading
+import logging
+import time
+import re
+
+from .annotationbackends import get_annotation_backend
+
+logger = logging.getLogger('django')
+
+# how often (seconds) a worker re-checks the Genes table version. Between checks the
+# in-memory index is trusted as-is.
+GENE_INDEX_CHECK_INTERVAL_SECONDS = 60
+
+
+class GeneIntervalIndex:
+    """In-process interval index over `annoquery.Genes`.
+
+    Per chromosome the genes are kept as NumPy arrays sorted by start. A query interval
+    [start, stop] hits every gene with gene.start <= start and gene.stop >= stop, which is
+    the same containment test the old per-row ORM filter used. Candidates are bounded with
+    two `searchsorted` calls: genes starting before `stop - max_gene_length` cannot reach `stop`.
+    """
+
+    def __init__(self, genes:pd.DataFrame, version:Tuple=None):
+        self.version = version
+        self.chromosomes:Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray, int]] = {}
+        for chromosome, g in genes.groupby('chromosome', sort=False):
+            g = g.sort_values('start', kind='stable')
+            starts = g['start'].to_numpy(dtype=np.int64)
+            stops = g['stop'].to_numpy(dtype=np.int64)
+            names = g['gene'].to_numpy(dtype=object)
+            max_len = int((stops - starts).max()) if len(starts) else 0
+            self.chromosomes[int(chromosome)] = (starts, stops, names, max_len)
+
+    @classmethod
+    def from_backend(cls, backend, version:Tuple=None) -> 'GeneIntervalIndex':
+        genes = backend.load_genes()
+        genes['gene'] = [re.sub(r'^gene\=', '', f'{g}') for g in genes['gene']]
+        logger.info(f'GeneIntervalIndex: loaded {genes.shape[0]} genes from {backend.name}')
+        return cls(genes, version=version)
+
+    def lookup(self, chromosomes, starts, stops) -> np.ndarray:
+        """Vectorized overlap lookup. Returns an object array aligned to the inputs holding the
+        ';'-joined unique gene names for every hit, or np.nan when no gene contains the interval.
+        """
+        chromosomes = pd.Series(chromosomes).to_numpy()
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        result = np.full(len(starts), np.nan, dtype=object)
+
+        for chromosome in pd.unique(chromosomes):
+            if pd.isna(chromosome) or int(chromosome) not in self.chromosomes:
+                continue
+            g_starts, g_stops, g_names, max_len = self.chromosomes[int(chromosome)]
+            rows = np.flatnonzero(chromosomes == chromosome)
+            q_starts, q_stops = starts[rows], stops[rows]
+
+            lo = np.searchsorted(g_starts, q_stops - max_len, side='left')
+            hi = np.searchsorted(g_starts, q_starts, side='right')
+            counts = np.maximum(hi - lo, 0)
+            if not counts.sum():
+                continue
+
+            # flatten every (query, candidate gene) pair and keep the ones that contain the query
+            query_idx = np.repeat(np.arange(len(rows)), counts)
+            gene_idx = np.repeat(lo, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+            hit = g_stops[gene_idx] >= q_stops[query_idx]
+            query_idx, gene_idx = query_idx[hit], gene_idx[hit]
+
+            for q, names in pd.Series(g_names[gene_idx]).groupby(query_idx):
+                result[rows[q]] = ';'.join(sorted(set(names)))
+
+        return result
+
+
+_gene_index = None
+_gene_index_checked = 0.0
+_gene_index_lock = threading.Lock()
+
+
+def get_gene_index() -> GeneIntervalIndex:
+    """Process-wide GeneIntervalIndex, loaded from the annotation backend on first use and rebuilt
+    when its genes version changes. The version is checked at most every GENE_INDEX_CHECK_INTERVAL_SECONDS.
+    """
+    global _gene_index, _gene_index_checked
+    with _gene_index_lock:
+        now = time.monotonic()
+        if _gene_index is None or (now - _gene_index_checked) > GENE_INDEX_CHECK_INTERVAL_SECONDS:
+            backend = get_annotation_backend()
+            version = backend.genes_version()
+            if _gene_index is None or _gene_index.version != version:
+                _gene_index = GeneIntervalIndex.from_backend(backend, version=version)
+            _gene_index_checked = now
+        return _gene_index
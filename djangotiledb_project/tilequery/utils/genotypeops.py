@@ -1,10 +1,122 @@
 import pandas as pd
 import numpy as np
+from typing import Tuple
 
-def rowloop_index_a_with_b(s:pd.Series, a_label, b_label, subtract_one=False):    
-    """Usually in the context of `df.apply(thisfunc, axis=1)`, is expecting a pandas row-series and will take the unique nonzero genotype reference numbers (`b_label`) and index the allele list (`a_label`)"""
-    nonzeros = list(set(s.loc[b_label][np.flatnonzero(s.loc[b_label])]) - set([-1]))
-    if len(nonzeros):        
-        return s.loc[a_label][np.subtract(nonzeros, 1 if subtract_one else 0)]
+
+def _ragged_length(x) -> int:
+    if x is None:
+        return 0
+    if np.ndim(x) == 0:
+        return 0 if pd.isna(x) else 1
+    return len(x)
+
+
+def ragged_to_flat(s:pd.Series, dtype=None) -> Tuple[np.ndarray, np.ndarray]:
+    """Turns a series of variable-length arrays (as returned by tiledbvcf for `fmt_GT`, `alleles`,
+    `info_AF`...) into one flat `values` array plus `offsets`, so that row i is
+    `values[offsets[i]:offsets[i+1]]`. Missing cells (None/NaN) become empty rows.
+    """
+    items = s.to_numpy(dtype=object)
+    lengths = np.fromiter((_ragged_length(x) for x in items), dtype=np.int64, count=len(items))
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    parts = [np.atleast_1d(x) for x, n in zip(items, lengths) if n]
+    if parts:
+        values = np.concatenate(parts)
+        if dtype is not None:
+            values = values.astype(dtype, copy=False)
     else:
-        return np.nan
\ No newline at end of file
+        values = np.empty(0, dtype=dtype if dtype is not None else object)
+    return values, offsets
+
+
+class ColumnarGenotypes:
+    """Columnar view of the genotype related columns of a tiledbvcf result.
+
+    The ragged `fmt_GT`, `alleles` and `info_AF` columns are flattened once into values+offsets
+    arrays; everything else is plain array arithmetic, for any ploidy.
+    """
+
+    def __init__(self, gt:pd.Series, alleles:pd.Series=None, af:pd.Series=None):
+        self.n = len(gt)
+        self.gt, self.gt_offsets = ragged_to_flat(gt, dtype=np.int64)
+        self.gt_rows = np.repeat(np.arange(self.n), np.diff(self.gt_offsets))
+        self.alleles = ragged_to_flat(alleles) if alleles is not None else None
+        self.af = ragged_to_flat(af, dtype=np.float64) if af is not None else None
+
+    @classmethod
+    def from_dataframe(cls, df:pd.DataFrame, genotype_label='fmt_GT', allele_label='alleles', af_label='info_AF'):
+        return cls(df.loc[:, genotype_label],
+                   df.loc[:, allele_label] if allele_label in df.columns else None,
+                   df.loc[:, af_label] if af_label in df.columns else None)
+
+    def variant_mask(self) -> np.ndarray:
+        """False for rows whose calls are all reference (0) or all missing (-1), True otherwise."""
+        ploidy = np.diff(self.gt_offsets)
+        n_ref = np.bincount(self.gt_rows, weights=(self.gt == 0), minlength=self.n)
+        n_missing = np.bincount(self.gt_rows, weights=(self.gt == -1), minlength=self.n)
+        return ~((n_ref == ploidy) | (n_missing == ploidy))
+
+    def alt_allele_indices(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Unique non-reference, non-missing allele indices called in every row, as two aligned
+        arrays `(rows, allele_index)` sorted by row then allele index.
+        """
+        called = self.gt > 0
+        rows, idx = self.gt_rows[called], self.gt[called]
+        if not len(idx):
+            return rows, idx
+        width = int(idx.max()) + 1
+        keys = np.unique(rows * width + idx)
+        return keys // width, keys % width
+
+    @staticmethod
+    def _take(flat, rows:np.ndarray, idx:np.ndarray) -> np.ndarray:
+        values, offsets = flat
+        lengths = offsets[rows + 1] - offsets[rows]
+        valid = (idx >= 0) & (idx < lengths)
+        out = np.full(len(rows), np.nan, dtype=object)
+        out[valid] = values[offsets[rows[valid]] + idx[valid]]
+        return out
+
+    def alt_alleles(self, rows:np.ndarray, idx:np.ndarray) -> np.ndarray:
+        if self.alleles is None:
+            return np.full(len(rows), np.nan, dtype=object)
+        return self._take(self.alleles, rows, idx)
+
+    def alt_afs(self, rows:np.ndarray, idx:np.ndarray) -> np.ndarray:
+        """`info_AF` is Number=A, i.e. it has no entry for the reference allele, hence the -1."""
+        if self.af is None:
+            return np.full(len(rows), np.nan, dtype=object)
+        return self._take(self.af, rows, idx - 1)
+
+
+def explode_alt_alleles(df:pd.DataFrame,
+                        genotype_label='fmt_GT',
+                        allele_label='alleles',
+                        af_label='info_AF',
+                        show_only_alt=True,
+                        ) -> pd.DataFrame:
+    """One output row per called alt allele, with the `alt_allele` and `alt_af` columns appended.
+    Rows without any alt call are dropped when `show_only_alt`, otherwise kept once with NaN.
+    """
+    cg = ColumnarGenotypes.from_dataframe(df, genotype_label, allele_label, af_label)
+    rows, idx = cg.alt_allele_indices()
+    alt_allele = cg.alt_alleles(rows, idx)
+    alt_af = cg.alt_afs(rows, idx)
+
+    if not show_only_alt:
+        no_alt = np.setdiff1d(np.arange(cg.n), rows)
+        order = np.argsort(np.concatenate([rows, no_alt]), kind='stable')
+        rows = np.concatenate([rows, no_alt])[order]
+        alt_allele = np.concatenate([alt_allele, np.full(len(no_alt), np.nan, dtype=object)])[order]
+        alt_af = np.concatenate([alt_af, np.full(len(no_alt), np.nan, dtype=object)])[order]
+
+    out = df.iloc[rows].reset_index(drop=True)
+    out['alt_allele'] = alt_allele
+    out['alt_af'] = alt_af
+    return out
+
+
+def filter_genotype_to_variants_only_output_mask(s:pd.Series) -> np.ndarray:
+    """Boolean mask over a `fmt_GT` series keeping rows with at least one non-reference call."""
+    return ColumnarGenotypes(s).variant_mask()
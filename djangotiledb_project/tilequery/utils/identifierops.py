@@ -0,0 +1,95 @@
+from typing import Dict, List, Tuple
+import logging
+import re
+
+from django.db.models.functions import Upper
+
+from annoquery.models import Genes, Snps
+from .annotationops import chunked, annotation_data_version
+from .annotationcache import VersionedLRUCache
+from .regionops import CHR_DICT_STR_TO_INT, Region
+
+logger = logging.getLogger('django')
+
+CHR_DICT_INT_TO_STR = {v: k for k, v in CHR_DICT_STR_TO_INT.items()}
+
+RSID_PATTERN = re.compile(r'^rs\d+$', re.IGNORECASE)
+
+# max identifiers remembered per worker, including the ones that did not resolve
+IDENTIFIER_CACHE_SIZE = 20000
+
+
+# identifier -> list of region strings, cleared whenever the annotation tables change version
+_cache = VersionedLRUCache(IDENTIFIER_CACHE_SIZE)
+
+
+def is_region(token:str) -> bool:
+    return ':' in token
+
+
+def _lookup_gene_symbols(symbols:List[str]) -> Dict[str, List[str]]:
+    """One `upper(gene) IN` query per chunk against the upper-cased Genes.gene index, so symbols
+    match whatever their case (e.g. C9orf72, c9orf72). Genes rows may carry the raw `gene=` GFF
+    prefix, so both spellings are asked for."""
+    wanted = {}
+    for s in symbols:
+        wanted.setdefault(s.upper(), set()).add(s)
+    found = {s: [] for s in symbols}
+    names = list(wanted) + [f'GENE={n}' for n in wanted]
+    genes = Genes.objects.annotate(gene_upper=Upper('gene'))
+    for chunk in chunked(names):
+        for chromosome, start, stop, gene in genes.filter(gene_upper__in=chunk).values_list('chromosome', 'start', 'stop', 'gene_upper'):
+            contig = CHR_DICT_INT_TO_STR.get(chromosome)
+            if contig is None:
+                continue
+            for s in wanted.get(re.sub(r'^GENE\=', '', gene), ()):
+                found[s].append(str(Region(contig, start, stop)))
+    return found
+
+
+def _lookup_rsids(rsids:List[str]) -> Dict[str, List[str]]:
+    """One `rsid__in` query per chunk against the Snps.rsid index."""
+    by_lower = {r.lower(): r for r in rsids}
+    found = {r: [] for r in rsids}
+    for chunk in chunked(list(by_lower)):
+        for rsid, chromosome, start, stop in Snps.objects.filter(rsid__in=chunk).values_list('rsid', 'chr', 'start', 'stop'):
+            if chromosome in CHR_DICT_STR_TO_INT and rsid.lower() in by_lower:
+                found[by_lower[rsid.lower()]].append(str(Region(chromosome, start, stop)))
+    return found
+
+
+def resolve_identifiers(identifiers:List[str]) -> Dict[str, List[str]]:
+    """Maps gene symbols and rsIDs to region strings, with a bulk query for whatever is not in the
+    per-worker cache. Identifiers that do not resolve map to an empty list."""
+    version = annotation_data_version()
+    resolved = _cache.get_many(identifiers, version)
+    missing = [i for i in dict.fromkeys(identifiers) if i not in resolved]
+    if missing:
+        fetched = {}
+        fetched.update(_lookup_rsids([i for i in missing if RSID_PATTERN.match(i)]))
+        fetched.update(_lookup_gene_symbols([i for i in missing if not RSID_PATTERN.match(i)]))
+        fetched = {k: sorted(set(v)) for k, v in fetched.items()}
+        logger.info(f'resolve_identifiers: {len(missing)} looked up, {sum(1 for v in fetched.values() if v)} resolved')
+        _cache.set_many(fetched)
+        resolved.update(fetched)
+    return resolved
+
+
+def expand_query_tokens(tokens:List[str]) -> Tuple[List[str], List[str]]:
+    """Splits the `regions` field into coordinates, which pass through untouched, and gene
+    symbols/rsIDs, which are replaced by their regions. Returns (regions, unresolved identifiers)."""
+    tokens = [t.strip() for t in tokens]
+    identifiers = [t for t in tokens if t and not is_region(t)]
+    if not identifiers:
+        return tokens, []
+
+    resolved = resolve_identifiers(identifiers)
+    regions, unresolved = [], []
+    for t in tokens:
+        if not t or is_region(t):
+            regions.append(t)
+        elif resolved.get(t):
+            regions.extend(resolved[t])
+        else:
+            unresolved.append(t)
+    return regions, unresolved
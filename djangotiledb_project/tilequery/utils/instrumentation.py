@@ -0,0 +1,403 @@
+from typing import Dict, Iterator
+import contextvars
+import contextlib
+import functools
+import threading
+import datetime
+import logging
+import cProfile
+import socket
+import fcntl
+import time
+import json
+import os
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('django')
+# one JSON object per traced request / job
+trace_logger = logging.getLogger('tilequery.trace')
+
+# upper bounds (seconds) of the duration histogram buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# a worker writes its counters to QUERY_METRICS_DIR at most this often
+METRICS_FLUSH_INTERVAL_SECONDS = 5
+
+# the counters of workers that are gone, folded together when their files are pruned
+METRICS_RETIRED_FILE = 'retired.json'
+
+_current = contextvars.ContextVar('tilequery_trace', default=None)
+
+
+class StageStats:
+    __slots__ = ('seconds', 'calls', 'rows', 'db_queries', 'bytes')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.rows = 0
+        self.db_queries = 0
+        self.bytes = 0
+
+    def add(self, rows:int=0, bytes:int=0):
+        self.rows += int(rows)
+        self.bytes += int(bytes)
+
+    def as_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class RequestTrace:
+    """Per-stage timings of one request or job. Stages may nest: a stage's time includes its inner
+    stages, and each DB query is counted in the innermost stage running when it executed (and in the
+    trace total). Activated with `activate()`, after which `stage(...)` anywhere in the call tree
+    records into it."""
+
+    def __init__(self, name:str):
+        self.name = name
+        self.stages:Dict[str, StageStats] = {}
+        self.stack = []
+        self.db_queries = 0
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.profile_path = None
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @contextlib.contextmanager
+    def stage(self, name:str, rows:int=0, bytes:int=0):
+        stats = self.stages.setdefault(name, StageStats())
+        stats.calls += 1
+        stats.add(rows, bytes)
+        self.stack.append(stats)
+        t0 = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.seconds += time.perf_counter() - t0
+            self.stack.pop()
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.db_queries += 1
+        if self.stack:
+            self.stack[-1].db_queries += 1
+        return execute(sql, params, many, context)
+
+    @contextlib.contextmanager
+    def activate(self):
+        token = _current.set(self)
+        try:
+            with contextlib.ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(self._count_query))
+                yield self
+        finally:
+            _current.reset(token)
+
+    def summary(self) -> str:
+        return ' | '.join(f'{name}={s.seconds * 1000:.0f}ms/{s.rows}rows/{s.db_queries}q'
+                          for name, s in self.stages.items())
+
+    def as_dict(self) -> dict:
+        return dict(trace=self.name, seconds=self.seconds, db_queries=self.db_queries,
+                    stages={name: s.as_dict() for name, s in self.stages.items()},
+                    profile=self.profile_path)
+
+    def finish(self, **extra):
+        self.seconds = self.elapsed()
+        METRICS.observe(self)
+        trace_logger.info(json.dumps(dict(self.as_dict(), **extra), default=str))
+
+
+def current_trace() -> RequestTrace:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def stage(name:str, rows:int=0, bytes:int=0):
+    """Records a stage into the active trace. Without one it only yields a throwaway StageStats."""
+    trace = _current.get()
+    if trace is None:
+        yield StageStats()
+        return
+    with trace.stage(name, rows, bytes) as stats:
+        yield stats
+
+
+def _histogram() -> dict:
+    return dict(buckets=[0] * len(SECONDS_BUCKETS), sum=0.0, count=0)
+
+
+def _observe(histogram:dict, seconds:float):
+    for i, bound in enumerate(SECONDS_BUCKETS):
+        if seconds <= bound:
+            histogram['buckets'][i] += 1
+            break
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+
+
+class MetricsRegistry:
+    """Counters and duration histograms of this process, by trace name and by stage. Each process
+    writes them to `<QUERY_METRICS_DIR>/worker_<host>_<pid>_<start>.json`, so `/metrics`, served by
+    any one worker, can sum every worker (including the background job workers)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.file_name = f'worker_{socket.gethostname()}_{self.pid}_{int(time.time())}.json'
+        self.traces = {}
+        self.stages = {}
+        self.flushed = 0.0
+
+    def observe(self, trace:RequestTrace):
+        with self.lock:
+            if os.getpid() != self.pid:
+                # a forked child must not report its parent's counters again
+                self._reset()
+            t = self.traces.setdefault(trace.name, dict(seconds=_histogram(), db_queries=0))
+            _observe(t['seconds'], trace.seconds)
+            t['db_queries'] += trace.db_queries
+            for name, s in trace.stages.items():
+                st = self.stages.setdefault(name, dict(seconds=_histogram(), calls=0, rows=0, db_queries=0, bytes=0))
+                _observe(st['seconds'], s.seconds)
+                for k in ('calls', 'rows', 'db_queries', 'bytes'):
+                    st[k] += getattr(s, k)
+        self.flush()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return json.loads(json.dumps(dict(traces=self.traces, stages=self.stages)))
+
+    def flush(self, force:bool=False):
+        directory = getattr(settings, 'QUERY_METRICS_DIR', None)
+        if not directory or (not force and time.monotonic() - self.flushed < METRICS_FLUSH_INTERVAL_SECONDS):
+            return
+        self.flushed = time.monotonic()
+        path = os.path.join(directory, self.file_name)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(f'{path}.tmp', path)
+        except OSError:
+            logger.exception('MetricsRegistry: could not write metrics')
+
+
+METRICS = MetricsRegistry()
+
+
+def _merge_histogram(into:dict, h:dict):
+    into['buckets'] = [a + b for a, b in zip(into['buckets'], h['buckets'])]
+    into['sum'] += h['sum']
+    into['count'] += h['count']
+
+
+def _merge_snapshots(snapshots:list) -> dict:
+    merged = dict(traces={}, stages={})
+    for snapshot in snapshots:
+        for kind in merged:
+            for name, values in snapshot.get(kind, {}).items():
+                into = merged[kind].get(name)
+                if into is None:
+                    merged[kind][name] = values
+                    continue
+                for k, v in values.items():
+                    if k == 'seconds':
+                        _merge_histogram(into['seconds'], v)
+                    else:
+                        into[k] += v
+    return merged
+
+
+def _read_snapshot(path:str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid:int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _dead_worker_files(directory:str) -> list:
+    """Metrics files written on this host by processes that no longer exist. Files of other hosts
+    sharing the directory are left to those hosts."""
+    dead = []
+    for name in os.listdir(directory):
+        if not (name.startswith('worker_') and name.endswith('.json')):
+            continue
+        parts = name[len('worker_'):-len('.json')].rsplit('_', 2)
+        # worker_<pid>_<start>.json files predate the host in the name, and were all local
+        host, pid = (parts[0], parts[1]) if len(parts) == 3 else (socket.gethostname(), parts[0])
+        if host == socket.gethostname() and pid.isdigit() and not _pid_alive(int(pid)):
+            dead.append(name)
+    return dead
+
+
+@contextlib.contextmanager
+def _locked_metrics(directory:str):
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _prune_metrics(directory:str):
+    """Folds the files of dead workers into METRICS_RETIRED_FILE and deletes them, so the directory
+    holds one file per live worker while the summed counters never go down. Call with the lock held."""
+    dead = _dead_worker_files(directory)
+    if not dead:
+        return
+    retired = os.path.join(directory, METRICS_RETIRED_FILE)
+    snapshots = [_read_snapshot(os.path.join(directory, name)) for name in [METRICS_RETIRED_FILE] + dead]
+    with open(f'{retired}.tmp', 'w') as f:
+        json.dump(_merge_snapshots([x for x in snapshots if x is not None]), f)
+    os.replace(f'{retired}.tmp', retired)
+    for name in dead:
+        os.remove(os.path.join(directory, name))
+    logger.info(f'collect_metrics: folded {len(dead)} dead worker files into {METRICS_RETIRED_FILE}')
+
+
+def collect_metrics() -> dict:
+    """Sum of every process' metrics file, or only this process when QUERY_METRICS_DIR is unset.
+    The files of dead workers are pruned first, under a lock so no file is counted twice."""
+    METRICS.flush(force=True)
+    directory = getattr(settings, 'QUERY_METRICS_DIR', None)
+    snapshots = []
+    if directory and os.path.isdir(directory):
+        with _locked_metrics(directory):
+            try:
+                _prune_metrics(directory)
+            except OSError:
+                logger.exception('collect_metrics: could not prune the metrics of dead workers')
+            for name in os.listdir(directory):
+                if (name.startswith('worker_') and name.endswith('.json')) or name == METRICS_RETIRED_FILE:
+                    snapshot = _read_snapshot(os.path.join(directory, name))
+                    if snapshot is not None:
+                        snapshots.append(snapshot)
+    else:
+        snapshots.append(METRICS.snapshot())
+    return _merge_snapshots(snapshots)
+
+
+def _render_histogram(lines:list, metric:str, label:str, h:dict):
+    cumulative = 0
+    for bound, n in zip(SECONDS_BUCKETS, h['buckets']):
+        cumulative += n
+        lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+    lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {h["count"]}')
+    lines.append(f'{metric}_sum{{{label}}} {h["sum"]:.6f}')
+    lines.append(f'{metric}_count{{{label}}} {h["count"]}')
+
+
+def render_prometheus(merged:dict, extra_counters:Dict[str, Dict[str, int]]=None) -> str:
+    """Prometheus text exposition (version 0.0.4) of `collect_metrics()`."""
+    lines = ['# HELP tilequery_request_seconds Duration of traced requests and jobs.',
+             '# TYPE tilequery_request_seconds histogram']
+    for name, t in sorted(merged['traces'].items()):
+        _render_histogram(lines, 'tilequery_request_seconds', f'trace="{name}"', t['seconds'])
+    lines += ['# HELP tilequery_stage_seconds Duration of query stages.',
+              '# TYPE tilequery_stage_seconds histogram']
+    for name, s in sorted(merged['stages'].items()):
+        _render_histogram(lines, 'tilequery_stage_seconds', f'stage="{name}"', s['seconds'])
+    for field, help_text in (('rows', 'Rows processed by query stages.'),
+                             ('db_queries', 'Database queries run by query stages.'),
+                             ('bytes', 'Bytes handled by query stages (tiledb_read: in-memory size of the batches read).')):
+        lines += [f'# HELP tilequery_stage_{field}_total {help_text}', f'# TYPE tilequery_stage_{field}_total counter']
+        lines += [f'tilequery_stage_{field}_total{{stage="{name}"}} {s[field]}' for name, s in sorted(merged['stages'].items())]
+    for metric, values in (extra_counters or {}).items():
+        lines.append(f'# TYPE {metric} counter')
+        lines += [f'{metric}{{event="{k}"}} {v}' for k, v in sorted(values.items())]
+    return '\n'.join(lines) + '\n'
+
+
+def _start_profiler(request, name:str):
+    """cProfile (`profile=1`) or pyinstrument (`profile=pyinstrument`, if installed) for one request
+    of a staff user, when settings.QUERY_PROFILE_DIR is set. Returns a function that stops it and
+    returns the dump path, or None."""
+    directory = getattr(settings, 'QUERY_PROFILE_DIR', None)
+    wanted = request.GET.get('profile') or (request.POST.get('profile') if request.method == 'POST' else None)
+    if not directory or not wanted or not getattr(request.user, 'is_staff', False):
+        return None
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(str(directory), f'{name}_{datetime.datetime.now():%Y%m%dT%H%M%S}_{os.getpid()}')
+    if wanted == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning('_start_profiler: pyinstrument is not installed, using cProfile')
+        else:
+            profiler = Profiler()
+            profiler.start()
+            def stop():
+                profiler.stop()
+                with open(f'{stem}.html', 'w') as f:
+                    f.write(profiler.output_html())
+                return f'{stem}.html'
+            return stop
+    profiler = cProfile.Profile()
+    profiler.enable()
+    def stop():
+        profiler.disable()
+        profiler.dump_stats(f'{stem}.prof')
+        return f'{stem}.prof'
+    return stop
+
+
+def _traced_stream(trace:RequestTrace, content:Iterator[bytes], stop_profiler) -> Iterator[bytes]:
+    # a streaming response does its work while being iterated, after the view has returned
+    sent = 0
+    try:
+        with trace.activate():
+            for chunk in content:
+                sent += len(chunk)
+                yield chunk
+    finally:
+        if stop_profiler is not None:
+            trace.profile_path = stop_profiler()
+        trace.finish(status=200, bytes_sent=sent)
+
+
+def instrumented(name:str):
+    """View decorator: traces the request as `name` (stages, DB queries), logs the trace as JSON on
+    the `tilequery.trace` logger and adds it to /metrics. Streaming responses are traced until the
+    last chunk is sent."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            trace = RequestTrace(name)
+            stop_profiler = _start_profiler(request, name)
+            try:
+                with trace.activate():
+                    response = view(request, *args, **kwargs)
+            except Exception:
+                if stop_profiler is not None:
+                    trace.profile_path = stop_profiler()
+                trace.finish(status=500)
+                raise
+            if getattr(response, 'streaming', False):
+                response.streaming_content = _traced_stream(trace, response.streaming_content, stop_profiler)
+                return response
+            if stop_profiler is not None:
+                trace.profile_path = stop_profiler()
+            trace.finish(status=response.status_code)
+            return response
+        return wrapped
+    return decorator
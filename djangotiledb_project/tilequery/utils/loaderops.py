@@ -0,0 +1,331 @@
+from typing import Dict, Iterable, Iterator, List
+import logging
+import gzip
+import io
+import re
+from urllib.parse import unquote
+
+from django.db import models, transaction
+
+from annoquery.models import variant_key
+from .regionops import CHR_DICT_STR_TO_INT
+
+logger = logging.getLogger('django')
+
+# rows between two progress log lines
+LOAD_PROGRESS_EVERY = 1_000_000
+
+# RefSeq chromosome accessions (dbSNP VCF, RefSeq GFF) to contig names: NC_000001.11 -> chr1
+REFSEQ_PATTERN = re.compile(r'^NC_0000(?P<n>\d\d)\.\d+$')
+REFSEQ_SPECIAL = {23: 'chrX', 24: 'chrY'}
+
+
+def open_text(path:str):
+    """Opens plain or (b)gzipped text files."""
+    if path.endswith('.gz') or path.endswith('.bgz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'rt')
+
+
+def refseq_to_chr(seqid:str) -> str:
+    """`NC_000017.11`, `chr17` or `17` -> `chr17`. None for unplaced/alt/patch/mito sequences,
+    which the query side cannot address."""
+    m = REFSEQ_PATTERN.match(seqid)
+    if m:
+        n = int(m.group('n'))
+        contig = REFSEQ_SPECIAL.get(n, f'chr{n}')
+    else:
+        contig = seqid if seqid.startswith('chr') else f'chr{seqid}'
+    return contig if contig in CHR_DICT_STR_TO_INT else None
+
+
+def _to_int(value:str, default:int=-1) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _to_float(value:str, default:float=-1.0) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _progress(rows:Iterable[Dict], name:str) -> Iterator[Dict]:
+    n = 0
+    for n, row in enumerate(rows, start=1):
+        if n % LOAD_PROGRESS_EVERY == 0:
+            logger.info(f'{name}: {n} rows parsed')
+        yield row
+    logger.info(f'{name}: {n} rows parsed in total')
+
+
+# ClinVar variant_summary.txt header -> Clinvars field
+CLINVAR_COLUMNS = {
+    '#AlleleID': 'alleleid', 'Type': 'type', 'Name': 'name', 'GeneID': 'geneid', 'GeneSymbol': 'genesymbol',
+    'HGNC_ID': 'hgnc_id', 'ClinicalSignificance': 'clinicalsignificance', 'ClinSigSimple': 'clinsigsimple',
+    'LastEvaluated': 'lastevaluated', 'RS# (dbSNP)': 'rsid', 'nsv/esv (dbVar)': 'nsvesv',
+    'RCVaccession': 'rcvaccession', 'PhenotypeIDS': 'phenotypeids', 'PhenotypeList': 'phenotypelist',
+    'Origin': 'origin', 'OriginSimple': 'originsimple', 'Assembly': 'assembly',
+    'ChromosomeAccession': 'chromosomeaccession', 'Chromosome': 'chromosome', 'Start': 'start', 'Stop': 'stop',
+    'ReferenceAllele': 'referenceallele', 'AlternateAllele': 'alternateallele', 'Cytogenetic': 'cytogenetic',
+    'ReviewStatus': 'reviewstatus', 'NumberSubmitters': 'numbersubmitters', 'Guidelines': 'guidelines',
+    'TestedInGTR': 'testedingtr', 'OtherIDs': 'otherids', 'SubmitterCategories': 'submittercategories',
+    'VariationID': 'variationid', 'PositionVCF': 'positionvcf', 'ReferenceAlleleVCF': 'referenceallelevcf',
+    'AlternateAlleleVCF': 'alternateallelevcf',
+}
+
+
+def iter_clinvar_rows(path:str, assembly:str='GRCh38') -> Iterator[Dict]:
+    """Rows of ClinVar's variant_summary.txt(.gz) for one assembly. The chromosome is stored as the
+    number the query side looks up (X=23, Y=24); `order` is the line number in the file, which with
+    `alleleid` makes a record unique."""
+    with open_text(path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        missing = [c for c in CLINVAR_COLUMNS if c not in header]
+        if missing:
+            raise ValueError(f'<iter_clinvar_rows> {path} is missing the columns {",".join(missing)}. Expected a variant_summary.txt file.')
+        index = [(header.index(c), name) for c, name in CLINVAR_COLUMNS.items()]
+        for line_number, line in enumerate(f, start=1):
+            values = line.rstrip('\n').split('\t')
+            row = {name: values[i] for i, name in index}
+            if row['assembly'] != assembly:
+                continue
+            contig = refseq_to_chr(row['chromosome'])
+            if contig is None:
+                continue
+            row['variant_key'] = variant_key(contig, _to_int(row['positionvcf']), row['referenceallelevcf'], row['alternateallelevcf'])
+            row['chromosome'] = str(CHR_DICT_STR_TO_INT[contig])
+            row['order'] = float(line_number)
+            yield row
+
+
+def iter_dbsnp_rows(path:str) -> Iterator[Dict]:
+    """One Snps row per (rsID, alt allele) of a dbSNP VCF(.gz). `stop` is the last reference base,
+    same as tiledbvcf's pos_end, and the lookups match on the variant_key of (chr, start, ref, alt)."""
+    with open_text(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            seqid, pos, rsid, ref, alts = line.split('\t', 5)[:5]
+            contig = refseq_to_chr(seqid)
+            if contig is None or rsid == '.':
+                continue
+            start = int(pos)
+            stop = start + len(ref) - 1
+            for alt in alts.split(','):
+                yield dict(rsid=rsid, chr=contig, start=start, stop=stop, ref=ref, alt=alt,
+                           variant_key=variant_key(contig, start, ref, alt))
+
+
+def _gff_attributes(text:str) -> Dict[str, str]:
+    attributes = {}
+    for item in text.strip().split(';'):
+        key, sep, value = item.partition('=')
+        if sep:
+            attributes[key] = value
+    return attributes
+
+
+def iter_gene_rows(path:str, feature_types=('gene', 'pseudogene')) -> Iterator[Dict]:
+    """Gene records of a RefSeq GFF3(.gz). `gene` is the bare symbol (the query side also accepts
+    the older `gene=` prefixed form)."""
+    with open_text(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 9 or fields[2] not in feature_types:
+                continue
+            contig = refseq_to_chr(fields[0])
+            if contig is None:
+                continue
+            attributes = _gff_attributes(fields[8])
+            yield dict(chromosome=CHR_DICT_STR_TO_INT[contig],
+                       source=fields[1],
+                       gene_type=attributes.get('gene_biotype', fields[2]),
+                       start=int(fields[3]),
+                       stop=int(fields[4]),
+                       gene=attributes.get('gene', attributes.get('Name')),
+                       product=unquote(attributes['description']) if 'description' in attributes else None,
+                       )
+
+
+def model_row_converter(model, fields:List[str]):
+    """Returns a function turning a parsed dict into a tuple in `fields` order, with the values
+    coerced to the column types: strings cut to max_length (the Clinvars comments document the
+    truncation) and unparsable numbers set to -1."""
+    converters = []
+    for name in fields:
+        field = model._meta.get_field(name)
+        if isinstance(field, models.FloatField):
+            convert = _to_float
+        elif isinstance(field, models.IntegerField):
+            convert = _to_int
+        elif field.max_length:
+            convert = (lambda n: lambda v: v if v is None else str(v)[:n])(field.max_length)
+        else:
+            convert = lambda v: v
+        if field.null:
+            convert = (lambda c: lambda v: None if v is None or v == '' else c(v))(convert)
+        converters.append((name, convert))
+
+    def convert_row(row:Dict) -> tuple:
+        return tuple(c(row.get(name)) for name, c in converters)
+    return convert_row
+
+
+def _copy_text(value) -> str:
+    """COPY ... (FORMAT text) encoding of one value."""
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class CopyStream(io.TextIOBase):
+    """File-like view over an iterator of tuples, encoded as COPY text lines on demand. Handed to
+    psycopg2's `copy_expert`, so the source file is parsed and sent to postgres in one pass without
+    holding more than one read buffer in memory."""
+
+    def __init__(self, rows:Iterable[tuple]):
+        self.rows = iter(rows)
+        self.count = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size:int=-1) -> str:
+        lines = []
+        n = 0
+        for row in self.rows:
+            line = '\t'.join(_copy_text(v) for v in row) + '\n'
+            lines.append(line)
+            n += len(line)
+            self.count += 1
+            if 0 <= size <= n:
+                break
+        return ''.join(lines)
+
+
+def _index_definitions(cursor, table:str) -> List[tuple]:
+    """(index name, CREATE INDEX statement) of every index of `table` that does not back a constraint."""
+    cursor.execute("""
+        SELECT i.relname, pg_get_indexdef(i.oid)
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = %s::regclass
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+        ORDER BY i.relname""", [table])
+    return cursor.fetchall()
+
+
+def _constraint_definitions(cursor, table:str) -> List[tuple]:
+    """(constraint name, definition) of the primary key/unique constraints of `table`."""
+    cursor.execute("""
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype IN ('p', 'u')
+        ORDER BY conname""", [table])
+    return cursor.fetchall()
+
+
+INDEXDEF_PATTERN = re.compile(r'^(CREATE (?:UNIQUE )?INDEX) \S+ ON (?:ONLY )?\S+ ')
+
+
+def _partitions(cursor, table:str) -> List[tuple]:
+    """(partition name, bound e.g. `FOR VALUES IN ('chr1')`) of a partitioned `table`."""
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname""", [table])
+    return cursor.fetchall()
+
+
+def _staging_name(name:str) -> str:
+    # postgres identifiers are cut at 63 bytes
+    return f'{name[:54]}__staging'
+
+
+def staged_reload(connection, model, rows:Iterable[Dict], lock_timeout:str='30s') -> int:
+    """Replaces the contents of `model`'s table with `rows` without blocking readers while loading.
+
+    1. `CREATE TABLE <table>__staging (LIKE <table> INCLUDING DEFAULTS INCLUDING IDENTITY)`, i.e.
+       without indexes, and stream the rows into it with COPY FROM STDIN. Ids continue after the
+       live table's max id so `annotation_data_version` always sees the change.
+       A partitioned live table gets a staging table with the same partition key and bounds.
+    2. Build the live table's constraints and indexes on the staging table, then ANALYZE it.
+    3. In one short transaction: rename live -> old and staging -> live, move the id sequence over,
+       drop the old table and give the indexes and partitions their original names. Readers only
+       wait for this swap, bounded by `lock_timeout`.
+    Returns the number of rows loaded.
+    """
+    table = model._meta.db_table
+    staging = _staging_name(table)
+    old = f'{table[:58]}__old'
+    fields = [f for f in model._meta.concrete_fields if f.name != 'id']
+    convert = model_row_converter(model, [f.name for f in fields])
+    q = connection.ops.quote_name
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {q(staging)}')
+        cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass", [table])
+        partitioned = cursor.fetchone()[0]
+        if partitioned:
+            # same partitioning (see annoquery 0009), so COPY routes every row to its partition
+            cursor.execute('SELECT pg_get_partkeydef(%s::regclass)', [table])
+            cursor.execute(f'CREATE TABLE {q(staging)} (LIKE {q(table)} INCLUDING DEFAULTS) PARTITION BY {cursor.fetchone()[0]}')
+            partitions = _partitions(cursor, table)
+            for name, bound in partitions:
+                cursor.execute(f'CREATE TABLE {q(_staging_name(name))} PARTITION OF {q(staging)} {bound}')
+        else:
+            cursor.execute(f'CREATE TABLE {q(staging)} (LIKE {q(table)} INCLUDING DEFAULTS INCLUDING IDENTITY)')
+            partitions = []
+        cursor.execute(f'SELECT coalesce(max(id), 0) FROM {q(table)}')
+        first_id = cursor.fetchone()[0] + 1
+        indexes = _index_definitions(cursor, table)
+        constraints = _constraint_definitions(cursor, table)
+
+        stream = CopyStream((i,) + convert(row) for i, row in enumerate(_progress(rows, table), start=first_id))
+        columns = ', '.join(q(c) for c in ['id'] + [f.column for f in fields])
+        cursor.copy_expert(f'COPY {q(staging)} ({columns}) FROM STDIN (FORMAT text)', stream)
+        logger.info(f'staged_reload: copied {stream.count} rows into {staging}')
+
+        for name, definition in constraints:
+            cursor.execute(f'ALTER TABLE {q(staging)} ADD CONSTRAINT {q(_staging_name(name))} {definition}')
+        for name, definition in indexes:
+            # pg_get_indexdef gives `CREATE INDEX name ON [ONLY] public.table USING ...`. ONLY is dropped
+            # so an index on a partitioned table is created on every partition too
+            definition = INDEXDEF_PATTERN.sub(rf'\1 {q(_staging_name(name))} ON {q(staging)} ', definition, count=1)
+            logger.info(f'staged_reload: {definition}')
+            cursor.execute(definition)
+        cursor.execute(f'ANALYZE {q(staging)}')
+
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute("SELECT set_config('lock_timeout', %s, true)", [lock_timeout])
+        cursor.execute(f'LOCK TABLE {q(table)} IN ACCESS EXCLUSIVE MODE')
+        cursor.execute("SELECT attidentity FROM pg_attribute WHERE attrelid = %s::regclass AND attname = 'id'", [table])
+        is_identity = bool(cursor.fetchone()[0])
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, 'id'])
+        sequence = cursor.fetchone()[0]
+
+        cursor.execute(f'ALTER TABLE {q(table)} RENAME TO {q(old)}')
+        cursor.execute(f'ALTER TABLE {q(staging)} RENAME TO {q(table)}')
+        if sequence and not is_identity:
+            # a serial default was copied verbatim and still points at the old table's sequence
+            cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {q(table)}.id')
+        cursor.execute(f'DROP TABLE {q(old)}')
+        for name, _ in constraints:
+            cursor.execute(f'ALTER TABLE {q(table)} RENAME CONSTRAINT {q(_staging_name(name))} TO {q(name)}')
+        for name, _ in indexes:
+            cursor.execute(f'ALTER INDEX {q(_staging_name(name))} RENAME TO {q(name)}')
+        for name, _ in partitions:
+            cursor.execute(f'ALTER TABLE {q(_staging_name(name))} RENAME TO {q(name)}')
+        cursor.execute(f"SELECT setval(pg_get_serial_sequence(%s, 'id'), (SELECT max(id) FROM {q(table)}))", [table])
+    logger.info(f'staged_reload: swapped {stream.count} rows into {table}')
+    return stream.count
+
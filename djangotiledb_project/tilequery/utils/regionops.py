@@ -0,0 +1,117 @@
+import pandas as pd
+import numpy as np
+from typing import List, NamedTuple, Tuple
+import re
+
+CHR_DICT_STR_TO_INT = {'chr1': 1, 'chr2': 2, 'chr3': 3,
+                       'chr4': 4, 'chr5': 5, 'chr6': 6,
+                       'chr7': 7, 'chr8': 8, 'chr9': 9,
+                       'chr10': 10, 'chr11': 11, 'chr12': 12,
+                       'chr13': 13, 'chr14': 14, 'chr15': 15,
+                       'chr16': 16, 'chr17': 17, 'chr18': 18,
+                       'chr19': 19, 'chr20': 20, 'chr21': 21,
+                       'chr22': 22, 'chrX': 23, 'chrY': 24}
+
+# chr17:43124028-43124029, chr17:43,124,028-43,124,029 or a single position chr17:43124028
+REGION_PATTERN = re.compile(r'^(?P<contig>[^:\s]+):(?P<start>[\d,]+)(?:-(?P<end>[\d,]+))?$')
+# tiledbvcf attributes assign_rows_to_regions reads
+REGION_ATTRS = ['contig', 'pos_start', 'pos_end']
+
+
+class Region(NamedTuple):
+    """1-based, inclusive on both ends, same as the tiledbvcf region strings."""
+    contig: str
+    start: int
+    end: int
+
+    def __str__(self) -> str:
+        return f'{self.contig}:{self.start}-{self.end}'
+
+    def sort_key(self):
+        return (CHR_DICT_STR_TO_INT.get(self.contig, len(CHR_DICT_STR_TO_INT) + 1), self.contig, self.start, self.end)
+
+
+def parse_region(text:str) -> Region:
+    """Parses `chr:start-end`, raising a ValueError that names the offending region."""
+    m = REGION_PATTERN.match(text.strip())
+    if not m:
+        raise ValueError(f'<parse_region> could not parse region "{text}". Expected the form chr1:100-200.')
+    contig = m.group('contig')
+    if contig not in CHR_DICT_STR_TO_INT:
+        raise ValueError(f'<parse_region> unknown contig "{contig}" in region "{text}". Expected one of {",".join(CHR_DICT_STR_TO_INT)}.')
+    start = int(m.group('start').replace(',', ''))
+    end = int(m.group('end').replace(',', '')) if m.group('end') else start
+    if start < 1 or end < start:
+        raise ValueError(f'<parse_region> region "{text}" must have 1 <= start <= end.')
+    return Region(contig, start, end)
+
+
+def parse_regions(texts:List[str]) -> List[Region]:
+    """Parses every non-blank region, keeping the user's order and duplicates."""
+    return [parse_region(t) for t in texts if t and t.strip()]
+
+
+def merge_regions(regions:List[Region], gap:int=0) -> List[Region]:
+    """Sorts regions and merges the ones that overlap, touch, or are at most `gap` bp apart, so that
+    tiledb does one range read per merged block instead of one per pasted region."""
+    merged = []
+    for r in sorted(regions, key=Region.sort_key):
+        if merged and merged[-1].contig == r.contig and r.start <= merged[-1].end + gap + 1:
+            last = merged[-1]
+            merged[-1] = Region(last.contig, last.start, max(last.end, r.end))
+        else:
+            merged.append(r)
+    return merged
+
+
+def normalize_regions(texts:List[str], gap:int=0) -> Tuple[List[Region], List[str]]:
+    """Returns (parsed original regions, merged region strings to hand to tiledbvcf)."""
+    originals = parse_regions(texts)
+    return originals, [str(r) for r in merge_regions(originals, gap=gap)]
+
+
+def assign_rows_to_regions(df:pd.DataFrame,
+                           regions:List[Region],
+                           chromosome_label='contig',
+                           start_label='pos_start',
+                           stop_label='pos_end',
+                           ) -> np.ndarray:
+    """Maps every result row back to the original region(s) it overlaps. Returns an object array
+    aligned to `df` with the ','-joined region strings, or np.nan for rows that only fell into the
+    gap between two coalesced regions.
+    """
+    result = np.full(df.shape[0], np.nan, dtype=object)
+    if not regions or df.shape[0] == 0:
+        return result
+
+    contigs = df.loc[:, chromosome_label].to_numpy()
+    row_starts = df.loc[:, start_label].to_numpy(dtype=np.int64)
+    row_stops = df.loc[:, stop_label].to_numpy(dtype=np.int64)
+
+    unique_regions = sorted(set(regions), key=Region.sort_key)
+    by_contig = pd.DataFrame(unique_regions, columns=['contig', 'start', 'end']).groupby('contig', sort=False)
+    for contig, group in by_contig:
+        rows = np.flatnonzero(contigs == contig)
+        if not len(rows):
+            continue
+        r_starts = group['start'].to_numpy(dtype=np.int64)
+        r_ends = group['end'].to_numpy(dtype=np.int64)
+        names = np.array([f'{contig}:{s}-{e}' for s, e in zip(r_starts, r_ends)], dtype=object)
+        max_len = int((r_ends - r_starts).max())
+        q_starts, q_stops = row_starts[rows], row_stops[rows]
+
+        # overlap: region.start <= row.stop and region.end >= row.start
+        lo = np.searchsorted(r_starts, q_starts - max_len, side='left')
+        hi = np.searchsorted(r_starts, q_stops, side='right')
+        counts = np.maximum(hi - lo, 0)
+        if not counts.sum():
+            continue
+        query_idx = np.repeat(np.arange(len(rows)), counts)
+        region_idx = np.repeat(lo, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+        hit = r_ends[region_idx] >= q_starts[query_idx]
+        query_idx, region_idx = query_idx[hit], region_idx[hit]
+
+        for q, hit_names in pd.Series(names[region_idx]).groupby(query_idx):
+            result[rows[q]] = ','.join(hit_names)
+
+    return result
@@ -0,0 +1,175 @@
+import pandas as pd
+from typing import List, Tuple
+import contextlib
+import hashlib
+import logging
+import fcntl
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .arrowops import dataframe_to_arrow, arrow_to_dataframe
+from .regionops import Region, parse_regions
+
+logger = logging.getLogger('django')
+
+# extra parquet schema metadata stored with every entry
+TRUNCATED_METADATA_KEY = b'tilequery.truncated'
+
+# entries are written in row groups of this size, so that pages of them can be read on their own
+RESULT_ROW_GROUP_ROWS = 10000
+
+
+def canonical_query(regions:List[str], samples:List[str], attrs:List[str], flags:dict, **versions) -> dict:
+    """Order-insensitive form of a query. Regions are parsed to their canonical `chr:start-end`
+    form; regions and samples are de-duplicated and sorted; attrs keep their order since it
+    decides the column order of the result."""
+    def clean(values):
+        return sorted(set(v.strip() for v in values if v and v.strip()))
+    return dict(regions=[str(r) for r in sorted(set(parse_regions(regions)), key=Region.sort_key)],
+                samples=clean(samples),
+                attrs=[a.strip() for a in attrs],
+                flags={k: bool(v) for k, v in sorted(flags.items())},
+                versions={k: repr(v) for k, v in sorted(versions.items())},
+                )
+
+
+def query_cache_key(query:dict) -> str:
+    return hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """On-disk cache of query results as Parquet files, shared by every gunicorn worker on the host.
+
+    Entries are written to a temporary file and renamed into place, so readers never see partial
+    files. Reads bump the file mtime, which is the LRU clock; once the directory exceeds `max_bytes`
+    the least recently used entries are deleted. Eviction and the hit/miss counters are serialized
+    with an flock on `<cache_dir>/.lock`.
+    """
+
+    def __init__(self, cache_dir:str, max_bytes:int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.parquet')
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _count(self, counter:str, n:int=1):
+        with self._locked():
+            p = os.path.join(self.cache_dir, 'stats.json')
+            try:
+                with open(p) as f:
+                    stats = json.load(f)
+            except (OSError, ValueError):
+                stats = {}
+            stats[counter] = stats.get(counter, 0) + n
+            with open(p + '.tmp', 'w') as f:
+                json.dump(stats, f)
+            os.replace(p + '.tmp', p)
+
+    def stats(self) -> dict:
+        try:
+            with open(os.path.join(self.cache_dir, 'stats.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key:str) -> Tuple[pd.DataFrame, bool]:
+        """Returns (df, truncated) or (None, False) on a miss."""
+        p = self._path(key)
+        try:
+            table = pq.read_table(p)
+            os.utime(p)
+        except (OSError, ValueError) as e:
+            # missing, or evicted/corrupted underneath us: both are a miss
+            if os.path.exists(p):
+                logger.warning(f'ResultCache: unreadable entry {p}: {e}')
+            self._count('misses')
+            return None, False
+        self._count('hits')
+        truncated = (table.schema.metadata or {}).get(TRUNCATED_METADATA_KEY) == b'1'
+        return arrow_to_dataframe(table), truncated
+
+    def entry_path(self, key:str) -> str:
+        """Path of an existing entry (counted as a use for the LRU), or None."""
+        p = self._path(key)
+        try:
+            os.utime(p)
+        except OSError:
+            return None
+        return p
+
+    def get_slice(self, key:str, offset:int, limit:int) -> Tuple[pa.Table, int, bool]:
+        """Rows [offset, offset+limit) of an entry, reading only the row groups that hold them.
+        Returns (table, total rows, truncated) or (None, 0, False) on a miss."""
+        p = self._path(key)
+        try:
+            pf = pq.ParquetFile(p)
+            total = pf.metadata.num_rows
+            wanted, first_row, row = [], None, 0
+            for i in range(pf.num_row_groups):
+                n = pf.metadata.row_group(i).num_rows
+                if row + n > offset and row < offset + limit:
+                    wanted.append(i)
+                    first_row = row if first_row is None else first_row
+                row += n
+            if wanted:
+                table = pf.read_row_groups(wanted).slice(offset - first_row, limit)
+            else:
+                table = pf.schema_arrow.empty_table()
+            os.utime(p)
+        except (OSError, ValueError) as e:
+            if os.path.exists(p):
+                logger.warning(f'ResultCache: unreadable entry {p}: {e}')
+            self._count('misses')
+            return None, 0, False
+        self._count('hits')
+        truncated = (pf.schema_arrow.metadata or {}).get(TRUNCATED_METADATA_KEY) == b'1'
+        return table, total, truncated
+
+    def put(self, key:str, df:pd.DataFrame, truncated:bool=False, row_group_size:int=RESULT_ROW_GROUP_ROWS):
+        table = dataframe_to_arrow(df)
+        table = table.replace_schema_metadata({**table.schema.metadata,
+                                               TRUNCATED_METADATA_KEY: b'1' if truncated else b'0'})
+        os.makedirs(self.cache_dir, exist_ok=True)
+        p = self._path(key)
+        tmp = f'{p}.{os.getpid()}.tmp'
+        pq.write_table(table, tmp, row_group_size=row_group_size)
+        os.replace(tmp, p)
+        self.evict()
+
+    def evict(self):
+        with self._locked():
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.parquet'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+            total = sum(e[1] for e in entries)
+            evicted = 0
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.cache_dir, name))
+                total -= size
+                evicted += 1
+        if evicted:
+            logger.info(f'ResultCache: evicted {evicted} entries')
+            self._count('evictions', evicted)
@@ -0,0 +1,98 @@
+from typing import List
+import numpy as np
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from .annotationcache import VersionedLRUCache
+from .resultcache import TRUNCATED_METADATA_KEY
+
+# max rows of one page request
+RESULT_PAGE_MAX_ROWS = 500
+
+# sorted/filtered row orders remembered per worker, keyed by file and sort/filter
+RESULT_ORDER_CACHE_SIZE = 32
+
+_orders = VersionedLRUCache(RESULT_ORDER_CACHE_SIZE)
+
+
+def _scalar_column(pf:pq.ParquetFile, table:pa.Table, name:str) -> pa.ChunkedArray:
+    column = table.column(name)
+    if pa.types.is_nested(column.type):
+        raise ValueError(f'<read_result_page> column "{name}" holds lists and cannot be sorted or filtered.')
+    return column
+
+
+def _row_order(pf:pq.ParquetFile, path:str, sort:str, descending:bool, filter_column:str, filter_text:str) -> np.ndarray:
+    """Row numbers of the file after filtering and sorting, or None when neither is asked for. Only
+    the sort/filter columns are read; the order is cached so paging through it reads no more."""
+    if not sort and not filter_text:
+        return None
+    key = (path, sort, descending, filter_column, filter_text)
+    found = _orders.get_many([key], None)
+    if key in found:
+        return found[key]
+
+    names = pf.schema_arrow.names
+    wanted = [c for c in (sort, filter_column if filter_text else None) if c]
+    for c in wanted:
+        if c not in names:
+            raise ValueError(f'<read_result_page> unknown column "{c}".')
+    table = pf.read(columns=list(dict.fromkeys(wanted)))
+    rows = np.arange(table.num_rows)
+    if filter_text:
+        values = pc.cast(_scalar_column(pf, table, filter_column), pa.string())
+        mask = pc.fill_null(pc.match_substring(values, filter_text, ignore_case=True), False)
+        rows = np.flatnonzero(mask.to_numpy(zero_copy_only=False))
+    if sort:
+        values = _scalar_column(pf, table, sort).take(pa.array(rows))
+        order = pc.array_sort_indices(values, order='descending' if descending else 'ascending', null_placement='at_end')
+        rows = rows[order.to_numpy()]
+    _orders.set_many({key: rows})
+    return rows
+
+
+def read_rows(pf:pq.ParquetFile, rows:np.ndarray) -> pa.Table:
+    """The given rows of a Parquet file, in that order, reading only the row groups holding them."""
+    if rows.size == 0:
+        return pf.schema_arrow.empty_table()
+    sizes = np.array([pf.metadata.row_group(i).num_rows for i in range(pf.num_row_groups)])
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    groups = np.searchsorted(starts, rows, side='right') - 1
+    wanted = np.unique(groups)
+    table = pf.read_row_groups(wanted.tolist())
+    # start of each wanted row group inside the concatenated table
+    base = np.concatenate([[0], np.cumsum(sizes[wanted])[:-1]])
+    return table.take(pa.array(base[np.searchsorted(wanted, groups)] + rows - starts[groups]))
+
+
+def _json_value(v):
+    # NaN is not valid JSON
+    return None if isinstance(v, float) and v != v else v
+
+
+def table_rows(table:pa.Table) -> List[list]:
+    columns = [c.to_pylist() for c in table.columns]
+    return [[_json_value(v) for v in row] for row in zip(*columns)]
+
+
+def read_result_page(path:str, offset:int=0, limit:int=100, sort:str=None, descending:bool=False,
+                filter_column:str=None, filter_text:str='') -> dict:
+    """One page of a stored result (a ResultCache entry or a job's Parquet file) as a JSON-able dict.
+    Filtering is a case-insensitive substring match on one column; sorting is stable."""
+    pf = pq.ParquetFile(path)
+    rows = _row_order(pf, path, sort, descending, filter_column, filter_text.strip())
+    stored = pf.metadata.num_rows
+    total = stored if rows is None else int(rows.size)
+    offset = max(0, offset)
+    limit = max(0, min(limit, RESULT_PAGE_MAX_ROWS))
+    page_rows = np.arange(offset, min(offset + limit, total)) if rows is None else rows[offset:offset + limit]
+    table = read_rows(pf, page_rows)
+    return dict(total_rows=total,
+                stored_rows=stored,
+                truncated=(pf.schema_arrow.metadata or {}).get(TRUNCATED_METADATA_KEY) == b'1',
+                offset=offset,
+                columns=table.column_names,
+                rows=table_rows(table),
+                )
@@ -0,0 +1,68 @@
+from typing import List, Tuple
+import threading
+import bisect
+
+from .datasetmeta import DatasetMetadata, DatasetMetadataService
+
+# max sample names returned by one search page
+SAMPLE_SEARCH_MAX_LIMIT = 100
+
+
+class SampleCatalog:
+    """Searchable index over the sample names of one version of the dataset metadata.
+
+    Membership is a frozenset lookup; prefix search is a bisect over the case-folded sorted names,
+    so it only touches the matching slice; substring search scans the folded names, which is fine
+    for tens of thousands of samples and only ever returns one page.
+    """
+
+    def __init__(self, samples:List[str]):
+        self.samples = sorted(set(samples), key=lambda s: (s.casefold(), s))
+        self.folded = [s.casefold() for s in self.samples]
+        self.names = frozenset(self.samples)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def __contains__(self, sample:str) -> bool:
+        return sample in self.names
+
+    def unknown(self, samples:List[str]) -> List[str]:
+        """The non-blank names in `samples` that are not in the dataset."""
+        return [s for s in (x.strip() for x in samples) if s and s not in self.names]
+
+    def _prefix_range(self, q:str) -> Tuple[int, int]:
+        lo = bisect.bisect_left(self.folded, q)
+        hi = bisect.bisect_left(self.folded, q + '\U0010ffff', lo)
+        return lo, hi
+
+    def search(self, q:str='', mode:str='prefix', offset:int=0, limit:int=20) -> Tuple[int, List[str]]:
+        """Case-insensitive `prefix` or `substring` search. Returns (total matches, one page of names)."""
+        q = q.strip().casefold()
+        limit = max(0, min(limit, SAMPLE_SEARCH_MAX_LIMIT))
+        offset = max(0, offset)
+        if mode == 'prefix':
+            lo, hi = self._prefix_range(q)
+            return hi - lo, self.samples[lo + offset:min(hi, lo + offset + limit)]
+        if mode == 'substring':
+            matches = [i for i, s in enumerate(self.folded) if q in s]
+            return len(matches), [self.samples[i] for i in matches[offset:offset + limit]]
+        raise ValueError(f'<SampleCatalog.search> unknown mode "{mode}". Expected prefix or substring.')
+
+
+class SampleCatalogService:
+    """Process-wide SampleCatalog, rebuilt whenever the dataset metadata service serves new metadata."""
+
+    def __init__(self, metadata_service:DatasetMetadataService):
+        self.metadata_service = metadata_service
+        self.metadata:DatasetMetadata = None
+        self.catalog:SampleCatalog = None
+        self.lock = threading.Lock()
+
+    def get(self) -> SampleCatalog:
+        metadata = self.metadata_service.get()
+        with self.lock:
+            if metadata is not self.metadata:
+                self.catalog = SampleCatalog(metadata.samples)
+                self.metadata = metadata
+            return self.catalog
@@ -0,0 +1,121 @@
+import pandas as pd
+from typing import Callable, Iterator, List
+import logging
+
+import pyarrow as pa
+import tiledbvcf as tv
+
+from .instrumentation import stage
+
+logger = logging.getLogger('django')
+
+
+def iter_tiledb_batches(ds:tv.Dataset, attrs:List[str], regions:List[str], samples:List[str]) -> Iterator[pd.DataFrame]:
+    """Yields the result of a tiledbvcf read one batch at a time using incomplete reads. A batch is
+    whatever fits in the dataset's ReadConfig memory budget, so peak memory is bounded by that budget
+    rather than by the size of the whole result.
+    """
+    with stage('tiledb_read') as s:
+        batch = ds.read(attrs=attrs, regions=regions, samples=samples)
+        s.add(rows=batch.shape[0], bytes=batch.memory_usage(index=False).sum())
+    yield batch
+    while not ds.read_completed():
+        with stage('tiledb_read') as s:
+            batch = ds.continue_read()
+            s.add(rows=batch.shape[0], bytes=batch.memory_usage(index=False).sum())
+        yield batch
+
+
+def iter_tiledb_arrow_batches(ds:tv.Dataset, attrs:List[str], regions:List[str], samples:List[str]) -> Iterator[pa.Table]:
+    """`iter_tiledb_batches` as Arrow tables: the ragged columns stay list arrays instead of
+    becoming one numpy array per row."""
+    with stage('tiledb_read') as s:
+        batch = ds.read_arrow(attrs=attrs, regions=regions, samples=samples)
+        s.add(rows=batch.num_rows, bytes=batch.nbytes)
+    yield batch
+    while not ds.read_completed():
+        with stage('tiledb_read') as s:
+            batch = ds.continue_read_arrow()
+            s.add(rows=batch.num_rows, bytes=batch.nbytes)
+        yield batch
+
+
+class TileDBQueryStream:
+    """Iterable over the batches of one query, with an optional per-batch `row_filter` (returns a
+    boolean mask), an optional `transform` applied to the filtered batch (e.g. annotation), and an
+    optional `row_limit` on filtered rows. Reading stops as soon as the limit is hit, and
+    `truncated` tells the caller that rows were left behind. `attrs` not listed in `output_attrs`
+    are read for the filter/transform only and dropped from the yielded frames. `on_incomplete` is
+    called when iteration ends with the tiledb read still pending (row limit hit, error, or the
+    consumer closed the stream), so the caller can discard a reader that is left mid-read.
+    """
+
+    def __init__(self, ds:tv.Dataset,
+                 attrs:List[str],
+                 regions:List[str],
+                 samples:List[str],
+                 row_filter:Callable[[pd.DataFrame], object]=None,
+                 transform:Callable[[pd.DataFrame], pd.DataFrame]=None,
+                 row_limit:int=None,
+                 output_attrs:List[str]=None,
+                 on_incomplete:Callable[[], None]=None,
+                 ):
+        self.ds = ds
+        self.attrs = attrs
+        self.internal_attrs = [a for a in attrs if a not in output_attrs] if output_attrs is not None else []
+        self.regions = regions
+        self.samples = samples
+        self.row_filter = row_filter
+        self.transform = transform
+        self.row_limit = row_limit
+        self.on_incomplete = on_incomplete
+        self.truncated = False
+        self.batches_read = 0
+        self.rows_read = 0
+        self.rows_kept = 0
+
+    def __iter__(self) -> Iterator[pd.DataFrame]:
+        yielded = False
+        empty = None
+        completed = False
+        try:
+            for batch in iter_tiledb_batches(self.ds, self.attrs, self.regions, self.samples):
+                self.batches_read += 1
+                self.rows_read += batch.shape[0]
+                if self.row_filter is not None and batch.shape[0]:
+                    batch = batch.loc[self.row_filter(batch), :]
+
+                if self.row_limit:
+                    remaining = self.row_limit - self.rows_kept
+                    if batch.shape[0] > remaining:
+                        batch = batch.iloc[:remaining]
+                        self.truncated = True
+                self.rows_kept += batch.shape[0]
+
+                if batch.shape[0]:
+                    if self.transform is not None:
+                        batch = self.transform(batch)
+                    yielded = True
+                    yield batch.drop(columns=self.internal_attrs)
+                else:
+                    empty = batch.drop(columns=self.internal_attrs)
+
+                if self.truncated:
+                    break
+            else:
+                completed = True
+        finally:
+            if not completed and self.on_incomplete is not None and not self._read_completed():
+                self.on_incomplete()
+
+        logger.info(f'TileDBQueryStream: {self.batches_read} batches, {self.rows_read} rows read, '
+                    f'{self.rows_kept} rows kept, truncated={self.truncated}')
+        # always give the caller at least one (empty) frame so the columns are known
+        if not yielded and empty is not None:
+            yield empty
+
+    def _read_completed(self) -> bool:
+        try:
+            return self.ds.read_completed()
+        except Exception:
+            return False
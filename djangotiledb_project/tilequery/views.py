@@ -1,22 +1,45 @@
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, HttpResponseNotAllowed, StreamingHttpResponse, FileResponse, Http404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.shortcuts import get_object_or_404, redirect
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.urls import reverse
 
 import pandas as pd
 import numpy as np
-from typing import List
+from typing import List, Tuple
 import warnings
 import configparser
 import tiledbvcf as tv
+import pyarrow.parquet as pq
 import json
 import re
 import logging
 import os
 import datetime
 
-from annoquery.models import Clinvars, Snps, Genes
-from .utils.genotypeops import rowloop_index_a_with_b
+from .auth import authenticate_api_token
+from .models import QueryJob, Cohort
+from .utils.genotypeops import explode_alt_alleles, filter_genotype_to_variants_only_output_mask
+from .utils.annotationops import batch_search_for_snp_and_clinvar, clinvar_profile_fields
+from .utils.annotationbackends import get_annotation_backend
+from .utils.annotationcache import prewarm_annotations
+from .utils.geneindex import get_gene_index
+from .utils.datasetpool import DATASET_POOL, get_dataset
+from .utils.datasetmeta import DatasetMetadataService
+from .utils.samplecatalog import SampleCatalogService
+from .utils.cohortops import COHORT_NAME_PATTERN, expand_sample_tokens, parse_sample_list, visible_cohorts
+from .utils.streamops import TileDBQueryStream, iter_tiledb_arrow_batches
+from .utils.carrierops import CARRIER_ATTRS, CarrierScan
+from .utils.frequencyops import FREQUENCY_ATTRS, FREQUENCY_TABLE_VERSION, AlleleFrequencyAggregator
+from .utils.regionops import CHR_DICT_STR_TO_INT, REGION_ATTRS, parse_regions, normalize_regions, assign_rows_to_regions
+from .utils.identifierops import expand_query_tokens
+from .utils.arrowops import EXPORT_FORMATS, iter_export_bytes
+from .utils.resultcache import TRUNCATED_METADATA_KEY, ResultCache, canonical_query, query_cache_key
+from .utils.resultview import read_result_page
+from .utils.instrumentation import collect_metrics, current_trace, instrumented, render_prometheus, stage
 
 
 logger = logging.getLogger('django')
@@ -26,10 +49,25 @@ config = configparser.ConfigParser()
 config.read('staticfiles/tilequery/config.ini')
 MEMORY_BUDGET_MB=int(config['TILEDB'].get('MEMORY_BUDGET_MB', '32000'))
 URI=str(config['TILEDB'].get('URI', '/mnt/data/tileprism'))
+# memory budget of the streaming reads. Each incomplete-read batch is bounded by it.
+BATCH_MEMORY_BUDGET_MB=int(config['TILEDB'].get('BATCH_MEMORY_BUDGET_MB', '2048'))
+# regions closer than this many bp are read as one tiledb range
+REGION_MERGE_GAP=int(config['TILEDB'].get('REGION_MERGE_GAP', '1000'))
+# where background query jobs write their Parquet results
+JOB_RESULTS_DIR=str(config.get('JOBS', 'RESULTS_DIR', fallback=os.path.join(settings.BASE_DIR, 'job_results')))
+# on-disk query result cache shared by all workers, LRU-evicted above MAX_MB
+RESULT_CACHE_DIR=str(config.get('CACHE', 'RESULT_CACHE_DIR', fallback=os.path.join(settings.BASE_DIR, 'result_cache')))
+RESULT_CACHE_MAX_MB=int(config.get('CACHE', 'RESULT_CACHE_MAX_MB', fallback='2048'))
+# dataset attributes/samples cached per dataset uri and version
+DATASET_METADATA_DIR=str(config.get('CACHE', 'DATASET_METADATA_DIR', fallback=os.path.join(settings.BASE_DIR, 'dataset_metadata')))
+# which Clinvars columns are appended to the results: minimal, clinical or full
+CLINVAR_PROFILE=str(config.get('ANNOTATION', 'CLINVAR_PROFILE', fallback='clinical'))
 
 # persistent vars:
 pathogenic_vars = ['chr17:43124028-43124029', 'chr13:32340301-32340301', 'chr7:117559591-117559593', 'chr13:20189547-20189547', 'chr12:112477719-112477719', 'chr16:8811153-8811153', 'chr1:216247118-216247118', 'chr11:66211206-66211206', 'chr19:11116928-11116928', 'chr15:89327201-89327201', 'chrX:154030912-154030912', 'chr10:110964362-110964362', 'chr22:50627165-50627165', 'chr18:51078306-51078306', 'chr9:101427574-101427574', 'chr13:51944145-51944145', 'chr16:23636036-23636037', 'chr11:6617154-6617154', 'chr3:12604200-12604200', 'chr10:87933147-87933147', 'chr11:534289-534289', 'chr16:3243447-3243447', 'chr12:102840507-102840507', 'chr17:7674220-7674220', 'chr18:31592974-31592974', 'chr11:108251026-108251027', 'chr12:76347713-76347714', 'chr7:92501562-92501562', 'chr9:37783993-37783993', 'chr14:23426833-23426833', 'chr15:72346579-72346580', 'chr11:5226774-5226774', 'chr11:47337729-47337730', 'chr4:1801837-1801837', 'chr1:45331219-45331221', 'chr12:32802557-32802557', 'chr2:47803500-47803501', 'chr11:64759751-64759751', 'chr6:43007265-43007265', 'chr5:112839515-112839519', 'chr19:41970405-41970405', 'chr15:66436843-66436843', 'chr7:140801502-140801502', 'chr3:81648854-81648854', 'chr17:42903947-42903947', 'chr2:26195184-26195184', 'chr4:987858-987858', 'chr17:7222272-7222272', 'chr1:9726972-9726972', 'chr7:5986933-5986934', 'chr12:101753470-101753471', 'chr6:32040110-32040110', 'chr3:179234297-179234297', 'chr2:47414421-47414421', 'chr13:31269278-31269278', 'chr10:121520163-121520163', 'chr7:107683453-107683453', 'chr6:136898213-136898213', 'chr16:30737370-30737370', 'chr16:16163078-16163078', 'chr2:28776944-28776944', 'chr3:37047632-37047634', 'chr17:31214524-31214524', 'chr15:80180230-80180230', 'chr17:80118271-80118271', 'chr15:42387803-42387803', 'chr17:80212128-80212128', 'chr15:23645746-23645747', 'chr6:73644583-73644583', 'chr19:18162974-18162974', 'chrX:111685040-111685040', 'chr2:39022774-39022774', 'chr15:90761015-90761015', 'chr18:23536736-23536736', 'chr6:161785820-161785820', 'chr17:50167653-50167653', 'chr9:95172033-95172033', 'chr2:61839695-61839695', 'chr4:3493106-3493107', 'chr9:34649032-34649032', 'chr1:94029515-94029515', 'chr17:6425781-6425781', 'chr4:186274193-186274193', 'chr2:73914835-73914835', 'chr10:54317414-54317414', 'chr19:35831056-35831056', 'chr7:151576412-151576412', 'chr17:35103298-35103298', 'chr19:12649932-12649932', 'chr19:50323685-50323685', 'chr9:108899816-108899816', 'chr11:17531408-17531409', 'chr17:17216394-17216395', 'chr17:3499000-3499000', 'chr11:2167905-2167905', 'chr10:100749771-100749772', 'chrX:153932410-153932410', 'chr14:28767732-28767733', 'chr15:63060899-63060899', 'chr4:15567676-15567676']
 LATEST_COUNT = 0
+RESULT_CACHE = ResultCache(RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024)
+RESULT_KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
 
 # VCF header translation table
 VCF_TRANSLATE = {
@@ -37,42 +75,34 @@ VCF_TRANSLATE = {
 }
 
 QUERY_OPTION = 'tilequery/query.html'
+JOB_OPTION = 'tilequery/job.html'
+JOB_LIST_OPTION = 'tilequery/jobs.html'
+COHORT_LIST_OPTION = 'tilequery/cohorts.html'
 
-CHR_DICT_STR_TO_INT = {'chr1': 1, 'chr2': 2, 'chr3': 3, 
-                       'chr4': 4, 'chr5': 5, 'chr6': 6, 
-                       'chr7': 7, 'chr8': 8, 'chr9': 9, 
-                       'chr10': 10, 'chr11': 11, 'chr12': 12, 
-                       'chr13': 13, 'chr14': 14, 'chr15': 15, 
-                       'chr16': 16, 'chr17': 17, 'chr18': 18, 
-                       'chr19': 19, 'chr20': 20, 'chr21': 21, 
-                       'chr22': 22, 'chrX': 23, 'chrY': 24}
-
-CLINVAR_FIELDS = [f.name for f in Clinvars._meta.get_fields()]
+CLINVAR_FIELDS = clinvar_profile_fields(CLINVAR_PROFILE)
 
 CLINVAR_SEARCH_LIMIT = 0
 SNP_SEARCH_FLAG = True
-OVERALL_SEARCH_LIMIT = 1000
-
-# pre-fetch the help file
-def prefetch_helper_dataset():
-    p = './DF_COMPOSER_prefetched.pkl'
-    if os.path.exists(p):
-        DF_COMPOSER = pd.read_pickle(p) 
-    else:
-        cfg = tv.ReadConfig(memory_budget_mb=MEMORY_BUDGET_MB)
-        DS = tv.Dataset(URI, mode='r', cfg=cfg, verbose=False) 
-        DF_COMPOSER = pd.DataFrame([f'{",".join(DS.attributes())}', f'{",".join(DS.samples())}'], 
-                                columns=['property'], 
-                                index=['attributes', 'samples'])
-        DF_COMPOSER.to_pickle(p)
-        
-    return DF_COMPOSER
-
-DF_COMPOSER = prefetch_helper_dataset()
+# rows kept per interactive query. The result is paged from the result cache, so this bounds disk, not page size
+OVERALL_SEARCH_LIMIT=int(config.get('RESULTS', 'MAX_ROWS', fallback='100000'))
+# rows per page of the result table
+RESULT_PAGE_SIZE=int(config.get('RESULTS', 'PAGE_SIZE', fallback='100'))
+HELP_SAMPLE_PREVIEW = 20
+
+# attributes/samples of the dataset, loaded on first use (importing this module does no tiledb I/O)
+DATASET_METADATA = DatasetMetadataService(URI, MEMORY_BUDGET_MB, DATASET_METADATA_DIR)
+SAMPLE_CATALOG = SampleCatalogService(DATASET_METADATA)
+
+def prewarm_annotation_cache():
+    """Loads the gene index and the annotations of the pathogenic_vars hotspots into this worker's
+    caches. Started in a background thread by wsgi.py, see settings.ANNOTATION_CACHE_PREWARM."""
+    get_gene_index()
+    prewarm_annotations(get_annotation_backend(), pathogenic_vars, CLINVAR_FIELDS)
 
 # Create your views here.
 
 @login_required
+@instrumented('index')
 def index(request, methods=['GET', 'POST']): 
 
     def return_with_error(e:Exception, query_summary=None):
@@ -83,14 +113,18 @@ def index(request, methods=['GET', 'POST']):
     
     if request.method == 'POST':     
 
-        time_start = datetime.datetime.now()
-        
         regions=request.POST.get('regions').split(',')
         samples=request.POST.get('samples').split(',')
         attrs=request.POST.get('attrs').split(',')
         clinvar_flag=request.POST.get('clinvar', False)
         hidenonvariants_flag=request.POST.get('hidenonvariants', False)
         genelist_flag=request.POST.get('genelist', False)
+        background_flag=request.POST.get('background', False)
+        # `carriers`: per variant the samples carrying it and per sample the variants it carries, see `_carrier_scan_tiledb`
+        carrier_flag=request.POST.get('mode') == 'carriers'
+        # `frequencies`: AC/AN/AF and genotype counts per variant over the samples, see `_allele_frequency_tiledb`
+        frequency_flag=request.POST.get('mode') == 'frequencies'
+        mode = 'carriers' if carrier_flag else 'frequencies' if frequency_flag else 'genotypes'
         
         if all([x=='' for x in regions]) and (all([x=='' for x in samples]) if samples else True):
             w  = '<_query_tiledb> regions:List[str] must not be empty strings. Returning the possible samples and attributes you may query.'
@@ -101,37 +135,285 @@ def index(request, methods=['GET', 'POST']):
             regions = pathogenic_vars            
             messages.add_message(request, messages.WARNING, 'Region unspecified but samples specified, so a list of pathogenic variants from clinvar was substituted.')
             
+        # gene symbols and rsIDs are expanded into their coordinates via indexed bulk lookups
+        regions, unresolved = expand_query_tokens(regions)
+        if unresolved:
+            return return_with_error(ValueError(f'Could not resolve gene symbol(s)/rsID(s): {",".join(unresolved)}'))
+
+        # malformed regions or unknown contigs fail here with a readable message instead of deep inside tiledbvcf
+        try:
+            parse_regions(regions)
+        except ValueError as e:
+            return return_with_error(e)
+        # `cohort:<name>` tokens become the cohort's stored samples; the job keeps the tokens
+        sample_tokens = samples
+        samples, sample_key, unresolved_cohorts = expand_sample_tokens(sample_tokens, request.user)
+        if unresolved_cohorts:
+            return return_with_error(ValueError(f'<index> unknown or empty cohort(s): {",".join(unresolved_cohorts)}'))
+        unknown_samples = SAMPLE_CATALOG.get().unknown(samples)
+        if unknown_samples:
+            return return_with_error(ValueError(f'<index> unknown sample(s): {",".join(unknown_samples[:20])}'))
+
+        if carrier_flag or frequency_flag:
+            if background_flag:
+                return return_with_error(ValueError(f'<index> {mode} queries are not run in the background. Untick "Run in background?".'))
+            attrs = CARRIER_ATTRS if carrier_flag else FREQUENCY_ATTRS
+
+        # long cohort queries go to the background workers (`manage.py runqueryworkers`) instead of blocking this one
+        if background_flag:
+            job = QueryJob.objects.create(user=request.user, params=dict(
+                regions=regions, samples=sample_tokens, attrs=attrs,
+                clinvar_flag=bool(clinvar_flag),
+                hidenonvariants_flag=bool(hidenonvariants_flag),
+                genelist_flag=bool(genelist_flag),
+                ))
+            return redirect('job_detail', job_id=job.pk)
+
         # GENERATE QUERY SUMMARY
-        query_summary = pd.DataFrame([",".join(regions), ",".join(samples), ",".join(attrs)], columns=['query'], index=['regions', 'samples', 'attributes'])
+        # cohorts are summarized by name and size rather than by their (possibly thousands of) samples
+        samples_summary = ",".join(sample_tokens)
+        if sample_key != samples:
+            samples_summary += f' ({len(samples)} samples)'
+        query_summary = pd.DataFrame([",".join(regions), samples_summary, ",".join(attrs)], columns=['query'], index=['regions', 'samples', 'attributes'])
 
         # THE TILEDB SEARCH STARTS HERE        
+        carrier_key = None
         try:
-            df = _query_tiledb(request, regions=regions, samples=samples, attrs=attrs, 
-                               clinvar_flag=clinvar_flag, 
-                               hidenonvariants_flag=hidenonvariants_flag,
-                               genelist_flag=genelist_flag,
-                               )
-            df.index.name = 'S/N'
+            if carrier_flag:
+                result_key, carrier_key, cache_status = _cached_carrier_scan(regions=regions, samples=samples,
+                                                                             sample_key=sample_key,
+                                                                             clinvar_flag=clinvar_flag,
+                                                                             genelist_flag=genelist_flag,
+                                                                             )
+            elif frequency_flag:
+                result_key, cache_status = _cached_allele_frequencies(regions=regions, samples=samples,
+                                                                      sample_key=sample_key,
+                                                                      clinvar_flag=clinvar_flag,
+                                                                      genelist_flag=genelist_flag,
+                                                                      )
+            else:
+                result_key, cache_status = _cached_query_tiledb(request, regions=regions, samples=samples, attrs=attrs, 
+                                                                sample_key=sample_key,
+                                                                clinvar_flag=clinvar_flag, 
+                                                                hidenonvariants_flag=hidenonvariants_flag,
+                                                                genelist_flag=genelist_flag,
+                                                                )
         except Exception as e:
             return return_with_error(e, query_summary=query_summary.style.pipe(style_result_dataframe).render())
 
-        df = dataframe_common_final_reformat(df)
-
-        time_end = datetime.datetime.now()
-        elapsed_seconds = (time_end - time_start).seconds
-        query_summary.loc['query_details'] = [f'time={elapsed_seconds} secs | SNP search={SNP_SEARCH_FLAG} | Clinvar search={clinvar_flag} | HideNonVariants={hidenonvariants_flag} | clinvar_limit={CLINVAR_SEARCH_LIMIT} | overall_limit = {OVERALL_SEARCH_LIMIT}']
-
-        ### STYLE ####       
-        final_content = df.style.pipe(style_result_dataframe).to_html()
-        ##############
-        context =  dict(answer=final_content, 
-                        query_summary=query_summary.style.pipe(style_result_dataframe).to_html(), 
-                        )
-        return render(request, QUERY_OPTION, context)
+        trace = current_trace()
+        query_summary.loc['query_details'] = [f'time={trace.elapsed():.3f} secs | SNP search={SNP_SEARCH_FLAG} | Clinvar search={clinvar_flag} | HideNonVariants={hidenonvariants_flag} | clinvar_limit={CLINVAR_SEARCH_LIMIT} | overall_limit = {OVERALL_SEARCH_LIMIT} | mode={mode} | cache={cache_status}']
+        query_summary.loc['stages'] = [f'{trace.summary()} | db queries={trace.db_queries}']
+
+        # the page only gets an empty table, its rows are fetched page by page from `result_page`
+        with stage('render') as s:
+            context =  dict(result_url=reverse('result_page', kwargs=dict(key=result_key)),
+                            page_size=RESULT_PAGE_SIZE,
+                            query_summary=query_summary.style.pipe(style_result_dataframe).to_html(), 
+                            )
+            if carrier_key is not None:
+                context['carrier_result_url'] = reverse('result_page', kwargs=dict(key=carrier_key))
+            response = render(request, QUERY_OPTION, context)
+            s.add(bytes=len(response.content))
+        return response
         
     else:            
         return render(request, QUERY_OPTION)    
 
+@login_required
+def sample_search(request):
+    """JSON autocomplete over the dataset's sample names: `?q=<text>&mode=prefix|substring&offset=&limit=`."""
+    try:
+        offset = int(request.GET.get('offset', 0))
+        limit = int(request.GET.get('limit', 20))
+        total, results = SAMPLE_CATALOG.get().search(request.GET.get('q', ''),
+                                                     mode=request.GET.get('mode', 'prefix'),
+                                                     offset=offset, limit=limit)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return JsonResponse(dict(total=total, offset=offset, results=results))
+
+@login_required
+def cohort_list(request):
+    """The cohorts the user can reference as `cohort:<name>`. POST saves one: `name`, `samples`
+    (comma, whitespace or newline separated, or an uploaded `samples_file`), `description`, `shared`.
+    Saving an existing name of the user replaces its samples."""
+    if request.method == 'POST':
+        name = request.POST.get('name', '').strip()
+        text = request.POST.get('samples', '')
+        if 'samples_file' in request.FILES:
+            text += '\n' + request.FILES['samples_file'].read().decode(errors='replace')
+        samples = parse_sample_list(text)
+        if not COHORT_NAME_PATTERN.match(name):
+            messages.add_message(request, messages.WARNING, f'<cohort_list> invalid cohort name "{name}". Use up to 64 letters, digits, "_", "." or "-".')
+        elif not samples:
+            messages.add_message(request, messages.WARNING, '<cohort_list> a cohort needs at least one sample.')
+        else:
+            unknown_samples = SAMPLE_CATALOG.get().unknown(samples)
+            if unknown_samples:
+                messages.add_message(request, messages.WARNING, f'<cohort_list> unknown sample(s): {",".join(unknown_samples[:20])}')
+            else:
+                cohort = Cohort.objects.filter(owner=request.user, name=name).first() or Cohort(owner=request.user, name=name)
+                cohort.description = request.POST.get('description', '')[:255]
+                cohort.shared = bool(request.POST.get('shared', False))
+                cohort.set_samples(samples)
+                cohort.save()
+                return redirect('cohort_list')
+    cohorts = visible_cohorts(request.user).defer('samples_blob')
+    return render(request, COHORT_LIST_OPTION, dict(cohorts=cohorts))
+
+@login_required
+def cohort_delete(request, cohort_id):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    get_object_or_404(Cohort, pk=cohort_id, owner=request.user).delete()
+    return redirect('cohort_list')
+
+def metrics(request):
+    """Prometheus text metrics summed over every worker: request and stage durations, rows, DB queries
+    and bytes per stage, result cache events. Only served to staff, either logged in or through the
+    bearer ApiToken of a staff user (see `create_api_token`), which is what the scraper sends."""
+    user = request.user if request.user.is_authenticated else authenticate_api_token(request)
+    if user is None:
+        response = HttpResponse('A staff login or "Authorization: Bearer <token>" header is required.', status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    if not user.is_staff:
+        raise PermissionDenied()
+    text = render_prometheus(collect_metrics(),
+                             extra_counters={'tilequery_result_cache_events_total': RESULT_CACHE.stats()})
+    return HttpResponse(text, content_type='text/plain; version=0.0.4')
+
+def _get_user_job(request, job_id) -> QueryJob:
+    job = get_object_or_404(QueryJob, pk=job_id)
+    if job.user_id != request.user.pk and not request.user.is_staff:
+        raise Http404('No such job.')
+    return job
+
+@login_required
+def job_list(request):
+    jobs = QueryJob.objects.filter(user=request.user)[:100]
+    return render(request, JOB_LIST_OPTION, dict(jobs=jobs))
+
+@login_required
+def job_detail(request, job_id):
+    """Status/progress of a background query, and its result table once done. Results are read back
+    from the stored Parquet file, so reopening a finished job does not re-run the query."""
+    job = _get_user_job(request, job_id)
+    context = dict(job=job)
+    if job.status == QueryJob.DONE and os.path.exists(job.result_path):
+        context['total_rows'] = pq.ParquetFile(job.result_path).metadata.num_rows
+        context['result_url'] = reverse('job_result_page', kwargs=dict(job_id=job.pk))
+        context['page_size'] = RESULT_PAGE_SIZE
+    return render(request, JOB_OPTION, context)
+
+def _result_page_response(request, path:str) -> JsonResponse:
+    try:
+        with stage('result_page') as s:
+            page = read_result_page(path,
+                                    offset=int(request.GET.get('offset', 0)),
+                                    limit=int(request.GET.get('limit', RESULT_PAGE_SIZE)),
+                                    sort=request.GET.get('sort') or None,
+                                    descending=request.GET.get('order') == 'desc',
+                                    filter_column=request.GET.get('filter_column') or None,
+                                    filter_text=request.GET.get('filter', ''),
+                                    )
+            s.add(rows=len(page['rows']))
+    except ValueError as e:
+        return JsonResponse(dict(error=str(e)), status=400)
+    except OSError:
+        return JsonResponse(dict(error='This result is no longer stored. Run the query again.'), status=404)
+    return JsonResponse(page)
+
+@login_required
+@instrumented('result_page')
+def result_page(request, key):
+    """JSON page of a query result held in RESULT_CACHE: `?offset=&limit=&sort=<column>&order=asc|desc
+    &filter_column=<column>&filter=<text>`. Keys are content hashes, so they are not guessable."""
+    if not RESULT_KEY_PATTERN.match(key):
+        raise Http404('No such result.')
+    path = RESULT_CACHE.entry_path(key)
+    if path is None:
+        return JsonResponse(dict(error='This result is no longer stored. Run the query again.'), status=404)
+    return _result_page_response(request, path)
+
+@login_required
+@instrumented('job_result_page')
+def job_result_page(request, job_id):
+    """Same as `result_page`, over a finished background job's Parquet file."""
+    job = _get_user_job(request, job_id)
+    if job.status != QueryJob.DONE:
+        raise Http404('Job has no result yet.')
+    return _result_page_response(request, job.result_path)
+
+@login_required
+def job_download(request, job_id):
+    job = _get_user_job(request, job_id)
+    if job.status != QueryJob.DONE or not os.path.exists(job.result_path):
+        raise Http404('Job has no result yet.')
+    return FileResponse(open(job.result_path, 'rb'), as_attachment=True, filename=f'tilequery_{job.pk}.parquet')
+
+@login_required
+@instrumented('export')
+def export(request):
+    """Same inputs as `index`, but streams the full result as a download (csv, tsv, arrow or parquet).
+    TileDB is read batch by batch and every batch is encoded and sent before the next one is read,
+    so memory stays flat and the first bytes go out immediately. No OVERALL_SEARCH_LIMIT applies."""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    regions=request.POST.get('regions', '').split(',')
+    samples=request.POST.get('samples', '').split(',')
+    attrs=request.POST.get('attrs', '').split(',')
+    clinvar_flag=request.POST.get('clinvar', False)
+    hidenonvariants_flag=request.POST.get('hidenonvariants', False)
+    genelist_flag=request.POST.get('genelist', False)
+    fmt=request.POST.get('format', 'csv')
+    mode=request.POST.get('mode') or 'genotypes'
+
+    if mode != 'genotypes':
+        # the carrier and frequency tables are aggregates of the whole scan, not a stream of batches
+        return HttpResponseBadRequest(f'{mode} queries cannot be downloaded, only genotypes. Choose the genotypes mode to download.')
+    if fmt not in EXPORT_FORMATS:
+        return HttpResponseBadRequest(f'Unknown export format {fmt}. Choose from {",".join(EXPORT_FORMATS)}.')
+    if all([x=='' for x in regions]):
+        if all([x=='' for x in samples]):
+            return HttpResponseBadRequest('regions and samples must not both be empty.')
+        regions = pathogenic_vars
+    regions, unresolved = expand_query_tokens(regions)
+    if unresolved:
+        return HttpResponseBadRequest(f'Could not resolve gene symbol(s)/rsID(s): {",".join(unresolved)}')
+    try:
+        parse_regions(regions)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    samples, _, unresolved_cohorts = expand_sample_tokens(samples, request.user)
+    if unresolved_cohorts:
+        return HttpResponseBadRequest(f'Unknown or empty cohort(s): {",".join(unresolved_cohorts)}')
+    unknown_samples = SAMPLE_CATALOG.get().unknown(samples)
+    if unknown_samples:
+        return HttpResponseBadRequest(f'Unknown sample(s): {",".join(unknown_samples[:20])}')
+
+    stream = _stream_query_tiledb(regions=regions, samples=samples, attrs=attrs,
+                                  clinvar_flag=clinvar_flag,
+                                  hidenonvariants_flag=hidenonvariants_flag,
+                                  genelist_flag=genelist_flag,
+                                  )
+
+    def frames():
+        try:
+            for df in stream:
+                yield dataframe_common_final_reformat(df)
+        except Exception:
+            logger.exception('export: tiledb stream failed')
+            DATASET_POOL.discard(URI, BATCH_MEMORY_BUDGET_MB)
+            raise
+
+    content_type, extension = EXPORT_FORMATS[fmt]
+    response = StreamingHttpResponse(iter_export_bytes(frames(), fmt), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="tilequery_{datetime.datetime.now():%Y%m%d_%H%M%S}.{extension}"'
+    return response
+
 # class tiledb:
 #     def __init__(self, uri:str=URI, memory_budget_mb:int=MEMORY_BUDGET_MB) -> None:
 #         # load database        
@@ -148,6 +430,62 @@ def index(request, methods=['GET', 'POST']):
 #         df = self.ds.read(attrs=attrs, regions=regions, samples=samples)
 #         return df
 
+def _stream_query_tiledb(regions:List[str],
+                         samples:List[str],
+                         attrs:List[str]=['sample_name', 'id', 'alleles', 'fmt_GT', 'contig', 'pos_start', 'pos_end', 'info_AF'],
+                         uri:str=URI,
+                         memory_budget_mb:int=BATCH_MEMORY_BUDGET_MB,
+                         clinvar_flag=False,
+                         hidenonvariants_flag=False,
+                         genelist_flag=False,
+                         row_limit:int=None,
+                         ) -> TileDBQueryStream:
+    """The query as a stream of batches: each tiledb batch is variant-filtered and annotated on its own,
+    so memory is bounded by `memory_budget_mb` and reading stops once `row_limit` rows are kept."""
+
+    flags = {'clinvar_flag':clinvar_flag,
+             'hidenonvariants_flag':hidenonvariants_flag,
+             'genelist_flag':genelist_flag,
+             }
+
+    # sorted/merged regions: one tiledb range read per merged block instead of one per pasted region
+    original_regions, merged_regions = normalize_regions(regions, gap=REGION_MERGE_GAP)
+    # the gap filter needs the coordinates whether or not they were selected; unselected ones are projected away
+    can_map_regions = all(a in attrs for a in REGION_ATTRS)
+    read_attrs = attrs + [a for a in REGION_ATTRS if a not in attrs]
+    variants_only = hidenonvariants_flag or clinvar_flag or genelist_flag
+
+    def row_filter(batch):
+        mask = np.ones(batch.shape[0], dtype=bool)
+        if variants_only:
+            with stage('variant_filter', rows=batch.shape[0]):
+                mask &= filter_genotype_to_variants_only_output_mask(batch.fmt_GT)
+        if REGION_MERGE_GAP:
+            # drop records that only lie in the gap between two coalesced regions
+            with stage('region_filter', rows=batch.shape[0]):
+                mask &= pd.notna(assign_rows_to_regions(batch, original_regions))
+        return mask
+
+    def transform(batch):
+        batch = batch.copy()
+        if can_map_regions:
+            batch['query_region'] = assign_rows_to_regions(batch, original_regions)
+        if clinvar_flag or genelist_flag:
+            batch = _append_tiledb_with_annotation(batch, flags=flags)
+        return batch
+
+    # reuse this worker's open reader instead of reloading schema/fragment metadata on every request
+    with stage('dataset_open'):
+        ds = get_dataset(uri, memory_budget_mb)
+    return TileDBQueryStream(ds, attrs=read_attrs, regions=merged_regions, samples=samples,
+                             row_filter=row_filter,
+                             transform=transform,
+                             row_limit=row_limit,
+                             output_attrs=attrs,
+                             # a reader left mid-read must not be handed to this thread's next request
+                             on_incomplete=lambda: DATASET_POOL.discard(uri, memory_budget_mb),
+                             )
+
 # @login_required
 def _query_tiledb(request,
                   regions:List[str],
@@ -155,49 +493,239 @@ def _query_tiledb(request,
                   attrs:List[str]=['sample_name', 'id', 'alleles', 'fmt_GT', 'contig', 'pos_start', 'pos_end', 'info_AF'],
                 #   attrs:Union[None, List[str]]=['sample_name', 'alleles', 'fmt_GT', 'contig', 'pos_start'], 
                   uri:str=URI, 
-                  memory_budget_mb:int=MEMORY_BUDGET_MB,
+                  memory_budget_mb:int=BATCH_MEMORY_BUDGET_MB,
                   clinvar_flag=False,
                   hidenonvariants_flag=False,
                   genelist_flag=False,
                   )->pd.DataFrame:
 
-    flags = {'clinvar_flag':clinvar_flag,
-             'hidenonvariants_flag':hidenonvariants_flag,
-             'genelist_flag':genelist_flag,
-             }
-
     # if regions and sample are empty, return error
     # if regions empty but sample not empty, substitute the pathogenic var list.
     # if regions specified and sample specified, proceed as normal to extract all samples.
     
-    cfg = tv.ReadConfig(memory_budget_mb=memory_budget_mb)
-    ds = tv.Dataset(uri, mode='r', cfg=cfg, verbose=False)   
-    df = ds.read(attrs=attrs, regions=regions, samples=samples)
-
-    if hidenonvariants_flag or clinvar_flag or genelist_flag:
-        df = df.loc[filter_genotype_to_variants_only_output_mask(df.fmt_GT), :]
-
-    if OVERALL_SEARCH_LIMIT and (df.shape[0] > OVERALL_SEARCH_LIMIT):
-        messages.add_message(request, messages.WARNING, f'More than {OVERALL_SEARCH_LIMIT} records retrieved. Not executing gene/snp/clinvar search.')
-        return df
-
-    if (df.shape[0] > 0) and (clinvar_flag or genelist_flag):
-        df = _append_tiledb_with_annotation(df, flags=flags)
+    stream = _stream_query_tiledb(regions=regions, samples=samples, attrs=attrs,
+                                  uri=uri, memory_budget_mb=memory_budget_mb,
+                                  clinvar_flag=clinvar_flag,
+                                  hidenonvariants_flag=hidenonvariants_flag,
+                                  genelist_flag=genelist_flag,
+                                  row_limit=OVERALL_SEARCH_LIMIT,
+                                  )
+    try:
+        df = pd.concat(list(stream), ignore_index=True)
+    except Exception:
+        DATASET_POOL.discard(uri, memory_budget_mb)
+        raise
+
+    if stream.truncated:
+        messages.add_message(request, messages.WARNING, f'More than {OVERALL_SEARCH_LIMIT} records retrieved. Only the first {OVERALL_SEARCH_LIMIT} are shown.')
+    df.attrs['truncated'] = stream.truncated
     
     return df
 
+def _query_cache_versions(clinvar_flag, genelist_flag, row_limit:int) -> dict:
+    """Everything besides the query itself that a cached result depends on."""
+    versions = dict(dataset=DATASET_POOL.version(URI, BATCH_MEMORY_BUDGET_MB),
+                    row_limit=row_limit)
+    if clinvar_flag or genelist_flag:
+        versions['annodb'] = get_annotation_backend().version()
+    if clinvar_flag:
+        versions['clinvar_profile'] = CLINVAR_PROFILE
+    return versions
+
+def _cached_query_tiledb(request,
+                         regions:List[str],
+                         samples:List[str],
+                         attrs:List[str],
+                         clinvar_flag=False,
+                         hidenonvariants_flag=False,
+                         genelist_flag=False,
+                         sample_key:List[str]=None,
+                         ):
+    """`_query_tiledb` behind the on-disk RESULT_CACHE. The key is the canonicalized query plus the
+    dataset version and, when annotating, the annotation backend version, so new fragments or
+    reloaded annotations never serve stale results. `sample_key` (see `expand_sample_tokens`) replaces
+    `samples` in the key when given. Returns (key, 'hit'|'miss'); the result is read from the cache
+    entry by `result_page`."""
+    flags = {'clinvar_flag':clinvar_flag,
+             'hidenonvariants_flag':hidenonvariants_flag,
+             'genelist_flag':genelist_flag,
+             }
+    versions = _query_cache_versions(clinvar_flag, genelist_flag, row_limit=OVERALL_SEARCH_LIMIT)
+    key = query_cache_key(canonical_query(regions, sample_key if sample_key is not None else samples, attrs, flags, **versions))
+
+    path = RESULT_CACHE.entry_path(key)
+    if path is not None:
+        metadata = pq.read_schema(path).metadata or {}
+        if metadata.get(TRUNCATED_METADATA_KEY) == b'1':
+            messages.add_message(request, messages.WARNING, f'More than {OVERALL_SEARCH_LIMIT} records retrieved. Only the first {OVERALL_SEARCH_LIMIT} are shown.')
+        return key, 'hit'
+
+    df = _query_tiledb(request, regions=regions, samples=samples, attrs=attrs, 
+                       clinvar_flag=clinvar_flag, 
+                       hidenonvariants_flag=hidenonvariants_flag,
+                       genelist_flag=genelist_flag,
+                       )
+    try:
+        RESULT_CACHE.put(key, dataframe_common_final_reformat(df), truncated=df.attrs.get('truncated', False))
+    except Exception:
+        # the page is rendered from the stored result, so there is nothing to show without it
+        logger.exception('_cached_query_tiledb: could not store result')
+        raise RuntimeError('<_cached_query_tiledb> could not store the query result. Try again or use Download.')
+    return key, 'miss'
+
+def _carrier_scan_tiledb(regions:List[str],
+                         samples:List[str],
+                         uri:str=URI,
+                         memory_budget_mb:int=BATCH_MEMORY_BUDGET_MB,
+                         clinvar_flag=False,
+                         genelist_flag=False,
+                         ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Carrier-scan mode: which of `samples` carry a non-reference allele at each variant of `regions`,
+    e.g. a whole cohort against `pathogenic_vars`. Only CARRIER_ATTRS are read, as Arrow batches; each
+    batch is reduced to its carrier calls right after the GT column is decoded, and the carriers are
+    aggregated in numpy (see `carrierops.CarrierScan`), so no per-genotype dataframe is ever built.
+    Returns (variant table, sample table), the variant table annotated once per variant."""
+    original_regions, merged_regions = normalize_regions(regions, gap=REGION_MERGE_GAP)
+    scan = CarrierScan(samples_scanned=_samples_scanned(samples),
+                       regions=original_regions if REGION_MERGE_GAP else None)
+
+    with stage('dataset_open'):
+        ds = get_dataset(uri, memory_budget_mb)
+    try:
+        for batch in iter_tiledb_arrow_batches(ds, CARRIER_ATTRS, merged_regions, samples):
+            with stage('carrier_filter', rows=batch.num_rows):
+                scan.add(batch)
+    except Exception:
+        DATASET_POOL.discard(uri, memory_budget_mb)
+        raise
+    with stage('carrier_aggregate') as s:
+        variants, carriers = scan.tables()
+        s.add(rows=variants.shape[0])
+    logger.info(f'_carrier_scan_tiledb: {scan.records_read} records read, {variants.shape[0]} variants, {carriers.shape[0]} carriers')
+    return _annotate_variant_table(variants, clinvar_flag, genelist_flag), carriers
+
+def _samples_scanned(samples:List[str]) -> int:
+    # a blank samples field reads every sample of the dataset
+    requested = [x for x in samples if x]
+    return len(requested) if requested else len(SAMPLE_CATALOG.get())
+
+def _annotate_variant_table(variants:pd.DataFrame, clinvar_flag=False, genelist_flag=False) -> pd.DataFrame:
+    """Gene and dbSNP/ClinVar columns for a table with one row per variant (`contig`, `chr_int`,
+    `pos_start`, `pos_end`, `alt_allele`), i.e. one lookup per variant instead of per genotype.
+    `chr_int` is dropped from the result."""
+    if genelist_flag and variants.shape[0]:
+        with stage('gene_lookup', rows=variants.shape[0]):
+            variants['gene'] = get_gene_index().lookup(variants['chr_int'], variants['pos_start'], variants['pos_end'])
+    if clinvar_flag and variants.shape[0]:
+        # without a VCF ID column every rsID comes from the dbSNP lookup
+        annotation = batch_search_for_snp_and_clinvar(variants if 'id' in variants.columns else variants.assign(id='.'),
+                                                      clinvar_fields=CLINVAR_FIELDS,
+                                                      snp_search=SNP_SEARCH_FLAG,
+                                                      backend=get_annotation_backend(),
+                                                      )
+        variants = pd.concat([variants, annotation.rename(columns={'id':'clinvar_id'})], axis=1)
+    return variants.drop(columns=['chr_int'])
+
+def _cached_carrier_scan(regions:List[str],
+                         samples:List[str],
+                         clinvar_flag=False,
+                         genelist_flag=False,
+                         sample_key:List[str]=None,
+                         ):
+    """`_carrier_scan_tiledb` behind RESULT_CACHE. Both tables are stored, under the query key plus
+    `table=variants|samples`. Returns (variant table key, sample table key, 'hit'|'miss')."""
+    flags = {'carrier_scan':True,
+             'clinvar_flag':clinvar_flag,
+             'genelist_flag':genelist_flag,
+             }
+    versions = _query_cache_versions(clinvar_flag, genelist_flag, row_limit=None)
+    query = canonical_query(regions, sample_key if sample_key is not None else samples, CARRIER_ATTRS, flags, **versions)
+    variants_key = query_cache_key(dict(query, table='variants'))
+    samples_key = query_cache_key(dict(query, table='samples'))
+    if RESULT_CACHE.entry_path(variants_key) is not None and RESULT_CACHE.entry_path(samples_key) is not None:
+        return variants_key, samples_key, 'hit'
+
+    variants, carriers = _carrier_scan_tiledb(regions=regions, samples=samples,
+                                              clinvar_flag=clinvar_flag,
+                                              genelist_flag=genelist_flag,
+                                              )
+    try:
+        RESULT_CACHE.put(variants_key, variants)
+        RESULT_CACHE.put(samples_key, carriers)
+    except Exception:
+        logger.exception('_cached_carrier_scan: could not store result')
+        raise RuntimeError('<_cached_carrier_scan> could not store the carrier scan result. Try again.')
+    return variants_key, samples_key, 'miss'
+
+def _allele_frequency_tiledb(regions:List[str],
+                             samples:List[str],
+                             uri:str=URI,
+                             memory_budget_mb:int=BATCH_MEMORY_BUDGET_MB,
+                             clinvar_flag=False,
+                             genelist_flag=False,
+                             ) -> pd.DataFrame:
+    """Aggregation mode: AC, AN, AF, genotype class and missingness counts per variant over `samples`,
+    one row per variant. The batches of the read are streamed into an AlleleFrequencyAggregator, so
+    memory follows the number of sites, and no OVERALL_SEARCH_LIMIT applies to the genotypes read.
+    `no_record` counts the samples without any record at the site."""
+    original_regions, merged_regions = normalize_regions(regions, gap=REGION_MERGE_GAP)
+    aggregator = AlleleFrequencyAggregator(samples_scanned=_samples_scanned(samples))
+
+    with stage('dataset_open'):
+        ds = get_dataset(uri, memory_budget_mb)
+    try:
+        for batch in iter_tiledb_arrow_batches(ds, FREQUENCY_ATTRS, merged_regions, samples):
+            with stage('allele_count', rows=batch.num_rows):
+                aggregator.add(batch)
+    except Exception:
+        DATASET_POOL.discard(uri, memory_budget_mb)
+        raise
+    with stage('allele_aggregate') as s:
+        variants = aggregator.table(regions=original_regions if REGION_MERGE_GAP else None)
+        s.add(rows=variants.shape[0])
+    logger.info(f'_allele_frequency_tiledb: {aggregator.records_read} records read, {variants.shape[0]} variants')
+    return _annotate_variant_table(variants, clinvar_flag, genelist_flag)
+
+def _cached_allele_frequencies(regions:List[str],
+                               samples:List[str],
+                               clinvar_flag=False,
+                               genelist_flag=False,
+                               sample_key:List[str]=None,
+                               ):
+    """`_allele_frequency_tiledb` behind RESULT_CACHE. Returns (key, 'hit'|'miss')."""
+    flags = {'allele_frequency':True,
+             'clinvar_flag':clinvar_flag,
+             'genelist_flag':genelist_flag,
+             }
+    versions = _query_cache_versions(clinvar_flag, genelist_flag, row_limit=None)
+    key = query_cache_key(canonical_query(regions, sample_key if sample_key is not None else samples, FREQUENCY_ATTRS, flags,
+                                          table_version=FREQUENCY_TABLE_VERSION, **versions))
+    if RESULT_CACHE.entry_path(key) is not None:
+        return key, 'hit'
+
+    variants = _allele_frequency_tiledb(regions=regions, samples=samples,
+                                        clinvar_flag=clinvar_flag,
+                                        genelist_flag=genelist_flag,
+                                        )
+    try:
+        RESULT_CACHE.put(key, variants)
+    except Exception:
+        logger.exception('_cached_allele_frequencies: could not store result')
+        raise RuntimeError('<_cached_allele_frequencies> could not store the allele frequency result. Try again.')
+    return key, 'miss'
+
 @login_required
 def _help_tiledb(request,
                  uri:str=URI, 
                  memory_budget_mb:int=MEMORY_BUDGET_MB) -> pd.DataFrame:
-    # cfg = tv.ReadConfig(memory_budget_mb=memory_budget_mb)
-    # ds = tv.Dataset(uri, mode='r', cfg=cfg, verbose=True) 
-
-    # composer = [f'{",".join(ds.attributes())}', f'{",".join(ds.samples())}']
-    # composer = [f'{",".join(DS.attributes())}', f'{",".join(DS.samples())}']
-    
-    # return pd.DataFrame(composer, columns=['property'], index=['attributes', 'samples'])
-    return DF_COMPOSER
+    # only a sample count and a short preview: the full list is searched through `sample_search`
+    metadata = DATASET_METADATA.get()
+    catalog = SAMPLE_CATALOG.get()
+    _, preview = catalog.search(offset=0, limit=HELP_SAMPLE_PREVIEW)
+    return pd.DataFrame([f'{",".join(metadata.attributes)}',
+                         f'{len(catalog)} samples, e.g. {",".join(preview)}. Type in the samples field to search them.'],
+                        columns=['property'],
+                        index=['attributes', 'samples'])
  
 
 def _append_tiledb_with_annotation(df, 
@@ -215,130 +743,47 @@ def _append_tiledb_with_annotation(df,
 
     `show_only_alt` == True : means that variants with genotype [0 0] will be discarded automatically
     """    
-    # get unique set of chr,start,stop,allele, which may be greater 
-    # than the inputted search because of multiple hits or different
-    # alleles.
-
-    # res_df_gene = pd.DataFrame(np.nan, index=df.index, columns=['gene_symbol','gene_product'])
-
-    # do gene search which doesn't need the allele explosion operation. so may have to skip some rows. could skip based on the index.
-    # NB this is SLOW. faster way would be to find a super set of the region being queried, get a list of all the genes
-    # in that region, then match region to gene. That way I only query the database once!
-    def genelist_lookup_inside_loop(row:pd.Series):
-        gene_hit_items = (Genes.objects.filter(chromosome=row.loc['chr_int'])
-                          .order_by('start')
-                          .filter(start__lte=row.loc[start_label], 
-                                  stop__gte=row.loc[stop_label],
-                                  )
-                          )
-        # gene_hit = gene_hit_items.first()
-        # return [gene_hit.gene, gene_hit.product] if gene_hit else [np.nan, np.nan]
-
-        if gene_hit_items:
-            gene_hits = ';'.join((list(set([re.sub(r'^gene\=', '', f'{g.gene}') for g in gene_hit_items]))))
-        else:
-            gene_hits = np.nan
-        return gene_hits
-
-    def search_for_snp_and_clinvar(s:pd.Series):
-        if s.loc['id'] != ".":
-            snp = s.loc['id']
-        else:
-            # # SNPS
-            if SNP_SEARCH_FLAG:
-                logger.info(f'search_for_snp_and_clinvar:input `s`: {s.shape}')
-                snp_hits = list(Snps.objects.filter(chr=s.loc[chromosome_label], 
-                                                    start=s.loc[start_label]).filter(
-                                                        stop=s.loc[stop_label],
-                                                        alt=s.loc['alt_allele'],
-                                    )
-                                )
-                logger.info(f'search_for_snp_and_clinvar: snp_hits length: {len(snp_hits)}')
-                
-                # for now, just take the first hit. May decide to change in future.
-                if snp_hits:
-                    snp = snp_hits[0].rsid
-                else:
-                    snp = '-'
-            else:
-                snp = '-'
+    # decode the ragged GT/alleles/AF columns once into flat arrays and emit one row per called alt allele,
+    # because rsid and clinvar search will require the alt allele.
+    ### rows with NO ALT GENOTYPE are removed when `show_only_alt`. The assumption is that it will be a normal phenotype so not interesting
+    with stage('allele_decode', rows=df.shape[0]):
+        df = explode_alt_alleles(df,
+                                 genotype_label=genotype_label,
+                                 allele_label=allele_label,
+                                 af_label=af_label,
+                                 show_only_alt=show_only_alt,
+                                 )
+    # an emptied batch (e.g. only 0/. calls) still goes through the lookups below, which return no rows,
+    # so every batch of a stream has the same annotated columns
 
-        # CLINVAR
-            
-        clinvar_hits = list(Clinvars.objects.filter(
-            chromosome=s.loc['chr_int'],
-            start=s.loc[start_label],
-            stop=s.loc[stop_label],
-            alternateallelevcf=s.loc['alt_allele'],
-        ))
-        logger.info(f'search_for_snp_and_clinvar: clinvar_hits length: {len(clinvar_hits)}')
-        
-        if clinvar_hits:
-            clin = [clinvar_hits[0].id, clinvar_hits[0].alleleid, clinvar_hits[0].type, 
-                    clinvar_hits[0].name, clinvar_hits[0].geneid, clinvar_hits[0].genesymbol, 
-                    clinvar_hits[0].hgnc_id, clinvar_hits[0].clinicalsignificance, clinvar_hits[0].clinsigsimple, 
-                    clinvar_hits[0].lastevaluated, clinvar_hits[0].rsid, clinvar_hits[0].nsvesv, 
-                    clinvar_hits[0].rcvaccession, clinvar_hits[0].phenotypeids, clinvar_hits[0].phenotypelist, 
-                    clinvar_hits[0].origin, clinvar_hits[0].originsimple, clinvar_hits[0].assembly, 
-                    clinvar_hits[0].chromosomeaccession, clinvar_hits[0].chromosome, clinvar_hits[0].start, clinvar_hits[0].stop, 
-                    clinvar_hits[0].referenceallele, clinvar_hits[0].alternateallele, clinvar_hits[0].cytogenetic, 
-                    clinvar_hits[0].reviewstatus, clinvar_hits[0].numbersubmitters, clinvar_hits[0].guidelines, 
-                    clinvar_hits[0].testedingtr, clinvar_hits[0].otherids, clinvar_hits[0].submittercategories,
-                    clinvar_hits[0].variationid, clinvar_hits[0].positionvcf, clinvar_hits[0].referenceallelevcf,
-                    clinvar_hits[0].alternateallelevcf, clinvar_hits[0].order]
-        else:
-            clin = ['-'] * len(CLINVAR_FIELDS)
-        return [snp] + clin
-
-    # script starts here
-
-    df = df.copy()
-
-    # parse the alleles and GT into set of alt genotypes, padding extra cells with with np.nan
-    # gts = convert_pd_series_of_arrays_to_padded_np_array(df.loc[:, genotype_label])
-    # als = convert_pd_series_of_arrays_to_padded_np_array(df.loc[:, allele_label])
-    alt_allele_lists = df.apply(rowloop_index_a_with_b, axis=1, a_label=allele_label, b_label=genotype_label)
-    df['alt_allele'] = alt_allele_lists
-
-    alt_af_lists = df.apply(rowloop_index_a_with_b, axis=1, a_label=af_label, b_label=genotype_label, subtract_one=True)
-    df['alt_af'] = alt_af_lists
-
-    ### remove rows with NO ALT GENOTYPE. The assumption is that it will be a normal phenotype so not interesting
-    if show_only_alt:
-        df.dropna(axis=0, how='any', subset='alt_allele', inplace=True)
-        if df.shape[0] == 0:
-            return df
-        
-    
     df['chr_int'] = df.loc[:, chromosome_label].map(CHR_DICT_STR_TO_INT)
     
-    # gene_hit_names = np.array([g.gene for g in gene_hit_items])
-    # unique_hits, indices, counts = np.unique(gene_hit_names, return_index=True, return_counts=True)
-    # count_sorted_index = np.argsort(counts)            
-    # return [gene_hit_items[int(count_sorted_index[-1])].gene, gene_hit_items[int(count_sorted_index[-1])].product,]
-
     if flags.get('genelist_flag', False):
-        res_df_gene = pd.DataFrame(
-            df.apply(genelist_lookup_inside_loop, axis=1, result_type='expand').values,
-            columns=['gene'],
-            # columns=['gene','product']
-            )
+        # one vectorized pass over the in-memory gene interval index instead of one Genes query per row.
+        with stage('gene_lookup', rows=df.shape[0]):
+            res_df_gene = pd.DataFrame(
+                get_gene_index().lookup(df.loc[:, 'chr_int'], df.loc[:, start_label], df.loc[:, stop_label]),
+                columns=['gene'],
+                )
         logger.info('res_df_gene done')
-        df = pd.concat([df.reset_index(drop=True), res_df_gene], axis=1)
-    
-    # explodes more than one nonzero allele to multiple lines, because rsid and clinvar search will require the alt allele
-    df = df.explode(['alt_allele', 'alt_af']).reset_index(drop=True)
+        df = pd.concat([df, res_df_gene], axis=1)
 
     if flags.get('clinvar_flag', False):
         # apply a search limit so as not to make the user wait for so long, and also avoid a mistakenly large query.
-        if CLINVAR_SEARCH_LIMIT:
-            clinvar_result_df = df.iloc[:CLINVAR_SEARCH_LIMIT].apply(search_for_snp_and_clinvar, axis=1, result_type='expand')
-        else:
-            clinvar_result_df = df.apply(search_for_snp_and_clinvar, axis=1, result_type='expand')
-            
-        snp_clinvar_result = pd.DataFrame(clinvar_result_df.values,
-                                        columns=['rsid'] + CLINVAR_FIELDS)
+        # all unique variant keys are resolved with a few set-based queries instead of 2 queries per row.
+        snp_clinvar_result = batch_search_for_snp_and_clinvar(
+            df.iloc[:CLINVAR_SEARCH_LIMIT] if CLINVAR_SEARCH_LIMIT else df,
+            clinvar_fields=CLINVAR_FIELDS,
+            chromosome_label=chromosome_label,
+            start_label=start_label,
+            stop_label=stop_label,
+            allele_label=allele_label,
+            snp_search=SNP_SEARCH_FLAG,
+            backend=get_annotation_backend(),
+            )
 
+        # the Clinvars primary key is what the results page expands a row with
+        snp_clinvar_result = snp_clinvar_result.rename(columns={'id':'clinvar_id'})
         logger.info('snp_clinvar_result done')
         df = pd.concat([df, snp_clinvar_result], axis=1)
 
@@ -346,24 +791,6 @@ def _append_tiledb_with_annotation(df,
     return df
 
 
-###### UTILS ###################################
-
-def convert_pd_series_of_arrays_to_padded_np_array(s:pd.Series, fillna_value=np.nan):
-    return pd.DataFrame(s.tolist()).fillna(fillna_value).to_numpy()
-
-def filter_genotype_to_variants_only_output_mask(s:pd.Series) -> np.array:
-    """assumes that the max columns of gts is 2"""
-    gts = convert_pd_series_of_arrays_to_padded_np_array(s, 0)
-    if gts.shape[1] > 2:
-        warnings.warn('<filter_genotype_to_variants_only>:fmt_GT had more than 2 strands. Truncating to 2 only.')
-        gts = gts.iloc[:, :2]
-    arr = gts == 0
-    arr2 = gts == -1
-    mask = ~(np.einsum('i,i->i', arr[:,0], arr[:,1]) | np.einsum('i,i->i', arr2[:,0], arr2[:,1]))
-    
-    
-    return mask
-
 ###### STYLERS #################################
 cell_hover = {  # for row hover use <tr> instead of <td>
     'selector': 'tr:hover',
@@ -375,9 +802,18 @@ generic_cell = {
     'props': [('text-align', 'center')]
     }
 
+def _clinvar_detail_link(clinvar_id):
+    if clinvar_id in (None, '-') or pd.isna(clinvar_id):
+        return '-'
+    url = reverse('clinvar_detail', kwargs=dict(clinvar_id=int(clinvar_id)))
+    return f'<a href="{url}" class="clinvar-detail">{clinvar_id}</a>'
+
 def style_result_dataframe(styler):
     styler.set_table_attributes('class="table"')    
     styler.set_table_styles([generic_cell, cell_hover], overwrite=True)    
+    if 'clinvar_id' in styler.data.columns:
+        # the large clinvar text fields are not in the result, they are fetched when the row is expanded
+        styler.format(_clinvar_detail_link, subset=['clinvar_id'])
     return styler
 
 def dataframe_common_final_reformat(df):